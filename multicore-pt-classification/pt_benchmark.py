@@ -0,0 +1,173 @@
+""" Benchmarks for the parallel tempering sampler in pt_classification_dropout.py
+
+python pt_benchmark.py precision     compare acceptance, accuracy and run time of float64 and float32 runs
+python pt_benchmark.py precision --pool     the same runs on one ReplicaPool instead of new processes
+python pt_benchmark.py allocations   bytes retained by two windows of steady-state passes and peak of one, exits 1 over --max-retained or --max-peak
+python pt_benchmark.py startup       seconds until the replicas run and propose, fork, forkserver and spawn
+python pt_benchmark.py shards --rows 200000     likelihood time and agreement with 1, 2, 4 and 8 shards
+"""
+
+from __future__ import print_function, division
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from pt_core import DropoutType, Network, ShardedKernel
+from pt_classification_dropout import ParallelTempering, ReplicaPool, set_start_method
+
+
+def load_problem(name):
+    # small problems that run in seconds, same preprocessing as main()
+    if name == 'iris':
+        data = np.genfromtxt('DATA/iris.csv', delimiter=';')
+        features = data[:, 0:4]
+        classes = data[:, 4].reshape(data.shape[0], 1) - 1
+        features = (features - np.mean(features, axis=0)) / np.std(features, axis=0)
+        indices = np.random.permutation(features.shape[0])
+        split = int(0.7 * features.shape[0])
+        traindata = np.hstack([features[indices[:split]], classes[indices[:split]]])
+        testdata = np.hstack([features[indices[split:]], classes[indices[split:]]])
+        return traindata, testdata, [4, 12, 3]
+    if name == 'cancer':
+        traindata = np.genfromtxt('DATA/Cancer/ftrain.txt', delimiter=' ')[:, :-1]
+        testdata = np.genfromtxt('DATA/Cancer/ftest.txt', delimiter=' ')[:, :-1]
+        return traindata, testdata, [9, 12, 2]
+    if name == 'ionosphere':
+        traindata = np.genfromtxt('DATA/Ions/Ions/ftrain.csv', delimiter=',')[:, :-1]
+        testdata = np.genfromtxt('DATA/Ions/Ions/ftest.csv', delimiter=',')[:, :-1]
+        return traindata, testdata, [34, 50, 2]
+    raise ValueError('Unknown benchmark problem: {}'.format(name))
+
+
+def run_pt(traindata, testdata, topology, dropout_type, num_samples, num_chains, precision, pool=None):
+    path = tempfile.mkdtemp(prefix='pt_benchmark_')
+    swap_interval = max(1, int(0.01 * num_samples / num_chains))
+    pt = ParallelTempering(True, 0.1, 0.1, 0.1, dropout_type, traindata, testdata, topology, num_chains, 2, num_samples, swap_interval, path, precision=precision, pool=pool)
+    for d in ['/predictions/', '/posterior', '/posterior/pos_w', '/posterior/pos_likelihood', '/posterior/accept_list', '/traces']:
+        pt.make_directory(path + d)
+    pt.initialize_chains(0.5)
+
+    timer = time.time()
+    pos_w, fx_train, fx_test, rmse_train, rmse_test, acc_train, acc_test, likelihood_rep, swap_perc, accept_vec, accept = pt.run_chains()
+    timetotal = time.time() - timer
+    shutil.rmtree(path)
+
+    return {'accept': accept, 'swap': swap_perc, 'acc_train': np.mean(acc_train), 'acc_test': np.mean(acc_test), 'time': timetotal, 'startup': pt.startup}
+
+
+def precision_benchmark(args):
+    traindata, testdata, topology = load_problem(args.problem)
+    dropout_type = DropoutType[args.dropout]
+    pool = ReplicaPool(args.chains) if args.pool else None
+    print('{:>8} {:>8} {:>8} {:>10} {:>10} {:>8}'.format('dtype', 'accept', 'swap', 'acc_train', 'acc_test', 'time'))
+    for precision in (np.float64, np.float32):
+        for repeat in range(args.repeats):
+            res = run_pt(traindata, testdata, topology, dropout_type, args.samples, args.chains, precision, pool)
+            print('{:>8} {:8.2f} {:8.2f} {:10.2f} {:10.2f} {:8.2f}'.format(np.dtype(precision).name, res['accept'], res['swap'], res['acc_train'], res['acc_test'], res['time']))
+    if pool is not None:
+        pool.close()
+
+
+def steady_state_allocations(fnn, data, w, iterations, warmup=50):
+    """Bytes retained by two windows of iterations of the gradient and likelihood passes after warm-up, and the largest peak of one iteration.
+
+    The peak is reset before every iteration and measured from the traced memory at its start.
+    """
+    w_gd = np.zeros(fnn.num_param)
+    tracemalloc.start()
+    for i in range(warmup): # workspaces and masks are allocated by then
+        fnn.langevin_gradient(data, w, 1, out=w_gd)
+        fnn.kernel.log_likelihood(fnn, data, w)
+    marks = []
+    peak = 0
+    for window in range(2):
+        marks.append(tracemalloc.get_traced_memory()[0])
+        for i in range(iterations):
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fnn.langevin_gradient(data, w, 1, out=w_gd)
+            fnn.kernel.log_likelihood(fnn, data, w)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - start)
+    marks.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    return marks[1] - marks[0], marks[2] - marks[1], peak
+
+
+def allocation_benchmark(args):
+    """Fails when the second window retains more than args.max_retained bytes or an iteration peaks over args.max_peak bytes.
+
+    The first window also holds the few objects of the measurement itself, the second should retain nothing.
+    The peak of an iteration is the array views and scalars of its per-pattern loop, no array buffers.
+    """
+    traindata, testdata, topology = load_problem(args.problem)
+    print('{:>18} {:>8} {:>10} {:>10} {:>16} {:>6}'.format('dropout', 'dtype', 'window 1', 'window 2', 'peak/iteration', ''))
+    passed = True
+    for dropout_type in DropoutType:
+        for precision in (np.float64, np.float32):
+            fnn = Network(topology, traindata, testdata, 0.1, 0.1, 0.1, dropout_type, np.random.default_rng(), dtype=precision)
+            first, second, peak = steady_state_allocations(fnn, traindata, np.random.randn(fnn.num_param), args.repeats)
+            ok = second <= args.max_retained and peak <= args.max_peak
+            passed &= ok
+            print('{:>18} {:>8} {:10d} {:10d} {:16d} {:>6}'.format(dropout_type.name, np.dtype(precision).name, first, second, peak, 'ok' if ok else 'FAIL'))
+    return passed
+
+
+def startup_benchmark(args):
+    traindata, testdata, topology = load_problem(args.problem)
+    dropout_type = DropoutType[args.dropout]
+    print('{:>12} {:>10} {:>10} {:>14}'.format('method', 'mean', 'max', 'first proposal'))
+    for method in ('fork', 'forkserver', 'spawn'):
+        set_start_method(method)
+        for repeat in range(args.repeats):
+            startup = run_pt(traindata, testdata, topology, dropout_type, args.samples, args.chains, np.float64)['startup']
+            print('{:>12} {:10.3f} {:10.3f} {:14.3f}'.format(method, startup[:, 0].mean(), startup[:, 0].max(), startup[:, 1].max()))
+
+
+def shard_benchmark(args):
+    traindata, testdata, topology = load_problem(args.problem)
+    data = np.tile(traindata, (max(1, args.rows // traindata.shape[0]), 1)) # a large dataset of the problem's rows
+    fnn = Network(topology, data, data, 0.1, 0.1, 0.1, DropoutType[args.dropout], np.random.default_rng())
+    w = np.random.randn(fnn.num_param)
+    lhood, fx, rmse = fnn.kernel.log_likelihood(fnn, data, w)
+    fx = fx.copy()
+    print('{} rows'.format(data.shape[0]))
+    print('{:>8} {:>12} {:>14} {:>12}'.format('shards', 'ms', 'likelihood', 'fx differ'))
+    for shards in (1, 2, 4, 8):
+        kernel = ShardedKernel(fnn.kernel, shards)
+        kernel.log_likelihood(fnn, data, w) # shard networks and workspaces
+        timer = time.time()
+        for repeat in range(args.repeats):
+            shard_lhood, shard_fx, shard_rmse = kernel.log_likelihood(fnn, data, w)
+        print('{:>8} {:12.2f} {:14.6g} {:>12}'.format(shards, 1000 * (time.time() - timer) / args.repeats, shard_lhood - lhood, np.count_nonzero(shard_fx != fx)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['precision', 'allocations', 'startup', 'shards'])
+    parser.add_argument('--problem', default='iris', choices=['iris', 'cancer', 'ionosphere'])
+    parser.add_argument('--dropout', default='DROP_CONNECT', choices=[d.name for d in DropoutType])
+    parser.add_argument('--samples', type=int, default=4000)
+    parser.add_argument('--chains', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--pool', action='store_true', help='run the chains on a ReplicaPool')
+    parser.add_argument('--rows', type=int, default=200000, help='rows of the shards benchmark')
+    parser.add_argument('--max-retained', type=int, default=0, help='bytes the second allocations window may retain')
+    parser.add_argument('--max-peak', type=int, default=1536, help='bytes one allocations iteration may hold at its peak')
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # DATA paths are relative to this folder
+    if args.benchmark == 'precision':
+        precision_benchmark(args)
+    elif args.benchmark == 'startup':
+        startup_benchmark(args)
+    elif args.benchmark == 'shards':
+        shard_benchmark(args)
+    elif not allocation_benchmark(args):
+        sys.exit(1)
+
+if __name__ == "__main__": main()
@@ -71,7 +71,7 @@ class Network:
 
     def BackwardPass(self, Input, desired): # since data outputs and number of output neuons have different orgnisation
         onehot = np.zeros((desired.size, self.Top[2]))
-        onehot[np.arange(desired.size),int(desired)] = 1
+        onehot[np.arange(desired.size),int(desired[0])] = 1
         desired = onehot
         out_delta = (desired - self.out)*(self.out*(1 - self.out))
         hid_delta = np.dot(out_delta,self.W2.T) * (self.hidout * (1 - self.hidout))
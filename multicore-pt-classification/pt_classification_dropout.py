@@ -5,250 +5,45 @@ import multiprocessing
 import os
 import sys
 import gc
+import contextlib
+import fcntl
+import mmap
+import traceback
 import numpy as np
 import random
 import time
 import operator
 import math
-import matplotlib as mpl
-mpl.use('agg')
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-from scipy.stats import multivariate_normal
-from scipy.stats import norm
 #import GPy  
 #np.random.seed(1)
 
 import io  
-from enum import Enum
-class DropoutType(Enum):
-    ORIGIN = 1
-    DROP_CONNECT = 2
-    GAUSSIAN_DROPOUT = 3
-
-class Network:
-
-    def __init__(self, Topo, Train, Test, learn_rate, input_dropout, hidden_dropout, dropout_type=DropoutType.ORIGIN):
-        self.Top = Topo  # NN topology [input, hidden, output]
-        self.TrainData = Train
-        self.TestData = Test
-        self.lrate = learn_rate
-        self.input_dropout = input_dropout
-        self.hidden_dropout = hidden_dropout
-        self.dropout_type = dropout_type
-
-        self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-        self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-        self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-        self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
-        self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
-        self.out = np.zeros((1, self.Top[2]))  # output last layer
-        self.pred_class = 0
-
-    def sigmoid(self, x):
-        return 1 / (1 + np.exp(-x))
-
-    def sampleEr(self, actualout):
-        error = np.subtract(self.out, actualout)
-        sqerror = np.sum(np.square(error)) / self.Top[2]
-        return sqerror
-
-    def ForwardPass(self, X, eval=False):
-        if eval:
-            input_dropout = 0
-            hidden_dropout = 0
-        else:
-            input_dropout = self.input_dropout
-            hidden_dropout = self.hidden_dropout
-
-        if self.dropout_type == DropoutType.ORIGIN:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*z1.shape) > input_dropout).astype(float)
-            z1 = z1 * self.input_dropout_mask / (1.0 - input_dropout) # dropout on z1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*z2.shape) > hidden_dropout).astype(float)
-            z2 = z2 * self.hidden_dropout_mask / (1.0 - hidden_dropout) # dropout on z2
-            self.out = self.sigmoid(z2)  # output second hidden layer
-            self.pred_class = np.argmax(self.out)
-
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(self.W1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*self.W1.shape) > input_dropout).astype(float)
-            
-            z1 = X.dot(self.W1 * self.input_dropout_mask / (1.0 - input_dropout)) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(self.W2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*self.W2.shape) > hidden_dropout).astype(float)
-            z2 = self.hidout.dot(self.W2 * self.hidden_dropout_mask / (1.0 - hidden_dropout)) - self.B2
-            self.out = self.sigmoid(z2)
-            self.pred_class = np.argmax(self.out)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                sigma1 = input_dropout * (1 - input_dropout)
-                self.input_dropout_mask = np.random.normal(1, sigma1, z1.shape)
-            z1  = z1 * self.input_dropout_mask
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                sigma2 = hidden_dropout * (1 - hidden_dropout)
-                self.hidden_dropout_mask = np.random.normal(1, sigma2, z2.shape)
-            z2 = z2 * self.hidden_dropout_mask
-            self.out = self.sigmoid(z2)
-            self.pred_class = np.argmax(self.out)
-
-        else:
-            z1 = X.dot(self.W1) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-            z2 = self.hidout.dot(self.W2) - self.B2
-            self.out = self.sigmoid(z2)  # output second hidden layer
-            self.pred_class = np.argmax(self.out)
-
-    def BackwardPass(self, Input, desired): # since data outputs and number of output neuons have different orgnisation
-        onehot = np.zeros((desired.size, self.Top[2]))
-        onehot[np.arange(desired.size),int(desired)] = 1
-        desired = onehot
-
-        if self.dropout_type == DropoutType.ORIGIN:
-            out_delta = (desired - self.out)*(self.out*(1 - self.out))
-            hid_delta = np.dot(out_delta,self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += np.dot(self.hidout.T,self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout) * self.lrate)
-            self.B2 += (-1 * self.lrate * self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout))
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += np.dot(Input.T,(self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout) * self.lrate))
-            self.B1 += (-1 * self.lrate * self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout))
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :]) * self.hidden_dropout_mask / (1.0 - self.hidden_dropout)
-            self.B2 += -self.lrate * (out_delta)
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :]) * self.input_dropout_mask / (1.0 - self.input_dropout)
-            self.B1 += -self.lrate * (hid_delta)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot((self.hidden_dropout_mask * out_delta)[np.newaxis, :])
-            self.B2 += -self.lrate * (self.hidden_dropout_mask * out_delta)
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += self.lrate * Input[:, np.newaxis].dot((self.input_dropout_mask * hid_delta)[np.newaxis, :])
-            self.B1 += -self.lrate * (self.input_dropout_mask * hid_delta)
-        else:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :])
-            self.B2 += -self.lrate * out_delta
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :])
-            self.B1 += -self.lrate * hid_delta
-
-    def decode(self, w):
-        w_layer1size = self.Top[0] * self.Top[1]
-        w_layer2size = self.Top[1] * self.Top[2]
-
-        w_layer1 = w[0:w_layer1size]
-        self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-        w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-        self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-        self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1,self.Top[1])
-        self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]].reshape(1,self.Top[2])
-
- 
-
-    def encode(self):
-        w1 = self.W1.ravel()
-        w1 = w1.reshape(1,w1.shape[0])
-        w2 = self.W2.ravel()
-        w2 = w2.reshape(1,w2.shape[0])
-        w = np.concatenate([w1.T, w2.T, self.B1.T, self.B2.T])
-        w = w.reshape(-1)
-        return w
-
-    def softmax(self):
-        prob = np.exp(self.out)/np.sum(np.exp(self.out))
-        return prob
- 
-
-
-    def langevin_gradient(self, data, w, depth):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-
-        for i in range(0, depth):
-            for i in range(0, size):
-                pat = i
-                Input = data[pat, 0:self.Top[0]]
-                Desired = data[pat, self.Top[0]:]
-                self.ForwardPass(Input)
-                self.BackwardPass(Input, Desired)
-        w_updated = self.encode()
-
-        return  w_updated
-
-    def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-        prob = np.zeros((size,self.Top[2]))
-
-        for i in range(0, size):  # to see what fx is produced by your current weight update
-            Input = data[i, 0:self.Top[0]]
-            self.ForwardPass(Input, eval=True)
-            fx[i] = self.pred_class
-            prob[i] = self.softmax()
-
-        #print(fx, 'fx')
-        #print(prob, 'prob' )
-
-        return fx, prob
- 
-
+from pt_core import DropoutType, Network, CategoricalKernel, ShardedKernel, num_parameters
+from pt_posterior import RecordingPolicy, ChainRecorder, StreamingSummary, PosteriorPredictions, load_traces, load_summary
+from pt_diagnostics import ConvergenceMonitor, IntervalStatistics, status_board
+from pt_datasets import load_problem
+from pt_results import RESULT_COLUMNS, ResultsStore
+from pt_threads import ReplicaLayout, blas_limits, restore_blas_limits
+from pt_exchange import QueueChannel, QueueTransport, SocketTransport
+from pt_status import STATUS_INTERVAL, ReplicaStatus, create_status, replica_row, status_line
 
 class ptReplica(multiprocessing.Process):
 
-    def __init__(self, use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, w, minlim_param, maxlim_param, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, parameter_queue, main_process,event ):
+    def __init__(self, use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, w, minlim_param, maxlim_param, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, parameter_queue, main_process,event, precision=np.float64, dropout_rates=None, kernel=None, recording=None, board=None, chain_index=0, stop=None, launched=None, layout=None, channel=None, status=None, verbose=False ):
         #MULTIPROCESSING VARIABLES
         multiprocessing.Process.__init__(self)
+        self.launched = launched # time the main process started the replica, for its startup time
+        self.layout = layout # ReplicaLayout of its BLAS threads and CPUs, None leaves them as inherited
         self.processID = temperature
         self.parameter_queue = parameter_queue
         self.signal_main = main_process
         self.event =  event
+        self.board = board # shared status board of the ConvergenceMonitor, None when not monitored
+        self.chain_index = chain_index
+        self.stop = stop # set by the main process to end the run at the next swap point
+        self.channel = channel # exchange with the main process, the queue and events above when None
+        self.status = status # row of its counters, None for its row of the status file of the run folder
+        self.verbose = verbose # prints every accepted proposal and its acceptance at the end
 
         self.temperature = temperature
         self.adapttemp = temperature
@@ -277,49 +72,54 @@ class ptReplica(multiprocessing.Process):
         self.input_dropout = input_dropout
         self.hidden_dropout = hidden_dropout
         self.dropout_type = dropout_type
+        self.precision = precision # forward, likelihood and gradient dtype, the chain state stays float64
+        self.dropout_rates = dropout_rates # per-layer dropout rates, None for input_dropout then hidden_dropout
+        self.kernel = CategoricalKernel() if kernel is None else kernel
+        self.pt_samples = int(samples * 0.6) # this means that PT in canonical form with adaptive temp will work till pt  samples are reached
+        # start already resolved; the canonical phase is recorded from the first state sampled at T=1
+        self.recording = (RecordingPolicy(start=0) if recording is None else recording).for_chain(temperature, self.pt_samples + 1)
 
         self.l_prob = 0.5  # can be evaluated for diff problems - if data too large keep this low value since the gradients cost comp time
         self.w_size =0
 
 
+    def __getstate__(self):
+        # pickled by the spawn and forkserver start methods, memory-mapped datasets are sent as their file
+        state = dict(self.__dict__)
+        state['traindata'] = MappedArray.of(self.traindata)
+        state['testdata'] = MappedArray.of(self.testdata)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in ('traindata', 'testdata'):
+            if isinstance(state[name], MappedArray):
+                setattr(self, name, state[name].open())
+
     def rmse(self, pred, actual): 
 
         return np.sqrt(((pred-actual)**2).mean())
 
     def accuracy(self,pred,actual ):
-        count = 0
-        for i in range(pred.shape[0]):
-            if pred[i] == actual[i]:
-                count+=1 
- 
 
-        return 100*(count/pred.shape[0])
+        return 100*(np.count_nonzero(pred == actual)/pred.shape[0])
 
     def likelihood_func(self, fnn, data, w):
-        y = data[:, self.topology[0]]
-        fx, prob = fnn.evaluate_proposal(data,w)
-        rmse = self.rmse(fx,y)
-        z = np.zeros((data.shape[0],self.topology[2]))
-        lhood = 0
-        for i in range(data.shape[0]):
-            for j in range(self.topology[2]):
-                if j == y[i]:
-                    z[i,j] = 1
-                lhood += z[i,j]*np.log(prob[i,j])
-  
+        lhood, fx, rmse = self.kernel.log_likelihood(fnn, data, w)
 
         return [lhood/self.adapttemp, fx, rmse]
 
     def prior_likelihood(self, sigma_squared, nu_1, nu_2, w):
-        h = self.topology[1]  # number hidden neurons
-        d = self.topology[0]  # number input neurons
-        part1 = -1 * ((d * h + h + self.topology[2]+h*self.topology[2]) / 2) * np.log(sigma_squared)
-        part2 = 1 / (2 * sigma_squared) * (sum(np.square(w)))
-        log_loss = part1 - part2
-        return log_loss
+        return self.kernel.log_prior(sigma_squared, nu_1, nu_2, w)
 
     def run(self):
+        started = time.time()
+        limited = False # whether the BLAS threads of the layout apply here
+        if self.layout is not None:
+            limited = self.layout.apply(self.chain_index)
         #INITIALISING FOR FNN
+        self.traindata = np.ascontiguousarray(self.traindata, dtype=self.precision) # float32 halves the dataset copies
+        self.testdata = np.ascontiguousarray(self.testdata, dtype=self.precision)
         testsize = self.testdata.shape[0]
         trainsize = self.traindata.shape[0]
         samples = self.samples 
@@ -333,29 +133,33 @@ class ptReplica(multiprocessing.Process):
 
 
         
-        w_size = (netw[0] * netw[1]) + (netw[1] * netw[2]) + netw[1] + netw[2]  # num of weights and bias
+        w_size = num_parameters(netw)  # num of weights and bias
         self.w_size = w_size
-        pos_w = np.ones((samples, w_size)) #Posterior for all weights
-        #pos_w = np.ones((samples, w_size)) #Posterior for all weights
-        lhood_list = np.zeros((samples,1))
-        surrogate_list = np.zeros((samples,1))
+        # pos_w, likelihood, rmse, accuracy, accept and w_traces as far as the recording policy keeps them
+        recorder = ChainRecorder(self.recording, samples, w_size, trainsize, testsize, self.kernel.prediction_dtype)
+        recorder.open(self.path, self.temperature) # blocks are written by a thread while sampling
+        statistics = None if self.board is None else IntervalStatistics(self.board, self.chain_index)
+        status = ReplicaStatus(replica_row(self.path, self.chain_index) if self.status is None else self.status, self.temperature, samples)
+        # constant-memory moments and quantiles after the burn-in, in segments when a monitor detects it or may stop the run early
+        summary = StreamingSummary(None if self.board is not None else int(samples * self.burn_in), w_size)
         #fxtrain_samples = np.ones((batch_save, trainsize)) #Output of regression FNN for training samples
         #fxtest_samples = np.ones((batch_save, testsize)) #Output of regression FNN for testing samples
-        rmse_train  = np.zeros(samples)
-        rmse_test = np.zeros(samples)
-        acc_train = np.zeros(samples)
-        acc_test = np.zeros(samples)
         learn_rate = self.learn_rate
  
         #Random Initialisation of weights
-        w = self.w
+        w = self.w.copy()
         eta = 0 #Junk variable 
         #print(w,self.temperature)
-        w_proposal = np.random.randn(w_size)
+        rng = np.random.default_rng()
+        w_proposal = rng.standard_normal(w_size)
+        # buffers reused by every proposal, w and w_proposal are swapped on acceptance
+        w_gd = np.zeros(w_size)
+        w_prop_gd = np.zeros(w_size)
+        w_delta = np.zeros(w_size)
         #Randomwalk Steps
         step_w = 0.025
         #Declare FNN
-        fnn = Network(self.topology, self.traindata, self.testdata, learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type)
+        fnn = Network(self.topology, self.traindata, self.testdata, learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, rng, dtype=self.precision, dropout_rates=self.dropout_rates, kernel=self.kernel)
         #Evaluate Proposals
         pred_train, prob_train = fnn.evaluate_proposal(self.traindata,w) #	
         pred_test, prob_test = fnn.evaluate_proposal(self.testdata, w) #
@@ -363,9 +167,6 @@ class ptReplica(multiprocessing.Process):
         sigma_squared = 25
         nu_1 = 0
         nu_2 = 0
-        sigma_diagmat = np.zeros((w_size, w_size))  # for Equation 9 in Ref [Chandra_ICONIP2017]
-        np.fill_diagonal(sigma_diagmat, step_w)
-
         delta_likelihood = 0.5 # an arbitrary position
         prior_current = self.prior_likelihood(sigma_squared, nu_1, nu_2, w)  # takes care of the gradients
         #Evaluate Likelihoods
@@ -375,20 +176,24 @@ class ptReplica(multiprocessing.Process):
         
  
 
-        trainacc = 0
-        testacc=0
-
-        prop_list = np.zeros((samples,w_proposal.size))
-        likeh_list = np.zeros((samples,2)) # one for posterior of likelihood and the other for all proposed likelihood
-        likeh_list[0,:] = [-100, -100] # to avoid prob in calc of 5th and 95th percentile later
-        surg_likeh_list = np.zeros((samples,2))
-        accept_list = np.zeros(samples)
+        trainacc = self.accuracy(pred_train, y_train)
+        testacc = self.accuracy(pred_test, y_test)
+        rmsetrain_current = rmsetrain
+        rmsetest_current = rmsetest
+        w_current = w.copy() # last accepted state, what pos_w records until the next acceptance
+        fxtrain_current = pred_train.copy() # its predictions, pred_train and pred_test are overwritten by every proposal
+        fxtest_current = pred_test.copy()
 
         num_accepted = 0
 
+        # likelihood has one column for all proposed likelihoods and one for the posterior, row 0 is -100
+        # to avoid prob in calc of 5th and 95th percentile later
+        recorder.record(0, state=num_accepted, pos_w=w_current, likelihood=(-100, -100), rmse_train=rmsetrain, rmse_test=rmsetest, acc_train=trainacc, acc_test=testacc, accept=0, fx_train=fxtrain_current, fx_test=fxtest_current)
+        summary.record(0, (num_accepted, 0), w_current, likelihood=likelihood * self.adapttemp, rmse_train=rmsetrain, rmse_test=rmsetest, acc_train=trainacc, acc_test=testacc)
+
         langevin_count = 0
 
-        pt_samples = samples * 0.6 # this means that PT in canonical form with adaptive temp will work till pt  samples are reached
+        pt_samples = self.pt_samples
 
         init_count = 0
 
@@ -398,9 +203,11 @@ class ptReplica(multiprocessing.Process):
 
 
 
-        self.event.clear()
-
-        w_traces = list()
+        channel = QueueChannel(self.parameter_queue, self.signal_main, self.event, self.stop) if self.channel is None else self.channel
+        stopping = False
+        if self.launched is not None:
+            # seconds from the start by the main process to run() and to the first proposal, then 1 if its BLAS threads were limited
+            np.savetxt(self.path + '/posterior/startup_chain_' + str(self.temperature) + '.txt', [started - self.launched, time.time() - self.launched, limited], fmt='%1.4f')
 
         for i in range(samples-1):  # Begin sampling --------------------------------------------------------------------------
 
@@ -423,19 +230,20 @@ class ptReplica(multiprocessing.Process):
             lx = np.random.uniform(0,1,1)
 
             if (self.use_langevin_gradients is True) and (lx< self.l_prob):  
-                w_gd = fnn.langevin_gradient(self.traindata, w.copy(), self.sgd_depth) # Eq 8
-                w_proposal = np.random.normal(w_gd, step_w, w_size) # Eq 7
-                w_prop_gd = fnn.langevin_gradient(self.traindata, w_proposal.copy(), self.sgd_depth) 
+                fnn.langevin_gradient(self.traindata, w, self.sgd_depth, out=w_gd) # Eq 8
+                rng.standard_normal(out=w_proposal) # Eq 7
+                w_proposal *= step_w
+                w_proposal += w_gd
+                fnn.langevin_gradient(self.traindata, w_proposal, self.sgd_depth, out=w_prop_gd) 
                 #first = np.log(multivariate_normal.pdf(w , w_prop_gd , sigma_diagmat)) 
                 #second = np.log(multivariate_normal.pdf(w_proposal , w_gd , sigma_diagmat)) # this gives numerical instability - hence we give a simple implementation next that takes out log 
 
-                wc_delta = (w- w_prop_gd) 
-                wp_delta = (w_proposal - w_gd )
-
                 sigma_sq = step_w * step_w
 
-                first = -0.5 * np.sum(wc_delta  *  wc_delta  ) / sigma_sq  # this is wc_delta.T  *  wc_delta /sigma_sq
-                second = -0.5 * np.sum(wp_delta * wp_delta ) / sigma_sq
+                wc_delta = np.subtract(w, w_prop_gd, out=w_delta) 
+                first = -0.5 * np.dot(wc_delta, wc_delta) / sigma_sq  # this is wc_delta.T  *  wc_delta /sigma_sq
+                wp_delta = np.subtract(w_proposal, w_gd, out=w_delta)
+                second = -0.5 * np.dot(wp_delta, wp_delta) / sigma_sq
 
             
                 diff_prop =  first - second
@@ -448,7 +256,9 @@ class ptReplica(multiprocessing.Process):
 
             else:
                 diff_prop = 0
-                w_proposal = np.random.normal(w, step_w, w_size)
+                rng.standard_normal(out=w_proposal)
+                w_proposal *= step_w
+                w_proposal += w
    
 
             # no need since priors take care of this issue
@@ -464,9 +274,6 @@ class ptReplica(multiprocessing.Process):
 
             [likelihood_ignore, pred_test, rmsetest] = self.likelihood_func(fnn, self.testdata, w_proposal)
 
-            surg_likeh_list[i+1,0] = likelihood_proposal
-            surg_likeh_list[i+1,1] = np.nan
-
             prior_prop = self.prior_likelihood(sigma_squared, nu_1, nu_2, w_proposal)  # takes care of the gradients
             
             diff_likelihood = likelihood_proposal - likelihood
@@ -480,10 +287,6 @@ class ptReplica(multiprocessing.Process):
 
 
 
-            accept_list[i+1] = num_accepted
-
-            #accept_list[i+1] = self.adapttemp
-
             if (i % batch_save+1) == 0: # just for saving posterior to file - work on this later
                 x = 0
 
@@ -492,112 +295,231 @@ class ptReplica(multiprocessing.Process):
             u = random.uniform(0, 1)
  
             
-            prop_list[i+1,] = w_proposal	
-            likeh_list[i+1,0] = likelihood_proposal * self.adapttemp
-
- 
-
             if u < mh_prob:
                 num_accepted  =  num_accepted + 1
                 likelihood = likelihood_proposal
                 prior_current = prior_prop
-                w = w_proposal 
+                w, w_proposal = w_proposal, w 
 
-                acc_train[i+1,] = self.accuracy(pred_train, y_train )  
-                acc_test[i+1,] = self.accuracy(pred_test, y_test )
+                trainacc = self.accuracy(pred_train, y_train )  
+                testacc = self.accuracy(pred_test, y_test )
 
-                print (i, langevin_count, self.adapttemp, self.temperature, diff_prop ,  likelihood, rmsetrain, rmsetest, acc_train[i+1,], acc_test[i+1,] , 'accepted') 
-
-                pos_w[i+ 1,] = w_proposal
+                if self.verbose:
+                    print (i, langevin_count, self.adapttemp, self.temperature, diff_prop ,  likelihood, rmsetrain, rmsetest, trainacc, testacc , 'accepted') 
 
                 #fxtrain_samples[i + 1,] = pred_train
                 #fxtest_samples[i + 1,] = pred_test
-                rmse_train[i + 1,] = rmsetrain
-                rmse_test[i + 1,] = rmsetest 
-                #x = x + 1
-
-            else:
-                pos_w[i+1,] = pos_w[i,] 
-                #fxtrain_samples[i + 1,] = fxtrain_samples[i,]
-                #fxtest_samples[i + 1,] = fxtest_samples[i,]
-                rmse_train[i + 1,] = rmse_train[i,]
-                rmse_test[i + 1,] = rmse_test[i,]
-                acc_train[i+1,] = acc_train[i,]
-                acc_test[i+1,] = acc_test[i,]
-
-                #x = x + 1
+                rmsetrain_current = rmsetrain
+                rmsetest_current = rmsetest 
+                w_current[:] = w
+                fxtrain_current[:] = pred_train
+                fxtest_current[:] = pred_test
+
+            # a rejected proposal records the current state again
+            recorder.record(i + 1, state=num_accepted, pos_w=w_current, likelihood=(likelihood_proposal * self.adapttemp, likelihood * self.adapttemp), rmse_train=rmsetrain_current, rmse_test=rmsetest_current, acc_train=trainacc, acc_test=testacc, accept=num_accepted, fx_train=fxtrain_current, fx_test=fxtest_current)
+            # the likelihood of the state is recomputed when the canonical phase starts
+            summary.record(i + 1, (num_accepted, init_count), w_current, likelihood=likelihood * self.adapttemp, rmse_train=rmsetrain_current, rmse_test=rmsetest_current, acc_train=trainacc, acc_test=testacc)
+            if statistics is not None:
+                statistics.add(self.adapttemp, likelihood * self.adapttemp, np.dot(w, w))
             #SWAPPING PREP
             if (i+1)%self.swap_interval == 0:
+                if statistics is not None:
+                    statistics.post(i + 1)
+                status.post(i + 1, num_accepted, langevin_count, likelihood * self.adapttemp)
                 param = np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood]),np.asarray([self.temperature]),np.asarray([i])])
-                self.parameter_queue.put(param)
-                self.signal_main.set()
-                self.event.clear()
-                self.event.wait()
-                # retrieve parameters fom queues if it has been swapped
-                result =  self.parameter_queue.get()
-                w= result[0:w.size]     
+                waiting = time.time()
+                result, stopping = channel.exchange(param)
+                status.swap_wait += time.time() - waiting
+                w[:] = result[0:w.size]     
                 eta = result[w.size]
                 #likelihood = result[w.size+1]
+            elif (i+1)%STATUS_INTERVAL == 0:
+                status.post(i + 1, num_accepted, langevin_count, likelihood * self.adapttemp)
 
-            w_traces.append(w)
-        
-        file_name = self.path + '/traces/w_traces_' + str(self.temperature) + '_.npy'
-        np.save(file_name, w_traces)
+            recorder.record(i + 1, w_traces=w)
+            if stopping:
+                break
 
         param = np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood]),np.asarray([self.temperature]),np.asarray([i])])
         #print('SWAPPED PARAM',self.temperature,param)
-        self.parameter_queue.put(param)
+        status.post(i + 1, num_accepted, langevin_count, likelihood * self.adapttemp, finished=True)
+        channel.finish(param)
         #param = np.concatenate([s_pos_w[i-self.surrogate_interval:i,:],lhood_list[i-self.surrogate_interval:i,:]],axis=1)
         #self.surrogate_parameterqueue.put(param) 
-        self.signal_main.set()
-        print ((num_accepted*100 / (samples * 1.0)), '% was accepted')
+        samples = i + 2 # fewer than self.samples when the run was stopped early
+        if self.verbose: # the status board shows both
+            print ((num_accepted*100 / (samples * 1.0)), '% was accepted')
         accept_ratio = num_accepted / (samples * 1.0) * 100 
 
 
-        print ((langevin_count*100 / (samples * 1.0)), '% was Lsnngrevin ')
+        if self.verbose:
+            print ((langevin_count*100 / (samples * 1.0)), '% was Lsnngrevin ')
         langevin_ratio = langevin_count / (samples * 1.0) * 100 
 
         
-        file_name = self.path+'/posterior/pos_w/'+'chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name,pos_w )
-        
-        #file_name = self.path+'/predictions/fxtrain_samples_chain_'+ str(self.temperature)+ '.txt'
-        #np.savetxt(file_name, fxtrain_samples, fmt='%1.2f')
-        #file_name = self.path+'/predictions/fxtest_samples_chain_'+ str(self.temperature)+ '.txt'
-        #np.savetxt(file_name, fxtest_samples, fmt='%1.2f')		
-        file_name = self.path+'/predictions/rmse_test_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, rmse_test, fmt='%1.2f')		
-        file_name = self.path+'/predictions/rmse_train_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, rmse_train, fmt='%1.2f')
-
-
-        file_name = self.path+'/predictions/acc_test_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, acc_test, fmt='%1.2f')		
-        file_name = self.path+'/predictions/acc_train_chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name, acc_train, fmt='%1.2f')
- 
- 
-
-        file_name = self.path+'/posterior/pos_likelihood/chain_'+ str(self.temperature)+ '.txt'
-        np.savetxt(file_name,likeh_list, fmt='%1.4f')  
+        recorder.close(samples)
+        summary.save(self.path, self.temperature)
 
         file_name = self.path + '/posterior/accept_list/chain_' + str(self.temperature) + '_accept.txt'
         np.savetxt(file_name, [accept_ratio], fmt='%1.4f')
+        channel.close()
 
-        file_name = self.path + '/posterior/accept_list/chain_' + str(self.temperature) + '.txt'
-        np.savetxt(file_name, accept_list, fmt='%1.4f')
 
  
 
 
+class MappedArray:
+    """A memory-mapped dataset of load_problem sent to a ReplicaPool worker as its file instead of its rows."""
+
+    def __init__(self, array):
+        self.filename = array.filename
+        self.offset = array.offset
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+
+    @staticmethod
+    def of(array):
+        # only a whole mapping, the offset of a view is the one of the array it was taken from
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+            return MappedArray(array)
+        return array
+
+    def key(self):
+        return (self.filename, self.offset, self.shape, self.dtype.str, self.order)
+
+    def open(self):
+        return np.memmap(self.filename, self.dtype, 'r', self.offset, self.shape, self.order)
+
+
+def pool_worker(index, jobs, done, parameter_queue, wait_chain, event, stop, board):
+    mapped = {} # datasets of earlier runs stay mapped
+    cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+    limits = blas_limits()
+    for args, kwargs in iter(jobs.get, None):
+        for i, arg in enumerate(args):
+            if isinstance(arg, MappedArray):
+                if arg.key() not in mapped:
+                    mapped[arg.key()] = arg.open()
+                args[i] = mapped[arg.key()]
+        kwargs['board'] = board if kwargs['board'] else None
+        if kwargs['layout'] is None: # an earlier run with a layout may have pinned it and limited its pools
+            if cpus is not None:
+                os.sched_setaffinity(0, cpus)
+            restore_blas_limits(limits)
+        error = None
+        try:
+            ptReplica(*args, parameter_queue, wait_chain, event, chain_index=index, stop=stop, **kwargs).run()
+        except Exception:
+            error = traceback.format_exc()
+            wait_chain.set() # as for a dead replica process
+        parameter_queue.put('replica') # behind the last state it sent, see ReplicaPool.finish
+        done.put((index, error))
+
+
+def set_start_method(method, preload=('numpy', 'pt_core', 'pt_posterior', 'pt_diagnostics', 'pt_classification_dropout')):
+    """Start method of the replica processes: fork (the default on Linux), forkserver or spawn.
+
+    The forkserver imports preload once, replicas are forked from it with the sampler modules
+    loaded. Nothing of the sampler imports matplotlib, run_problem loads it for the plots only.
+    """
+    if method == 'forkserver':
+        multiprocessing.set_forkserver_preload(list(preload))
+    multiprocessing.set_start_method(method, force=True)
+
+
+def pyplot():
+    import matplotlib as mpl
+    mpl.use('agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+class ReplicaPool:
+    """Replica processes kept alive across the runs of ParallelTempering, see run_problem.
+
+    Worker i runs chain i of every run. Its queue and events are created with the pool and
+    inherited when it is forked, since they cannot be sent to a running process. Workers keep
+    their imports and the datasets of load_problem, which are sent as the file they map.
+    """
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.parameter_queue = [multiprocessing.Queue() for i in range(num_workers)]
+        self.wait_chain = [multiprocessing.Event() for i in range(num_workers)]
+        self.event = [multiprocessing.Event() for i in range(num_workers)]
+        self.stop = multiprocessing.Event()
+        self.board = status_board(num_workers)
+        self.jobs = [multiprocessing.Queue() for i in range(num_workers)]
+        self.done = multiprocessing.Queue()
+        self.running = set()
+        self.used = set()
+        self.errors = {} # traceback of the failed replica of every chain
+        self.workers = []
+        for i in range(num_workers):
+            worker = multiprocessing.Process(target=pool_worker, args=(i, self.jobs[i], self.done, self.parameter_queue[i], self.wait_chain[i], self.event[i], self.stop, self.board), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, index, args, kwargs):
+        # the arguments of ptReplica after the channels the worker owns
+        args = [MappedArray.of(arg) for arg in args]
+        self.jobs[index].put((args, dict(kwargs, board=kwargs.get('board') is not None)))
+        self.running.add(index)
+        self.used.add(index)
+
+    def collect(self):
+        while not self.done.empty():
+            index, error = self.done.get()
+            self.running.discard(index)
+            if error is not None:
+                self.errors[index] = error
+
+    def is_alive(self, index):
+        self.collect()
+        return index in self.running and self.workers[index].is_alive()
+
+    def error(self, index):
+        """Traceback of the replica of chain index once its worker reported it, None if it did not fail."""
+        while self.is_alive(index):
+            time.sleep(0.01)
+        return self.errors.pop(index, None)
+
+    def finish(self):
+        """Wait for the chains of the run and empty their queues for the next one."""
+        while self.running:
+            if not any(self.workers[index].is_alive() for index in self.running):
+                raise RuntimeError('replica pool workers died: {}'.format(sorted(self.running)))
+            self.collect()
+            time.sleep(0.01)
+        # states no chain read back are left in the queues, behind them the worker and the main process each put a marker
+        for index in self.used:
+            self.parameter_queue[index].put('main')
+            markers = set()
+            while len(markers) < 2:
+                item = self.parameter_queue[index].get()
+                if isinstance(item, str):
+                    markers.add(item)
+        self.used = set()
+        errors, self.errors = self.errors, {}
+        if errors:
+            raise RuntimeError('replica failed:\n' + '\n'.join(errors.values()))
+
+    def close(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
 class ParallelTempering:
 
-    def __init__(self,  use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path):
+    def __init__(self,  use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path, precision=np.float64, dropout_rates=None, kernel=None, memory_budget=256 * 2**20, recording=None, monitor=None, pool=None, threads=None, pin=False, shards=1, transport=None, verbose=False, status_every=30):
         #FNN Chain variables
         self.traindata = traindata
         self.testdata = testdata
         self.topology = topology
-        self.num_param = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
+        self.num_param = num_parameters(topology)
         #Parallel Tempering variables
         self.swap_interval = swap_interval
         self.path = path
@@ -610,10 +532,24 @@ class ParallelTempering:
         self.NumSamples = int(NumSample/self.num_chains)
         self.sub_sample_size = max(1, int( 0.05* self.NumSamples))
         # create queues for transfer of parameters between process chain
-        self.parameter_queue = [multiprocessing.Queue() for i in range(num_chains)]
+        self.pool = pool # ReplicaPool running the chains, None starts a process per chain
+        if pool is None:
+            self.parameter_queue = [multiprocessing.Queue() for i in range(num_chains)]
+            self.wait_chain = [multiprocessing.Event() for i in range (self.num_chains)]
+            self.event = [multiprocessing.Event() for i in range (self.num_chains)]
+            self.stop = multiprocessing.Event()
+        else:
+            if pool.num_workers < num_chains:
+                raise ValueError('{} chains for a pool of {} workers'.format(num_chains, pool.num_workers))
+            self.parameter_queue = pool.parameter_queue[:num_chains]
+            self.wait_chain = pool.wait_chain[:num_chains]
+            self.event = pool.event[:num_chains]
+            self.stop = pool.stop
+            self.stop.clear()
         self.chain_queue = multiprocessing.JoinableQueue()	
-        self.wait_chain = [multiprocessing.Event() for i in range (self.num_chains)]
-        self.event = [multiprocessing.Event() for i in range (self.num_chains)]
+        self.transport = transport # SocketTransport of replicas joined from elsewhere, None for the queues above
+        if transport is not None and pool is not None:
+            raise ValueError('a run with a transport has no pool')
      
         self.all_param = None
         self.geometric = True # True (geometric)  False (Linear)
@@ -630,8 +566,22 @@ class ParallelTempering:
         self.input_dropout = input_dropout
         self.hidden_dropout = hidden_dropout
         self.dropout_type = dropout_type
+        self.dropout_rates = dropout_rates
+        self.kernel = CategoricalKernel() if kernel is None else kernel
 
         self.use_langevin_gradients = use_langevin_gradients
+        self.precision = np.dtype(precision) # np.float32 runs forward, likelihood and gradient in single precision
+        self.memory_budget = memory_budget # bytes per chunk when post-processing predictions
+        self.recording = RecordingPolicy() if recording is None else recording # traces kept by the replicas, from burn-in on by default
+        self.monitor = monitor # ConvergenceMonitor that can stop the run early, None runs all samples
+        # cores, likelihood shards and BLAS threads of the replicas out of a budget of threads cores,
+        # None leaves the replicas their inherited threads and CPUs
+        self.layout = None
+        if threads is not None or pin or shards > 1:
+            self.layout = ReplicaLayout(num_chains, threads, pin, shards=shards)
+        self.verbose = verbose # prints every accepted proposal and swap
+        self.status_every = status_every # seconds between lines of the status of the replicas, None for none
+        self.status = None
 
     def default_beta_ladder(self, ndim, ntemps, Tmax): #https://github.com/konqr/ptemcee/blob/master/ptemcee/sampler.py
         """
@@ -745,17 +695,28 @@ class ParallelTempering:
 
 
     def initialize_chains(self,  burn_in):
+        # burn_in is a fraction of the samples or 'auto' for the MSER burn-in of the monitor
         self.burn_in = burn_in
+        if burn_in == 'auto' and self.monitor is None:
+            self.monitor = ConvergenceMonitor(stop=False)
+        board = None if self.monitor is None else self.monitor.attach(self.num_chains, None if self.pool is None else self.pool.board, self.path)
         self.assign_temperatures()
         self.minlim_param = np.repeat([-100] , self.num_param)  # priors for nn weights
         self.maxlim_param = np.repeat([100] , self.num_param)
  
 
         
+        recording = self.recording.resolve(0 if self.monitor is not None else int(self.NumSamples*self.burn_in))
+        self.replica_args = []
         for i in range(0, self.num_chains):
 
             w = np.random.randn(self.num_param)
-            self.chains.append(ptReplica( self.use_langevin_gradients, self.learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, w, self.minlim_param, self.maxlim_param, self.NumSamples,self.traindata,self.testdata,self.topology,self.burn_in,self.temperatures[i],self.swap_interval,self.path,self.parameter_queue[i],self.wait_chain[i],self.event[i]))
+            # the channels go between, a pool worker passes its own
+            args = [self.use_langevin_gradients, self.learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, w, self.minlim_param, self.maxlim_param, self.NumSamples,self.traindata,self.testdata,self.topology,self.burn_in,self.temperatures[i],self.swap_interval,self.path]
+            kernel = self.kernel if self.layout is None or self.layout.shards == 1 else ShardedKernel(self.kernel, self.layout.shards)
+            kwargs = dict(precision=self.precision, dropout_rates=self.dropout_rates, kernel=kernel, recording=recording, board=board, layout=self.layout, verbose=self.verbose)
+            self.replica_args.append((args, kwargs))
+            self.chains.append(ptReplica(*args, self.parameter_queue[i], self.wait_chain[i], self.event[i], chain_index=i, stop=self.stop, **kwargs))
 
     def surr_procedure(self,queue):
 
@@ -764,40 +725,28 @@ class ParallelTempering:
         else:
             return
     
-    def swap_procedure(self, parameter_queue_1, parameter_queue_2):
-        # if parameter_queue_2.empty() is False and parameter_queue_1.empty() is False:
-            param1 = parameter_queue_1.get()
-            param2 = parameter_queue_2.get()
-            w1 = param1[0:self.num_param]
-            eta1 = param1[self.num_param]
-            lhood1 = param1[self.num_param+1]
-            T1 = param1[self.num_param+2]
-            w2 = param2[0:self.num_param]
-            eta2 = param2[self.num_param]
-            lhood2 = param2[self.num_param+1]
-            T2 = param2[self.num_param+2]
-            #print('yo')
+    def swap_order(self, lhood):
+        """Chain whose state each chain continues from, after a swap proposal between every neighbour pair in turn."""
+        order = list(range(self.num_chains))
+        for index in range(0, self.num_chains-1):
+            if self.verbose:
+                print('starting swap')
+            lhood1 = lhood[order[index]]
+            lhood2 = lhood[order[index+1]]
             #SWAPPING PROBABILITIES
             try:
                 swap_proposal =  min(1,0.5*np.exp(min(709, lhood2 - lhood1)))
             except OverflowError:
                 swap_proposal = 1
             u = np.random.uniform(0,1)
-            swapped = False
+            self.total_swap_proposals += 1
             if u < swap_proposal: 
-                self.total_swap_proposals += 1
                 self.num_swap += 1
-                param_temp =  param1
-                param1 = param2
-                param2 = param_temp
-                swapped = True
-            else:
-                swapped = False
-                self.total_swap_proposals += 1
-            return param1, param2,swapped
+                order[index], order[index+1] = order[index+1], order[index]
+        return order
  
  
-    def run_chains(self): 
+    def run_chains(self, post_process=True): 
         # only adjacent chains can be swapped therefore, the number of proposals is ONE less num_chains
         swap_proposal = np.ones(self.num_chains-1) 
         # create parameter holders for paramaters that will be swapped
@@ -812,59 +761,75 @@ class ParallelTempering:
         for l in range(0,self.num_chains):
             self.chains[l].start_chain = start
             self.chains[l].end = end
-        for j in range(0,self.num_chains):        
-            self.wait_chain[j].clear()
-            self.event[j].clear()
-            self.chains[j].start()
+        self.status = create_status(self.path, self.num_chains) # before the replicas open it
+        launched = time.time()
+        if self.transport is not None:
+            self.transport.start(self.replica_args, None if self.monitor is None else self.monitor.board, self.status)
+        else:
+            # the thread variables of the layout for replicas that import numpy again
+            with contextlib.nullcontext() if self.layout is None else self.layout.exported():
+                for j in range(0,self.num_chains):        
+                    self.wait_chain[j].clear()
+                    self.event[j].clear()
+                    if self.pool is None:
+                        self.chains[j].launched = launched
+                        self.chains[j].start()
+                    else:
+                        args, kwargs = self.replica_args[j]
+                        self.pool.submit(j, args, dict(kwargs, launched=launched))
         #SWAP PROCEDURE
 
-        swaps_appected_main =0
-        total_swaps_main =0
+        transport = self.transport
+        if transport is None:
+            transport = QueueTransport(self.parameter_queue, self.wait_chain, self.event, self.chain_alive, self.num_param, self.verbose,
+                                       self.stop, None if self.pool is None else self.pool.error)
+        logged = time.time()
         for i in range(int(self.NumSamples/self.swap_interval)):
-            count = 0
-            for index in range(self.num_chains):
-                if not self.chains[index].is_alive():
-                    count+=1
-                    self.wait_chain[index].set()
-                    print(str(self.chains[index].temperature) +" Dead")
-
-            if count == self.num_chains:
+            try:
+                lhood = transport.gather()
+            except RuntimeError:
+                if self.pool is not None:
+                    self.pool.finish() # the stopped replicas end and their queues are emptied for the next run
+                raise
+            if lhood is None:
                 break
-            print("Waiting")
-            timeout_count = 0
-            for index in range(0,self.num_chains):
-                print("Waiting for chain: {}".format(index+1))
-                flag = self.wait_chain[index].wait()
-                if flag:
-                    print("Signal from chain: {}".format(index+1))
-                    timeout_count += 1
-
-            if timeout_count != self.num_chains:
-                print("Skipping the swap!")
-                continue
-            print("Event occured")
-            for index in range(0,self.num_chains-1):
-                print('starting swap')
-                param_1, param_2, swapped = self.swap_procedure(self.parameter_queue[index],self.parameter_queue[index+1])
-                self.parameter_queue[index].put(param_1)
-                self.parameter_queue[index+1].put(param_2)
-                if index == 0:
-                    if swapped:
-                        swaps_appected_main += 1
-                    total_swaps_main += 1
-            for index in range (self.num_chains):
-                    self.event[index].set()
-                    self.wait_chain[index].clear()
+            if self.status_every is not None and time.time() - logged >= self.status_every:
+                print(status_line(self.status))
+                logged = time.time()
+            if self.stop.is_set():
+                # the replicas sent their last state after the stop signal
+                break
+            if self.monitor is not None and self.monitor.update():
+                print("Converged", self.monitor.summary())
+                self.stop.set()
+            if self.verbose:
+                print("Event occured")
+            transport.scatter(self.swap_order(lhood), self.stop.is_set())
 
         print("Joining processes")
 
         #JOIN THEM TO MAIN PROCESS
-        for index in range(0,self.num_chains):
-            self.chains[index].join()
+        transport.finish()
+        if self.pool is not None:
+            self.pool.finish()
+        elif self.transport is None:
+            for index in range(0,self.num_chains):
+                self.chains[index].join()
         self.chain_queue.join()
+        print(status_line(self.status))
+        self.startup = self.startup_times()
+        if self.layout is not None:
+            self.layout.limited = bool(self.startup[:, 2].all())
+            self.layout.save(self.path + '/layout.json')
+        print('replica startup {:.3f} s mean {:.3f} s max, first proposal {:.3f} s max ({})'.format(self.startup[:, 0].mean(), self.startup[:, 0].max(), self.startup[:, 1].max(), multiprocessing.get_start_method()))
          
-
-        pos_w, fx_train, fx_test,   rmse_train, rmse_test, acc_train, acc_test,  likelihood_vec ,   accept_vec, accept  = self.show_results()
+        # merged streaming summaries of the replicas, show_results reads the traces back only if needed
+        self.summary = load_summary(self.path, self.temperatures, None if self.monitor is None else self.burn_in_iteration())
+        if post_process:
+            pos_w, fx_train, fx_test,   rmse_train, rmse_test, acc_train, acc_test,  likelihood_vec ,   accept_vec, accept  = self.show_results()
+        else:
+            pos_w = fx_train = fx_test = rmse_train = rmse_test = acc_train = acc_test = likelihood_vec = accept_vec = None
+            accept = self.acceptance()
 
  
 
@@ -876,452 +841,412 @@ class ParallelTempering:
 
 
 
-    def show_results(self):
-
-        burnin = int(self.NumSamples*self.burn_in)
-
+    def chain_alive(self, index):
+        return self.chains[index].is_alive() if self.pool is None else self.pool.is_alive(index)
 
-        mcmc_samples = int(self.NumSamples*0.25)
- 
-        likelihood_rep = np.zeros((self.num_chains, self.NumSamples - burnin, 2)) # index 1 for likelihood posterior and index 0 for Likelihood proposals. Note all likilihood proposals plotted only
+    def acceptance(self):
+        # acceptance percentage of every chain over all its samples, written by the replica whatever the policy
         accept_percent = np.zeros((self.num_chains, 1))
-        accept_list = np.zeros((self.num_chains, self.NumSamples )) 
- 
-        pos_w = np.zeros((self.num_chains,self.NumSamples - burnin, self.num_param)) 
-
-        fx_train_all  = np.zeros((self.num_chains,self.NumSamples - burnin, self.traindata.shape[0]))
-        rmse_train = np.zeros((self.num_chains,self.NumSamples - burnin))
-        acc_train = np.zeros((self.num_chains,self.NumSamples - burnin))
-        fx_test_all  = np.zeros((self.num_chains,self.NumSamples - burnin, self.testdata.shape[0]))
-        rmse_test = np.zeros((self.num_chains,self.NumSamples - burnin))
-        acc_test = np.zeros((self.num_chains,self.NumSamples - burnin))
- 
-        
-         
         for i in range(self.num_chains):
-            file_name = self.path+'/posterior/pos_w/'+'chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            pos_w[i,:,:] = dat[burnin:,:]  
-
-            file_name = self.path + '/posterior/pos_likelihood/'+'chain_' + str(self.temperatures[i]) + '.txt'
-            dat = np.loadtxt(file_name) 
-            likelihood_rep[i, :] = dat[burnin:]
- 
-
-            file_name = self.path + '/posterior/accept_list/' + 'chain_'  + str(self.temperatures[i]) + '.txt'
-            dat = np.loadtxt(file_name) 
-            accept_list[i, :] = dat 
- 
- 
-            #file_name = self.path+'/predictions/fxtrain_samples_chain_'+ str(self.temperatures[i])+ '.txt'
-            #dat = np.loadtxt(file_name)
-            #fx_train_all[i,:,:] = dat[burnin:,:]
-
-            #file_name = self.path+'/predictions/fxtest_samples_chain_'+ str(self.temperatures[i])+ '.txt'
-            #dat = np.loadtxt(file_name)
-            #fx_test_all[i,:,:] = dat[burnin:,:]	
-
-            file_name = self.path+'/predictions/rmse_test_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            rmse_test[i,:] = dat[burnin:]	
-
-            file_name = self.path+'/predictions/rmse_train_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            rmse_train[i,:] = dat[burnin:]
-
-            file_name = self.path+'/predictions/acc_test_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            acc_test[i,:] = dat[burnin:]	
-
-            file_name = self.path+'/predictions/acc_train_chain_'+ str(self.temperatures[i])+ '.txt'
-            dat = np.loadtxt(file_name)
-            acc_train[i,:] = dat[burnin:]
-
-        chain1_rmsetest= rmse_test[0,:]  # to get posterior of chain 0 only (PT chain with temp 1)
-        chain1_rmsetrain= rmse_train[0,:]
-
-        chain1_acctest= acc_test[0,:]  
-        chain1_acctrain= acc_train[0,:] 
-
-        posterior = pos_w.transpose(2,0,1).reshape(self.num_param,-1)  
-
-        fx_train = fx_train_all.transpose(2,0,1).reshape(self.traindata.shape[0],-1)  # need to comment this if need to save memory 
-        fx_test = fx_test_all.transpose(2,0,1).reshape(self.testdata.shape[0],-1) 
-
-        #fx_test = fxtest_samples.reshape(self.num_chains*(self.NumSamples - burnin), self.testdata.shape[0]) # konarks version
- 
-
-        likelihood_vec = likelihood_rep.transpose(2,0,1).reshape(2,-1)  
+            accept_percent[i] = np.loadtxt(self.path + '/posterior/accept_list/chain_' + str(self.temperatures[i]) + '_accept.txt')
+        return np.sum(accept_percent)/self.num_chains 
 
+    def startup_times(self):
+        # seconds to run() and to the first proposal of every chain, and whether its BLAS threads were limited
+        return np.array([np.loadtxt(self.path + '/posterior/startup_chain_' + str(T) + '.txt') for T in self.temperatures]).reshape(-1, 3)
 
-        '''rmse_train = rmse_train[  : , 0: mcmc_samples]
-        rmse_test = rmse_test[  : , 0: mcmc_samples]
+    def burn_in_iteration(self):
+        if self.burn_in != 'auto' and self.monitor is not None: # of the samples drawn, fewer when stopped early
+            return int((self.status[:, 1].min() + 1)*self.burn_in)
+        if self.burn_in != 'auto':
+            return int(self.NumSamples*self.burn_in)
+        detected = self.monitor.burn_in()
+        return int(self.NumSamples*0.5) if detected is None else detected # too few batches for MSER
 
-        acc_train = rmse_train[  : , 0: mcmc_samples]
-        acc_test = rmse_test[  : , 0: mcmc_samples] '''
+    def show_results(self):
 
-        rmse_train = rmse_train.reshape(self.num_chains*(self.NumSamples - burnin), 1)
-        acc_train = acc_train.reshape(self.num_chains*(self.NumSamples - burnin), 1)
-        rmse_test = rmse_test.reshape(self.num_chains*(self.NumSamples - burnin), 1)
-        acc_test = acc_test.reshape(self.num_chains*(self.NumSamples - burnin), 1) 
+        burnin = self.burn_in_iteration()
 
-        '''rmse_train = rmse_train.reshape(self.num_chains*(mcmc_samples), 1)
-        acc_train = acc_train.reshape(self.num_chains*(mcmc_samples), 1)
-        rmse_test = rmse_test.reshape(self.num_chains*(mcmc_samples), 1)
-        acc_test = acc_test.reshape(self.num_chains*(mcmc_samples), 1) 
+        # every chain stays in its memory-mapped .npy file, the results are views over them and
+        # summaries are computed chunk by chunk, so memory does not grow with NumSamples.
+        # Traces the recording policy did not keep come back as None
+        traces = load_traces(self.path, [chain.recording for chain in self.chains], self.temperatures, burnin, self.memory_budget)
+        pos_w = traces['pos_w'] # (num_chains, samples, num_param)
+        likelihood_rep = traces['likelihood'] # index 1 for likelihood posterior and index 0 for Likelihood proposals. Note all likilihood proposals plotted only
+        accept_list = traces['accept']
 
-        rmse_train = np.append(rmse_train, chain1_rmsetrain)
-        rmse_test = np.append(rmse_test, chain1_rmsetest)  
-        acc_train = np.append(acc_train, chain1_acctrain)
-        acc_test = np.append(acc_test, chain1_acctest) '''
+        rmse_train = traces['rmse_train']
+        rmse_test = traces['rmse_test']
+        acc_train = traces['acc_train']
+        acc_test = traces['acc_test']
 
+        # predictions are read from the stored predictions or generated from pos_w only when used, chunk by chunk
+        fx_train_all = fx_test_all = None
+        if pos_w is not None:
+            fnn = Network(self.topology, self.traindata, self.testdata, self.learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, dtype=self.precision, dropout_rates=self.dropout_rates, kernel=self.kernel)
+            fx_train_all = PosteriorPredictions(pos_w, fnn, self.traindata, traces['fx_train'], self.memory_budget)
+            fx_test_all = PosteriorPredictions(pos_w, fnn, self.testdata, traces['fx_test'], self.memory_budget)
 
         accept_vec  = accept_list  
 
-        accept = np.sum(accept_percent)/self.num_chains 
+        accept = self.acceptance()
 
-        #np.savetxt(self.path + '/pos_param.txt', posterior.T)  # tcoment to save space
-        
-        np.savetxt(self.path + '/likelihood.txt', likelihood_vec.T, fmt='%1.5f')
+        if likelihood_rep is not None:
+            likelihood_rep.savetxt(self.path + '/likelihood.txt', fmt='%1.5f')
 
-        np.savetxt(self.path + '/accept_list.txt', accept_list, fmt='%1.2f')
+        if accept_list is not None:
+            with open(self.path + '/accept_list.txt', 'w') as f:
+                for chain in accept_list.chains:
+                    np.savetxt(f, chain[np.newaxis], fmt='%1.2f')
   
         np.savetxt(self.path + '/acceptpercent.txt', [accept], fmt='%1.2f')
+
+        # temperature and number of post burn-in rows of every chain in the trace files and likelihood.txt
+        recorded = next((trace for trace in traces.values() if trace is not None), None)
+        recorded = [] if recorded is None else np.column_stack([recorded.temperatures, recorded.lengths])
+        np.savetxt(self.path + '/recorded_chains.txt', np.reshape(recorded, (-1, 2)), fmt=['%1.4f', '%d'])
+
+        if self.monitor is not None:
+            self.monitor.save(self.path + '/diagnostics.txt')
  
 
-        return posterior, fx_train_all, fx_test_all,   rmse_train, rmse_test,  acc_train, acc_test,  likelihood_vec.T, accept_vec , accept
+        return pos_w, fx_train_all, fx_test_all,   rmse_train, rmse_test,  acc_train, acc_test,  likelihood_rep, accept_vec , accept
 
     def make_directory (self, directory): 
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-def main():
-
-    for i in range(1,9):
-
+def new_run_folder(folder, name):
+    # first free folder/name_<n>, created atomically so that concurrent runs get different ones
+    run_nb = 0
+    while True:
+        try:
+            os.makedirs(folder + name + '_%s' % (run_nb))
+            return folder + name + '_%s' % (run_nb), run_nb
+        except FileExistsError:
+            run_nb += 1
 
-        problem = i
-        separate_flag = False
-        print(problem, ' problem')
-
-        #DATA PREPROCESSING 
-        if problem == 1: #Wine Quality White
-            data  = np.genfromtxt('DATA/winequality-red.csv',delimiter=';')
-            data = data[1:,:] #remove Labels
-            classes = data[:,11].reshape(data.shape[0],1)
-            features = data[:,0:11]
-            separate_flag = True
-            name = "winequality-red"
-            hidden = 50
-            ip = 11 #input
-            output = 10
-            NumSample = 50000 
-        if problem == 3: #IRIS
-            data  = np.genfromtxt('DATA/iris.csv',delimiter=';')
-            classes = data[:,4].reshape(data.shape[0],1)-1
-            features = data[:,0:4]
- 
-            separate_flag = True
-            name = "iris"
-            hidden = 12
-            ip = 4 #input
-            output = 3
-            NumSample = 50000 
-        if problem == 2: #Wine Quality White
-            data  = np.genfromtxt('DATA/winequality-white.csv',delimiter=';')
-            data = data[1:,:] #remove Labels
-            classes = data[:,11].reshape(data.shape[0],1)
-            features = data[:,0:11]
-            separate_flag = True
-            name = "winequality-white"
-            hidden = 50
-            ip = 11 #input
-            output = 10
-            NumSample = 50000 
-        if problem == 4: #Ionosphere
-            traindata = np.genfromtxt('DATA/Ions/Ions/ftrain.csv',delimiter=',')[:,:-1]
-            testdata = np.genfromtxt('DATA/Ions/Ions/ftest.csv',delimiter=',')[:,:-1]
-            name = "Ionosphere"
-            hidden = 50
-            ip = 34 #input
-            output = 2
-            NumSample =50000 
-        if problem == 5: #Cancer
-            traindata = np.genfromtxt('DATA/Cancer/ftrain.txt',delimiter=' ')[:,:-1]
-            testdata = np.genfromtxt('DATA/Cancer/ftest.txt',delimiter=' ')[:,:-1]
-            name = "Cancer"
-            hidden = 12
-            ip = 9 #input
-            output = 2
-            NumSample =50000
-    
-        if problem == 6: #Bank additional
-            data = np.genfromtxt('DATA/Bank/bank-processed.csv',delimiter=';')
-            classes = data[:,20].reshape(data.shape[0],1)
-            features = data[:,0:20]
-            separate_flag = True
-            name = "bank-additional"
-            hidden = 50
-            ip = 20 #input
-            output = 2
-            NumSample = 50000 
-        if problem == 7: #PenDigit
-            traindata = np.genfromtxt('DATA/PenDigit/train.csv',delimiter=',')
-            testdata = np.genfromtxt('DATA/PenDigit/test.csv',delimiter=',')
-            name = "PenDigit"
-            for k in range(16):
-                mean_train = np.mean(traindata[:,k])
-                dev_train = np.std(traindata[:,k]) 
-                traindata[:,k] = (traindata[:,k]-mean_train)/dev_train
-                mean_test = np.mean(testdata[:,k])
-                dev_test = np.std(testdata[:,k]) 
-                testdata[:,k] = (testdata[:,k]-mean_test)/dev_test
-            ip = 16
-            hidden = 30
-            output = 10
-
-            NumSample = 50000 
-        if problem == 8: #Chess
-            data  = np.genfromtxt('DATA/chess.csv',delimiter=';')
-            classes = data[:,6].reshape(data.shape[0],1)
-            features = data[:,0:6]
-            separate_flag = True
-            name = "chess"
-            hidden = 25
-            ip = 6 #input
-            output = 18
-
-            NumSample = 50000
-
-
-            # Rohits set of problems - processed data
+def append_line(file_name, line):
+    # appended in one write under an exclusive lock, lines of concurrent runs never interleave
+    with open(file_name, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def layout_fields(layout):
+    # columns of the results store, a run without a layout kept the threads and CPUs it inherited
+    if layout is None:
+        return {'threads': None, 'blas_threads': None, 'pin': False, 'core_sets': None, 'shards': 1}
+    # blas_threads only when the replicas could limit their pools to it
+    return {'threads': layout.threads, 'blas_threads': layout.blas_threads if layout.limited else None, 'blas_limited': layout.limited,
+            'pin': layout.pin, 'core_sets': layout.core_sets, 'shards': layout.shards}
+
+def run_problem(problem, dropout_type=DropoutType.DROP_CONNECT, input_dropout=0.1, hidden_dropout=0.1, learn_rate=0.1, maxtemp=2, swap_ratio=0.01, num_chains=10, num_samples=None, seed=None, folder=None, store='fix_likeh/results.db', pool=None, threads=None, pin=False, shards=1, exchange=None, verbose=False, burn_in=0.5, early_stopping=False, split_seed=0):
+    """ One parallel tempering run of problem 1-8 of main(), its results added to the results store.
+
+    learn_rate is used with the langevin gradients, we found a small value is ok. num_samples
+    overrides the NumSample of the problem and folder the fix_likeh/<dropout type>/ results folder.
+    store is the SQLite file of pt_results.py shared by the runs. With a ReplicaPool of at least
+    num_chains workers the chains run in its processes instead of new ones. threads is the core
+    budget of the replicas' BLAS threads, all CPUs when pin or shards is given, and pin binds
+    each to its cores. Without any of them the replicas keep the threads and CPUs they inherit.
+    shards splits the likelihood of each replica over that many threads where its cores allow.
+    exchange is a host:port or Unix socket path the replicas join with pt_exchange.py instead of
+    being started here. verbose prints every accepted proposal and swap, the status of the
+    replicas is logged every 30 s and shown by pt_status.py. burn_in is the fraction of the samples
+    dropped, or 'auto' for the MSER burn-in of a convergence monitor. early_stopping ends the run
+    once the ConvergenceMonitor finds it converged, otherwise every sample is drawn. The stored
+    burn_in is the iteration the summary of the results starts at. With a monitor that is the
+    first summary segment after the burn-in, the fraction of the samples drawn or the MSER burn-in
+    the traces are cut at, which goes to mser_burn_in. seed seeds the sampler and split_seed the
+    train and test split, the same split for every run by default.
+    Returns the result row, the run name and the results folder of the run.
+    """
+
+    print(problem, ' problem')
+    if seed is not None:
+        np.random.seed(seed)
+        random.seed(seed)
+
+    # parsed, normalised and split once into DATA/cache, see pt_datasets.py
+    if problem == 1: #Wine Quality White
+        name = "winequality-red"
+        hidden = 50
+        ip = 11 #input
+        output = 10
+        NumSample = 50000 
+    if problem == 3: #IRIS
+        name = "iris"
+        hidden = 12
+        ip = 4 #input
+        output = 3
+        NumSample = 50000 
+    if problem == 2: #Wine Quality White
+        name = "winequality-white"
+        hidden = 50
+        ip = 11 #input
+        output = 10
+        NumSample = 50000 
+    if problem == 4: #Ionosphere
+        name = "Ionosphere"
+        hidden = 50
+        ip = 34 #input
+        output = 2
+        NumSample =50000 
+    if problem == 5: #Cancer
+        name = "Cancer"
+        hidden = 12
+        ip = 9 #input
+        output = 2
+        NumSample =50000
+
+    if problem == 6: #Bank additional
+        name = "bank-additional"
+        hidden = 50
+        ip = 20 #input
+        output = 2
+        NumSample = 50000 
+    if problem == 7: #PenDigit
+        name = "PenDigit"
+        ip = 16
+        hidden = 30
+        output = 10
+
+        NumSample = 50000 
+    if problem == 8: #Chess
+        name = "chess"
+        hidden = 25
+        ip = 6 #input
+        output = 18
+
+        NumSample = 50000
+
+
+        # Rohits set of problems - processed data
  
 
 
-        #Separating data to train and test
-        if separate_flag is True:
-            #Normalizing Data
-            for k in range(ip):
-                mean = np.mean(features[:,k])
-                dev = np.std(features[:,k])
-                features[:,k] = (features[:,k]-mean)/dev
-            train_ratio = 0.7 #Choosable
-            indices = np.random.permutation(features.shape[0])
-            traindata = np.hstack([features[indices[:np.int(train_ratio*features.shape[0])],:],classes[indices[:np.int(train_ratio*features.shape[0])],:]])
-            testdata = np.hstack([features[indices[np.int(train_ratio*features.shape[0])]:,:],classes[indices[np.int(train_ratio*features.shape[0])]:,:]])
+    train_ratio = 0.7 #Choosable
+    traindata, testdata = load_problem(problem, split_seed, train_ratio) # memory-mapped, shared by the replicas
  
 
 
 
-        ###############################
-        #THESE ARE THE HYPERPARAMETERS#
-        ###############################
-        topology = [ip, hidden, output]
+    ###############################
+    #THESE ARE THE HYPERPARAMETERS#
+    ###############################
+    topology = [ip, hidden, output]
 
-        netw = topology
+    netw = topology
 
 
 
 
-        y_test =  testdata[:,netw[0]]
-        y_train =  traindata[:,netw[0]]
+    y_test =  testdata[:,netw[0]]
+    y_train =  traindata[:,netw[0]]
 
-        #NumSample = NumSample * 0.4
+    #NumSample = NumSample * 0.4
 
  
 
 
-         
-        maxtemp = 2
- 
-        num_chains = 10
-        swap_ratio = 0.01 #float(sys.argv[1])
-        swap_interval = int(swap_ratio * NumSample/num_chains)    # int(swap_ratio * (NumSample/num_chains)) #how ofen you swap neighbours. note if swap is more than Num_samples, its off
-        burn_in = 0.5
      
-        learn_rate = 0.1  # in case langevin gradients are used. Can select other values, we found small value is ok. 
-        input_dropout = 0.1
-        hidden_dropout = 0.1
-        dropout_type = DropoutType.DROP_CONNECT
+    if num_samples is not None:
+        NumSample = num_samples
+    swap_interval = int(swap_ratio * NumSample/num_chains)    # int(swap_ratio * (NumSample/num_chains)) #how ofen you swap neighbours. note if swap is more than Num_samples, its off
+ 
+    precision = np.float64 # np.float32 halves memory traffic, see pt_benchmark.py precision
 
-        use_langevin_gradients =True # False leaves it as Random-walk proposals. Note that Langevin gradients will take a bit more time computationally
+    use_langevin_gradients =True # False leaves it as Random-walk proposals. Note that Langevin gradients will take a bit more time computationally
 
 
 
 
-        problemfolder = 'fix_likeh/dropconnect/results/'  # change this to your directory for results output - produces large datasets
+    if folder is None:
+        folder = 'fix_likeh/' + dropout_type.name.lower().replace('_', '') + '/'
+    problemfolder = folder + 'results/'  # change this to your directory for results output - produces large datasets
 
-        problemfolder_db = 'fix_likeh/dropconnect/results_db/'  # save main results
+    problemfolder_db = folder + 'results_db/'  # save main results
 
-    
 
 
-        filename = ""
-        run_nb = 0
-        while os.path.exists( problemfolder+name+'_%s' % (run_nb)):
-            run_nb += 1
-        if not os.path.exists( problemfolder+name+'_%s' % (run_nb)):
-            os.makedirs(  problemfolder+name+'_%s' % (run_nb))
-            path = (problemfolder+ name+'_%s' % (run_nb))
 
-        filename = ""
-        run_nb = 0
-        while os.path.exists( problemfolder_db+name+'_%s' % (run_nb)):
-            run_nb += 1
-        if not os.path.exists( problemfolder_db+name+'_%s' % (run_nb)):
-            os.makedirs(  problemfolder_db+name+'_%s' % (run_nb))
-            path_db = (problemfolder_db+ name+'_%s' % (run_nb))
+    filename = ""
+    path, run_nb = new_run_folder(problemfolder, name)
+    path_db, run_nb = new_run_folder(problemfolder_db, name)
 
 
  
   
-        timer = time.time() 
-        
+    timer = time.time() 
     
 
-        pt = ParallelTempering( use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path)
 
-        directories = [  path+'/predictions/', path+'/posterior', path+'/results', path+'/surrogate', path+'/surrogate/learnsurrogate_data', path+'/posterior/pos_w',  path+'/posterior/pos_likelihood',path+'/posterior/surg_likelihood',path+'/posterior/accept_list', path+'/traces']
-    
-        for d in directories:
-            pt.make_directory((filename)+ d)	
+    monitor = ConvergenceMonitor(target_ess=1000, max_rhat=1.05) if early_stopping else None # None always runs NumSample
 
+    pt = ParallelTempering( use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path, precision, monitor=monitor, pool=pool, threads=threads, pin=pin, shards=shards,
+                            transport=None if exchange is None else SocketTransport(exchange, num_chains), verbose=verbose)
 
+    directories = [  path+'/predictions/', path+'/posterior', path+'/results', path+'/surrogate', path+'/surrogate/learnsurrogate_data', path+'/posterior/pos_w',  path+'/posterior/pos_likelihood',path+'/posterior/surg_likelihood',path+'/posterior/accept_list', path+'/traces']
 
-        pt.initialize_chains(  burn_in)
+    for d in directories:
+        pt.make_directory((filename)+ d)	
+
+
+
+    pt.initialize_chains(  burn_in)
   
-        
-        pos_w, fx_train, fx_test,  rmse_train, rmse_test, acc_train, acc_test,   likelihood_rep , swap_perc,    accept_vec, accept = pt.run_chains()
+    
+    pos_w, fx_train, fx_test,  rmse_train, rmse_test, acc_train, acc_test,   likelihood_rep , swap_perc,    accept_vec, accept = pt.run_chains()
 
  
 
-        timer2 = time.time()
+    timer2 = time.time()
 
-        list_end = accept_vec.shape[1] 
-        accept_ratio = accept_vec[:,  list_end-1:list_end]/list_end   
-        accept_per = np.mean(accept_ratio) * 100
+    accept_per = accept # mean acceptance percentage over the chains
 
-        print(accept_per, ' accept_per')
+    print(accept_per, ' accept_per')
 
 
 
-        timetotal = (timer2 - timer) /60
-        print ((timetotal), 'min taken')
+    timetotal = (timer2 - timer) /60
+    print ((timetotal), 'min taken')
 
-        #PLOTS 
+    #PLOTS 
 
-        acc_tr = np.mean(acc_train [:])
-        acctr_std = np.std(acc_train[:]) 
-        acctr_max = np.amax(acc_train[:])
+    # from the streaming summaries of the replicas, the traces are only read for the plots
+    summary = pt.summary
+    acc_tr = summary['acc_train']['mean']
+    acctr_std = summary['acc_train']['std'] 
+    acctr_max = summary['acc_train']['max']
 
-        acc_tes = np.mean(acc_test[:])
-        acctest_std = np.std(acc_test[:]) 
-        acctes_max = np.amax(acc_test[:])
-    
+    acc_tes = summary['acc_test']['mean']
+    acctest_std = summary['acc_test']['std'] 
+    acctes_max = summary['acc_test']['max']
 
 
-        rmse_tr = np.mean(rmse_train[:])
-        rmsetr_std = np.std(rmse_train[:])
-        rmsetr_max = np.amax(acc_train[:])
 
-        rmse_tes = np.mean(rmse_test[:])
-        rmsetest_std = np.std(rmse_test[:])
-        rmsetes_max = np.amax(rmse_test[:])
+    rmse_tr = summary['rmse_train']['mean']
+    rmsetr_std = summary['rmse_train']['std']
+    rmsetr_max = summary['rmse_train']['max']
 
-        outres = open(path+'/result.txt', "a+") 
-        outres_db = open(path_db+'/result.txt', "a+") 
+    rmse_tes = summary['rmse_test']['mean']
+    rmsetest_std = summary['rmse_test']['std']
+    rmsetes_max = summary['rmse_test']['max']
 
-        resultingfile = open(problemfolder+'/master_result_file.txt','a+')  
-        resultingfile_db = open( problemfolder_db+'/master_result_file.txt','a+') 
+    xv = name+'_'+ str(run_nb) 
 
-        xv = name+'_'+ str(run_nb) 
+    print (  acc_tr, acctr_max, acc_tes, acctes_max)  
+    # majority vote of the posterior samples, None when the recording policy did not keep pos_w
+    ensemble_train = None if fx_train is None else fx_train.ensemble_accuracy()
+    ensemble_test = None if fx_test is None else fx_test.ensemble_accuracy()
+    print (ensemble_train, ensemble_test, ' majority vote acc train test')
+    allres =  np.asarray([ problem, NumSample, maxtemp, swap_interval, use_langevin_gradients, learn_rate, acc_tr, acctr_std, acctr_max, acc_tes, acctest_std, acctes_max, swap_perc, accept_per, timetotal]) 
+    row = ''.join('%1.2f ' % value for value in allres)
+     
+    # one locked write per line, runs launched together share the master result files
+    append_line(path_db+'/result.txt', row)
+    append_line(problemfolder_db+'master_result_file.txt', row + xv + ' \n')
+    append_line(path+'/result.txt', row)
+    append_line(problemfolder+'master_result_file.txt', row + xv + ' \n')
 
-        print (  acc_tr, acctr_max, acc_tes, acctes_max)  
-        allres =  np.asarray([ problem, NumSample, maxtemp, swap_interval, use_langevin_gradients, learn_rate, acc_tr, acctr_std, acctr_max, acc_tes, acctest_std, acctes_max, swap_perc, accept_per, timetotal]) 
-         
-        np.savetxt(outres_db,  allres   , fmt='%1.2f', newline=' '  )   
-        np.savetxt(resultingfile_db,   allres   , fmt='%1.2f',  newline=' ' ) 
-        np.savetxt(resultingfile_db, [xv]   ,  fmt="%s", newline=' \n' )  
+    # one transaction per run, runs launched together share the store
+    results = ResultsStore(store)
+    results.add_run(name=xv, path=path, dataset=name, dropout_type=dropout_type, input_dropout=input_dropout, hidden_dropout=hidden_dropout,
+                    swap_ratio=swap_ratio, num_chains=num_chains, burn_in=summary['burn_in'], seed=seed, split_seed=split_seed, precision=np.dtype(precision).name,
+                    rmse_train=rmse_tr, rmse_test=rmse_tes, ensemble_acc_train=ensemble_train, ensemble_acc_test=ensemble_test,
+                    summary_samples=int(summary['samples']), topology=topology, early_stopping=early_stopping,
+                    start_method=multiprocessing.get_start_method(), startup=float(pt.startup[:, 0].max()),
+                    exchange=exchange, **({'mser_burn_in': pt.burn_in_iteration()} if burn_in == 'auto' else {}),
+                    **layout_fields(pt.layout), **dict(zip(RESULT_COLUMNS, allres.tolist())))
+    results.close()
 
+    # the plots need every sample, the chains are only read into memory here
+    acc_train = np.ravel(acc_train)
+    acc_test = np.ravel(acc_test)
+    rmse_train = np.ravel(rmse_train)
+    rmse_test = np.ravel(rmse_test)
+    x = np.linspace(0, acc_train.shape[0] , num=acc_train.shape[0])
+    plt = pyplot()
 
-        np.savetxt(outres,  allres   , fmt='%1.2f', newline=' '  )   
-        np.savetxt(resultingfile,   allres   , fmt='%1.2f',  newline=' ' ) 
-        np.savetxt(resultingfile, [xv]   ,  fmt="%s", newline=' \n' )  
 
-        x = np.linspace(0, acc_train.shape[0] , num=acc_train.shape[0])
+    plt.plot(x, acc_train, '.',   label='Test')
+    plt.plot(x, acc_test,  '.', label='Train') 
+    plt.legend(loc='upper right')
 
+    plt.title("Plot of Classification Acc. over time")
+    plt.savefig(path+'/acc_samples.png') 
+    plt.clf()	
 
+    plt.plot(  acc_train, '.',  label='Test')
+    plt.plot(  acc_test,  '.',  label='Train') 
+    plt.legend(loc='upper right')
 
-        plt.plot(x, acc_train, '.',   label='Test')
-        plt.plot(x, acc_test,  '.', label='Train') 
-        plt.legend(loc='upper right')
+    plt.title("Plot of Classification Acc. over time")
+    plt.savefig(path_db+'/acc_samples.png') 
+    plt.clf()	
 
-        plt.title("Plot of Classification Acc. over time")
-        plt.savefig(path+'/acc_samples.png') 
-        plt.clf()	
+    plt.plot( rmse_train, '.',   label='Test')
+    plt.plot( rmse_test, '.',   label='Train') 
+    plt.legend(loc='upper right')
 
-        plt.plot(  acc_train, '.',  label='Test')
-        plt.plot(  acc_test,  '.',  label='Train') 
-        plt.legend(loc='upper right')
+    plt.title("Plot of EMSE over time")
+    plt.savefig(path+'/rmse_samples.png') 
+    plt.clf()
 
-        plt.title("Plot of Classification Acc. over time")
-        plt.savefig(path_db+'/acc_samples.png') 
-        plt.clf()	
 
-        plt.plot( rmse_train, '.',   label='Test')
-        plt.plot( rmse_test, '.',   label='Train') 
-        plt.legend(loc='upper right')
 
-        plt.title("Plot of EMSE over time")
-        plt.savefig(path+'/rmse_samples.png') 
-        plt.clf()
 
+    likelihood = np.asarray(likelihood_rep[:, :, 0]) # just plot proposed likelihood
 
+    print(accept_per)
 
 
-        likelihood = likelihood_rep[:,0] # just plot proposed likelihood
-        likelihood = np.asarray(np.split(likelihood, num_chains))
+ 
+# Plots
+    plt.plot(likelihood.T)
+    plt.savefig(path+'/likelihood.png')
+    plt.clf()
 
-        print(accept_vec)
+    plt.plot(likelihood.T)
+    plt.savefig(path_db+'/likelihood.png')
+    plt.clf()
 
 
-     
-    # Plots
-        plt.plot(likelihood.T)
-        plt.savefig(path+'/likelihood.png')
-        plt.clf()
+    plt.plot(np.asarray(accept_vec).T )
+    plt.savefig(path_db+'/accept.png')
+    plt.clf()
 
-        plt.plot(likelihood.T)
-        plt.savefig(path_db+'/likelihood.png')
-        plt.clf()
 
+    #mpl_fig = plt.figure()
+    #ax = mpl_fig.add_subplot(111)
 
-        plt.plot(accept_vec.T )
-        plt.savefig(path_db+'/accept.png')
-        plt.clf()
+    # ax.boxplot(pos_w)
 
+    # ax.set_xlabel('[W1] [B1] [W2] [B2]')
+    # ax.set_ylabel('Posterior')
 
-        #mpl_fig = plt.figure()
-        #ax = mpl_fig.add_subplot(111)
+    # plt.legend(loc='upper right')
 
-        # ax.boxplot(pos_w)
+    # plt.title("Boxplot of Posterior W (weights and biases)")
+    # plt.savefig(path+'/w_pos.png')
+    # plt.savefig(path+'/w_pos.svg', format='svg', dpi=600)
 
-        # ax.set_xlabel('[W1] [B1] [W2] [B2]')
-        # ax.set_ylabel('Posterior')
+    # plt.clf()
+    #dir()
+    gc.collect()
+    return allres, xv, path
 
-        # plt.legend(loc='upper right')
+def main():
 
-        # plt.title("Boxplot of Posterior W (weights and biases)")
-        # plt.savefig(path+'/w_pos.png')
-        # plt.savefig(path+'/w_pos.svg', format='svg', dpi=600)
+    pool = ReplicaPool(10) # the replicas of every problem
+    for i in range(1,9):
 
-        # plt.clf()
-        #dir()
-        gc.collect()
-        outres.close() 
-        resultingfile.close()
-        resultingfile_db.close()
-        outres_db.close()
+        run_problem(i, pool=pool)
+    pool.close()
 
 if __name__ == "__main__": main() # nn
 
@@ -23,238 +23,7 @@ from scipy.stats import norm
 
 import io
 
-from enum import Enum
-class DropoutType(Enum):
-    ORIGIN = 1
-    DROP_CONNECT = 2
-    GAUSSIAN_DROPOUT = 3
-
-class Network:
-
-    def __init__(self, Topo, Train, Test, learn_rate, input_dropout, hidden_dropout, dropout_type: DropoutType):
-        self.Top = Topo  # NN topology [input, hidden, output]
-        self.TrainData = Train
-        self.TestData = Test
-        self.lrate = learn_rate
-        self.input_dropout = input_dropout
-        self.hidden_dropout = hidden_dropout
-        self.dropout_type = dropout_type
-        
-        self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-        self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-        self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-        self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
-        self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
-        self.out = np.zeros((1, self.Top[2]))  # output last layer
-        self.pred_class = 0
-
-    def sigmoid(self, x):
-        return 1 / (1 + np.exp(-x))
-
-    def sampleEr(self, actualout):
-        error = np.subtract(self.out, actualout)
-        sqerror = np.sum(np.square(error)) / self.Top[2]
-        return sqerror
-
-    def ForwardPass(self, X, eval=False):
-        if eval:
-            input_dropout = 0
-            hidden_dropout = 0
-        else:
-            input_dropout = self.input_dropout
-            hidden_dropout = self.hidden_dropout
-            
-        if self.dropout_type == DropoutType.ORIGIN:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*z1.shape) > input_dropout).astype(float)
-            z1 = z1 * self.input_dropout_mask / (1.0 - input_dropout) # dropout on z1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-            
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*z2.shape) > hidden_dropout).astype(float)
-            z2 = z2 * self.hidden_dropout_mask / (1.0 - hidden_dropout) # dropout on z2
-            self.out = self.sigmoid(z2)
-        
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(self.W1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*self.W1.shape) > input_dropout).astype(float)
-
-            z1 = X.dot(self.W1 * self.input_dropout_mask / (1.0 - input_dropout)) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(self.W2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*self.W2.shape) > hidden_dropout).astype(float)
-            z2 = self.hidout.dot(self.W2 * self.hidden_dropout_mask / (1.0 - hidden_dropout)) - self.B2
-            self.out = self.sigmoid(z2)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                sigma1 = input_dropout * (1 - input_dropout)
-                self.input_dropout_mask = np.random.normal(1, sigma1, z1.shape)
-            z1  = z1 * self.input_dropout_mask
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                sigma2 = hidden_dropout * (1 - hidden_dropout)
-                self.hidden_dropout_mask = np.random.normal(1, sigma2, z2.shape)
-            z2 = z2 * self.hidden_dropout_mask
-            self.out = self.sigmoid(z2)
-
-        else: # no dropout
-            z1 = X.dot(self.W1) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-            z2 = self.hidout.dot(self.W2) - self.B2
-            self.out = self.sigmoid(z2)  # output second hidden layer
-
-
-        self.pred_class = np.argmax(self.out)
-
-
-        #print(self.pred_class, self.out, '  ---------------- out ')
-
-    '''def BackwardPass(self, Input, desired):
-        out_delta = (desired - self.out).dot(self.out.dot(1 - self.out))
-        hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-        print(self.B2.shape)
-        self.W2 += (self.hidout.T.reshape(self.Top[1],1).dot(out_delta) * self.lrate)
-        self.B2 += (-1 * self.lrate * out_delta)
-        self.W1 += (Input.T.reshape(self.Top[0],1).dot(hid_delta) * self.lrate)
-        self.B1 += (-1 * self.lrate * hid_delta)'''
-
-
- 
-
-    def BackwardPass(self, Input, desired): # since data outputs and number of output neuons have different orgnisation
-        onehot = np.zeros((desired.size, self.Top[2]))
-        onehot[np.arange(desired.size),int(desired)] = 1
-        desired = onehot
-        
-        if self.dropout_type == DropoutType.ORIGIN:
-            out_delta = (desired - self.out)*(self.out*(1 - self.out))
-            hid_delta = np.dot(out_delta,self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += np.dot(self.hidout.T,self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout) * self.lrate)
-            self.B2 += (-1 * self.lrate * self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout))
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += np.dot(Input.T,(self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout) * self.lrate))
-            self.B1 += (-1 * self.lrate * self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout))
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :]) * self.hidden_dropout_mask / (1.0 - self.hidden_dropout)
-            self.B2 += -self.lrate * (out_delta)
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :]) * self.input_dropout_mask / (1.0 - self.input_dropout)
-            self.B1 += -self.lrate * (hid_delta)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot((self.hidden_dropout_mask * out_delta)[np.newaxis, :])
-            self.B2 += -self.lrate * (self.hidden_dropout_mask * out_delta)
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += self.lrate * Input[:, np.newaxis].dot((self.input_dropout_mask * hid_delta)[np.newaxis, :])
-            self.B1 += -self.lrate * (self.input_dropout_mask * hid_delta)
-        else:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :])
-            self.B2 += -self.lrate * out_delta
-            Input = Input.reshape(1,self.Top[0])
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :])
-            self.B1 += -self.lrate * hid_delta
-
-
-    def decode(self, w):
-        w_layer1size = self.Top[0] * self.Top[1]
-        w_layer2size = self.Top[1] * self.Top[2]
-
-        w_layer1 = w[0:w_layer1size]
-        self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-        w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-        self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-        self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]].reshape(1,self.Top[1])
-        self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]].reshape(1,self.Top[2])
-
- 
-
-    def encode(self):
-        w1 = self.W1.ravel()
-        w1 = w1.reshape(1,w1.shape[0])
-        w2 = self.W2.ravel()
-        w2 = w2.reshape(1,w2.shape[0])
-        w = np.concatenate([w1.T, w2.T, self.B1.T, self.B2.T])
-        w = w.reshape(-1)
-        return w
-
-    def softmax(self):
-        prob = np.exp(self.out)/np.sum(np.exp(self.out))
-        return prob
- 
-
-
-    def langevin_gradient(self, data, w, depth):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-
-        for i in range(0, depth):
-            for i in range(0, size):
-                pat = i
-                Input = data[pat, 0:self.Top[0]]
-                Desired = data[pat, self.Top[0]:]
-                self.ForwardPass(Input)
-                self.BackwardPass(Input, Desired)
-        w_updated = self.encode()
-
-        return  w_updated
-
-    def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-        prob = np.zeros((size,self.Top[2]))
-
-        for i in range(0, size):  # to see what fx is produced by your current weight update
-            Input = data[i, 0:self.Top[0]]
-            self.ForwardPass(Input)
-            fx[i] = self.pred_class
-            prob[i] = self.softmax()
-
-        #print(fx, 'fx')
-        #print(prob, 'prob' )
-
-        return fx, prob
- 
-
+from pt_core import DropoutType, Network, CategoricalKernel, num_parameters
 
 class ptReplica(multiprocessing.Process):
 
@@ -293,6 +62,7 @@ class ptReplica(multiprocessing.Process):
         self.input_dropout = input_dropout
         self.hidden_dropout = hidden_dropout
         self.dropout_type = dropout_type
+        self.kernel = CategoricalKernel()
 
         self.l_prob = 0.5  # can be evaluated for diff problems - if data too large keep this low value since the gradients cost comp time
         self.w_size =0
@@ -312,27 +82,12 @@ class ptReplica(multiprocessing.Process):
         return 100*(count/pred.shape[0])
 
     def likelihood_func(self, fnn, data, w):
-        y = data[:, self.topology[0]]
-        fx, prob = fnn.evaluate_proposal(data,w)
-        rmse = self.rmse(fx,y)
-        z = np.zeros((data.shape[0],self.topology[2]))
-        lhood = 0
-        for i in range(data.shape[0]):
-            for j in range(self.topology[2]):
-                if j == y[i]:
-                    z[i,j] = 1
-                lhood += z[i,j]*np.log(prob[i,j])
-  
+        lhood, fx, rmse = self.kernel.log_likelihood(fnn, data, w)
 
         return [lhood/self.adapttemp, fx, rmse]
 
     def prior_likelihood(self, sigma_squared, nu_1, nu_2, w):
-        h = self.topology[1]  # number hidden neurons
-        d = self.topology[0]  # number input neurons
-        part1 = -1 * ((d * h + h + self.topology[2]+h*self.topology[2]) / 2) * np.log(sigma_squared)
-        part2 = 1 / (2 * sigma_squared) * (sum(np.square(w)))
-        log_loss = part1 - part2
-        return log_loss
+        return self.kernel.log_prior(sigma_squared, nu_1, nu_2, w)
 
     def run(self):
         #INITIALISING FOR FNN
@@ -349,7 +104,7 @@ class ptReplica(multiprocessing.Process):
 
 
         
-        w_size = (netw[0] * netw[1]) + (netw[1] * netw[2]) + netw[1] + netw[2]  # num of weights and bias
+        w_size = num_parameters(netw)  # num of weights and bias
         self.w_size = w_size
         pos_w = np.ones((samples, w_size)) #Posterior for all weights
         #pos_w = np.ones((samples, w_size)) #Posterior for all weights
@@ -371,7 +126,7 @@ class ptReplica(multiprocessing.Process):
         #Randomwalk Steps
         step_w = 0.025
         #Declare FNN
-        fnn = Network(self.topology, self.traindata, self.testdata, learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type)
+        fnn = Network(self.topology, self.traindata, self.testdata, learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, kernel=self.kernel, eval_dropout=True) # proposals are evaluated with dropout on
         #Evaluate Proposals
         pred_train, prob_train = fnn.evaluate_proposal(self.traindata,w) #	
         pred_test, prob_test = fnn.evaluate_proposal(self.testdata, w) #
@@ -606,7 +361,7 @@ class ParallelTempering:
         self.traindata = traindata
         self.testdata = testdata
         self.topology = topology
-        self.num_param = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
+        self.num_param = num_parameters(topology)
         #Parallel Tempering variables
         self.swap_interval = swap_interval
         self.path = path
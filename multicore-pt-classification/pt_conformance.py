@@ -0,0 +1,179 @@
+""" Conformance checks of the pt_core kernels against the legacy per-pattern implementations
+
+python pt_conformance.py                      float64 kernels against pt_classification.py and pt_timeseries_regression.py
+python pt_conformance.py --precision float32  same checks with looser tolerances
+
+The likelihood, prior and gradient checks run with dropout off, the legacy networks without dropout are
+the reference. Priors are compared as differences between two weight vectors since the constant term of
+the legacy regression prior counts only part of the weights and cancels in the acceptance ratio.
+The masked checks run the langevin gradient with ORIGIN, DROP_CONNECT (also bit-packed) and GAUSSIAN_DROPOUT
+masks against the per-pattern forward and backward passes of the legacy dropout samplers, which are
+written out here since pt_core replaced them. The reference is given the masks pt_core drew, without
+the 1/(1 - rate) rescaling pt_core folds into them, and rescales them the legacy way.
+"""
+
+from __future__ import print_function, division
+import argparse
+import os
+import sys
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'multicore-pt-regression', 'Code'))
+
+import pt_classification as legacy_classification
+import pt_timeseries_regression as legacy_regression
+from pt_core import DropoutType, Network, CategoricalKernel, GaussianKernel, num_parameters
+
+
+class LegacyReplica:
+    # the attributes the legacy likelihood_func and prior_likelihood read from ptReplica
+    def __init__(self, topology, rmse):
+        self.topology = topology
+        self.adapttemp = 1.0
+        self.rmse = rmse
+
+
+def make_data(rng, size, topology, regression):
+    features = rng.standard_normal((size, topology[0]))
+    if regression:
+        targets = rng.uniform(0, 1, (size, 1))
+    else:
+        targets = rng.integers(0, topology[-1], (size, 1)).astype(float)
+    return np.hstack([features, targets])
+
+
+def check(name, expected, actual, rtol, atol):
+    ok = np.allclose(expected, actual, rtol=rtol, atol=atol)
+    print('{:>40} {:>6} {:12.3e}'.format(name, 'ok' if ok else 'FAIL', np.max(np.abs(np.asarray(expected) - np.asarray(actual)))))
+    return ok
+
+
+def conformance(legacy, kernel, topology, regression, precision, rtol, atol, seed):
+    rng = np.random.default_rng(seed)
+    traindata = make_data(rng, 60, topology, regression)
+    testdata = make_data(rng, 25, topology, regression)
+    w = rng.standard_normal(sum(topology[l] * topology[l + 1] + topology[l + 1] for l in range(2)))
+    w2 = rng.standard_normal(w.size)
+    tau_sq = 0.3
+    name = type(kernel).__name__
+    passed = True
+
+    legacy_net = legacy.Network(topology, traindata, testdata, 0.1)
+    legacy_rep = LegacyReplica(topology, legacy.ptReplica.rmse.__get__(object()))
+    fnn = Network(topology, traindata, testdata, 0.1, 0.0, 0.0, DropoutType.ORIGIN, dtype=precision, kernel=kernel)
+
+    for label, data in (('train', traindata), ('test', testdata)):
+        if regression:
+            expected = legacy.ptReplica.likelihood_func(legacy_rep, legacy_net, data, w, tau_sq)
+        else:
+            expected = legacy.ptReplica.likelihood_func(legacy_rep, legacy_net, data, w)
+        lhood, fx, rmse = kernel.log_likelihood(fnn, data, w, tau_sq)
+        passed &= check('{} {} likelihood'.format(name, label), expected[0], lhood, rtol, atol)
+        passed &= check('{} {} predictions'.format(name, label), expected[1], fx, rtol, atol)
+        passed &= check('{} {} rmse'.format(name, label), expected[2], rmse, rtol, atol)
+
+    if regression:
+        expected = legacy.ptReplica.prior_likelihood(legacy_rep, 25, 0, 0, w, tau_sq) - legacy.ptReplica.prior_likelihood(legacy_rep, 25, 0, 0, w2, tau_sq)
+    else:
+        expected = legacy.ptReplica.prior_likelihood(legacy_rep, 25, 0, 0, w) - legacy.ptReplica.prior_likelihood(legacy_rep, 25, 0, 0, w2)
+    actual = kernel.log_prior(25, 0, 0, w, tau_sq) - kernel.log_prior(25, 0, 0, w2, tau_sq)
+    passed &= check('{} prior difference'.format(name), expected, actual, rtol, atol)
+
+    expected = legacy_net.langevin_gradient(traindata, w.copy(), 1)
+    actual = fnn.langevin_gradient(traindata, w.copy(), 1)
+    passed &= check('{} langevin gradient'.format(name), expected, actual, rtol, atol)
+    return passed
+
+
+def record_masks(fnn):
+    """List of the masks fnn draws from now on, one entry per pattern with a mask per layer (None for rate 0)."""
+    recorded = []
+    take = fnn.masks.take
+    def recording(n):
+        masks = take(n)
+        for i in range(n):
+            recorded.append([None if mask is None else np.array(mask[i], dtype=np.float64) for mask in masks])
+        return masks
+    fnn.masks.take = recording
+    return recorded
+
+
+def legacy_dropout_gradient(topology, data, w, lrate, dropout_type, rates, masks, regression):
+    """One langevin gradient pass of the legacy dropout samplers, pattern by pattern with the given masks."""
+    sizes = [topology[0] * topology[1], topology[1] * topology[2], topology[1], topology[2]]
+    W1, W2, B1, B2 = [part.copy() for part in np.split(np.asarray(w, dtype=np.float64), np.cumsum(sizes)[:-1])]
+    W1, W2 = W1.reshape(topology[0], topology[1]), W2.reshape(topology[1], topology[2])
+    sigmoid = lambda x: 1 / (1 + np.exp(-x))
+    for pattern, (mask1, mask2) in zip(data, masks):
+        X = pattern[0:topology[0]]
+        if regression:
+            desired = pattern[topology[0]:]
+        else:
+            desired = np.zeros(topology[2])
+            desired[int(pattern[topology[0]])] = 1
+        ones1 = np.ones(W1.shape if dropout_type == DropoutType.DROP_CONNECT else topology[1])
+        ones2 = np.ones(W2.shape if dropout_type == DropoutType.DROP_CONNECT else topology[2])
+        m1 = ones1 if mask1 is None else mask1
+        m2 = ones2 if mask2 is None else mask2
+        if dropout_type == DropoutType.GAUSSIAN_DROPOUT:
+            s1 = s2 = 1.0
+        else:
+            m1 = (m1 != 0).astype(np.float64) # the keep mask, pt_core folds the rescaling into it
+            m2 = (m2 != 0).astype(np.float64)
+            s1, s2 = 1.0 / (1.0 - rates[0]), 1.0 / (1.0 - rates[1])
+
+        if dropout_type == DropoutType.DROP_CONNECT:
+            hidout = sigmoid(X.dot(W1 * m1 * s1) - B1)
+            out = sigmoid(hidout.dot(W2 * m2 * s2) - B2)
+        else:
+            hidout = sigmoid((X.dot(W1) - B1) * m1 * s1)
+            out = sigmoid((hidout.dot(W2) - B2) * m2 * s2)
+
+        out_delta = (desired - out) * (out * (1 - out))
+        hid_delta = out_delta.dot(W2.T) * (hidout * (1 - hidout))
+        if dropout_type == DropoutType.DROP_CONNECT:
+            W2 += lrate * np.outer(hidout, out_delta) * m2 * s2
+            B2 += -lrate * out_delta
+            W1 += lrate * np.outer(X, hid_delta) * m1 * s1
+            B1 += -lrate * hid_delta
+        else:
+            W2 += lrate * np.outer(hidout, m2 * out_delta * s2)
+            B2 += -lrate * (m2 * out_delta * s2)
+            W1 += lrate * np.outer(X, m1 * hid_delta * s1)
+            B1 += -lrate * (m1 * hid_delta * s1)
+    return np.concatenate([W1.ravel(), W2.ravel(), B1, B2])
+
+
+def masked_conformance(kernel, topology, regression, precision, rtol, atol, seed, rates=(0.2, 0.3)):
+    rng = np.random.default_rng(seed)
+    traindata = make_data(rng, 60, topology, regression)
+    w = rng.standard_normal(num_parameters(topology))
+    name = type(kernel).__name__
+    passed = True
+    for dropout_type, packed in ((DropoutType.ORIGIN, False), (DropoutType.DROP_CONNECT, False), (DropoutType.DROP_CONNECT, True), (DropoutType.GAUSSIAN_DROPOUT, False)):
+        fnn = Network(topology, traindata, traindata, 0.1, rates[0], rates[1], dropout_type, np.random.default_rng(seed), packed, precision, kernel=kernel)
+        masks = record_masks(fnn)
+        actual = fnn.langevin_gradient(traindata, w.copy(), 1)
+        expected = legacy_dropout_gradient(topology, traindata, w, 0.1, dropout_type, rates, masks, regression)
+        label = dropout_type.name + (' packed' if packed else '')
+        passed &= check('{} {} gradient'.format(name, label), expected, actual, rtol, atol)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--precision', default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    precision = np.dtype(args.precision)
+    rtol, atol = (1e-9, 1e-9) if precision == np.float64 else (1e-3, 1e-3)
+    passed = conformance(legacy_classification, CategoricalKernel(), [4, 6, 3], False, precision, rtol, atol, args.seed)
+    passed &= conformance(legacy_regression, GaussianKernel(), [5, 7, 1], True, precision, rtol, atol, args.seed)
+    passed &= masked_conformance(CategoricalKernel(), [4, 6, 3], False, precision, rtol, atol, args.seed)
+    passed &= masked_conformance(GaussianKernel(), [5, 7, 1], True, precision, rtol, atol, args.seed)
+    print('all kernels conform' if passed else 'conformance FAILED')
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,500 @@
+""" Network and likelihood kernels shared by the parallel tempering and MCMC samplers
+
+The classification and regression entry points differ only in the kernel passed to Network:
+CategoricalKernel (softmax outputs, categorical likelihood) or GaussianKernel (linear-in-noise
+regression with variance tau_sq).
+"""
+
+from __future__ import print_function, division
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from enum import Enum
+class DropoutType(Enum):
+    ORIGIN = 1
+    DROP_CONNECT = 2
+    GAUSSIAN_DROPOUT = 3
+
+class DropoutMasks:
+    """Dropout masks drawn from a numpy Generator a block of patterns at a time.
+
+    One call generates the masks of every layer for block_size patterns (or a
+    whole batch) instead of one small RNG call per pattern, a DROP_CONNECT pass
+    over a large dataset never holds more than block_size weight masks. Masks
+    have the compute dtype with the 1/(1 - rate) rescaling of ORIGIN and
+    DROP_CONNECT folded in, so applying one is a single same-type multiply.
+    Bit-packed DROP_CONNECT masks are expanded one slice at a time instead.
+    """
+
+    def __init__(self, Topo, rates, dropout_type, rng=None, block_size=256, packed=False, dtype=np.float64):
+        self.Top = Topo
+        self.rates = list(rates) # one dropout rate per weight layer
+        self.dropout_type = dropout_type
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.block_size = block_size
+        self.packed = packed and dropout_type == DropoutType.DROP_CONNECT
+        self.dtype = dtype
+
+        if dropout_type == DropoutType.DROP_CONNECT: # one mask per weight
+            self.shapes = [(Topo[l], Topo[l + 1]) for l in range(len(self.rates))]
+        else: # one mask per neuron
+            self.shapes = [(Topo[l + 1],) for l in range(len(self.rates))]
+        self.gaussian = dropout_type == DropoutType.GAUSSIAN_DROPOUT
+        # ORIGIN and DROP_CONNECT rescale by the keep probability, GAUSSIAN_DROPOUT masks have mean one
+        self.scales = [1.0 if self.gaussian or rate == 0 else 1.0 / (1.0 - rate) for rate in self.rates]
+        self.thresholds = [np.float32(rate) for rate in self.rates] # same type as the uniforms, a mixed compare buffers its operands
+        self.buffers = [None] * len(self.rates) # reused while the block size stays the same
+        self.bits = [None] * len(self.rates)
+        self.keep = [None] * len(self.rates)
+        self.blocks = [None] * len(self.rates)
+        self.size = 0
+        self.index = 0
+
+    def draw(self, layer, n):
+        rate = self.rates[layer]
+        if rate == 0:
+            return None
+        shape = (n,) + self.shapes[layer]
+        if self.buffers[layer] is None or self.buffers[layer].shape != shape:
+            self.buffers[layer] = np.empty(shape, dtype=self.dtype if self.gaussian else np.float32)
+            self.bits[layer] = np.empty(shape, dtype=bool)
+            self.keep[layer] = None if self.packed else np.empty(shape, dtype=self.dtype)
+        block = self.buffers[layer]
+        if self.gaussian:
+            self.rng.standard_normal(dtype=block.dtype, out=block)
+            block *= rate * (1 - rate)
+            block += 1
+            return block
+        self.rng.random(out=block, dtype=np.float32)
+        bits = np.greater(block, self.thresholds[layer], out=self.bits[layer])
+        if self.packed:
+            return np.packbits(bits.reshape(n, -1), axis=1)
+        keep = self.keep[layer]
+        np.copyto(keep, bits)
+        keep *= self.scales[layer]
+        return keep
+
+    def fill(self, n):
+        """Draw masks for the next n patterns in one call."""
+        self.blocks = [self.draw(layer, n) for layer in range(len(self.rates))]
+        self.size = n
+        self.index = 0
+
+    def mask(self, layer, i, n):
+        block = self.blocks[layer]
+        if block is None:
+            return None
+        if self.packed:
+            shape = self.shapes[layer]
+            keep = np.unpackbits(block[i:i + n], axis=1, count=shape[0] * shape[1]).reshape((n,) + shape)
+            return np.multiply(keep, self.scales[layer], dtype=self.dtype)
+        return block[i:i + n]
+
+    def take(self, n):
+        """Masks for the next n patterns, one per layer with a leading pattern axis (None where the rate is zero)."""
+        if self.index + n > self.size:
+            self.fill(max(n, self.block_size))
+        i = self.index
+        self.index += n
+        return [self.mask(layer, i, n) for layer in range(len(self.rates))]
+
+def num_parameters(topology):
+    return sum(topology[l] * topology[l + 1] + topology[l + 1] for l in range(len(topology) - 1))
+
+def layer_offsets(topology):
+    """[w_start, w_end, b_start, b_end] of each layer in the flat parameter vector.
+
+    All weight matrices come first and then all biases, as in the original [W1, W2, B1, B2] layout.
+    """
+    offsets = []
+    start = 0
+    for l in range(len(topology) - 1):
+        offsets.append([start, start + topology[l] * topology[l + 1]])
+        start += topology[l] * topology[l + 1]
+    for l in range(len(topology) - 1):
+        offsets[l] += [start, start + topology[l + 1]]
+        start += topology[l + 1]
+    return offsets
+
+def as_float64(x, out):
+    """x in float64, copied into the float64 buffer out unless x already is out."""
+    if x is not out:
+        np.copyto(out, x)
+    return out
+
+class Network:
+
+    def __init__(self, Topo, Train, Test, learn_rate, input_dropout, hidden_dropout, dropout_type=DropoutType.ORIGIN, rng=None, packed_masks=False, dtype=np.float64, dropout_rates=None, kernel=None, eval_dropout=False):
+        self.Top = Topo  # NN topology [input, hidden, ..., hidden, output], any number of hidden layers
+        self.num_layers = len(Topo) - 1 # weight layers
+        self.TrainData = Train
+        self.TestData = Test
+        self.lrate = learn_rate
+        self.input_dropout = input_dropout
+        self.hidden_dropout = hidden_dropout
+        self.dropout_type = dropout_type
+        self.dtype = np.dtype(dtype) # compute precision, sums over the dataset are accumulated in float64
+        self.kernel = CategoricalKernel() if kernel is None else kernel # targets, predictions and likelihood of the model
+        self.eval_dropout = eval_dropout # True keeps dropout on when evaluating proposals
+
+        if dropout_rates is None: # input_dropout on the first layer, hidden_dropout on every layer after it
+            dropout_rates = [input_dropout] + [hidden_dropout] * (self.num_layers - 1)
+        self.dropout_rates = list(dropout_rates)
+        self.masks = DropoutMasks(Topo, self.dropout_rates, dropout_type, rng, packed=packed_masks, dtype=self.dtype)
+        self.no_masks = [None] * self.num_layers
+
+        self.offsets = layer_offsets(Topo)
+        self.num_param = num_parameters(Topo)
+
+        # single flat parameter buffer, the weights W[l] and biases B[l] of each layer are views into it
+        self.w = np.zeros(self.num_param, dtype=self.dtype)
+        self.W = [self.w[w0:w1].reshape(Topo[l], Topo[l + 1]) for l, (w0, w1, b0, b1) in enumerate(self.offsets)]
+        self.B = [self.w[b0:b1].reshape(1, Topo[l + 1]) for l, (w0, w1, b0, b1) in enumerate(self.offsets)]
+        for l in range(self.num_layers):
+            self.W[l][:] = np.random.randn(Topo[l], Topo[l + 1]) / np.sqrt(Topo[l])
+            self.B[l][:] = np.random.randn(1, Topo[l + 1]) / np.sqrt(Topo[l + 1])
+
+        self.layer_work = {} # activation, delta and update workspaces, one set per batch size
+        self.batch_work = {} # whole-dataset workspaces, one per dataset
+        self.dropout_masks = self.no_masks
+        self.hidout = None # output of first hidden layer
+        self.out = None # output last layer
+
+    def sigmoid(self, x, out=None):
+        if out is None:
+            return 1 / (1 + np.exp(-x))
+        np.negative(x, out=out)
+        np.exp(out, out=out)
+        out += 1
+        return np.reciprocal(out, out=out)
+
+    def sampleEr(self, actualout):
+        error = np.subtract(self.out, actualout)
+        sqerror = np.sum(np.square(error)) / self.Top[-1]
+        return sqerror
+
+    def layer_workspace(self, n):
+        work = self.layer_work.get(n)
+        if work is None:
+            sizes = self.Top[1:]
+            work = {'act': [np.zeros((n, size), dtype=self.dtype) for size in sizes], # output of each layer
+                    'delta': [np.zeros((n, size), dtype=self.dtype) for size in sizes],
+                    'grad': [np.zeros((n, size), dtype=self.dtype) for size in sizes],
+                    'bias': [np.zeros((1, size), dtype=self.dtype) for size in sizes],
+                    'bias_rows': [np.zeros((n, size), dtype=self.dtype) if n > 1 else None for size in sizes], # bias of every row
+                    'ones': np.ones((n, 1), dtype=self.dtype),
+                    'W_work': [np.zeros(W.shape, dtype=self.dtype) for W in self.W],
+                    'W_batch': [None] * self.num_layers, # DROP_CONNECT weights of each pattern, allocated when n > 1
+                    'target': np.zeros((n, self.Top[-1]), dtype=self.dtype)}
+            self.layer_work[n] = work
+        return work
+
+    def batch_workspace(self, data):
+        work = self.batch_work.get(id(data))
+        if work is None:
+            size = data.shape[0]
+            work = {'data': data, # keeps id(data) from being reused while cached
+                    'data_cast': np.ascontiguousarray(data, dtype=self.dtype), # no copy when data already has the compute dtype
+                    'X': np.ascontiguousarray(data[:, 0:self.Top[0]], dtype=self.dtype), # BLAS would copy the strided slice on every call
+                    'fx': np.zeros(size, dtype=self.dtype),
+                    'err': np.zeros(size, dtype=self.dtype),
+                    'ones64': np.ones(size)} # float64 sums over the dataset as dot products
+            work['err64'] = work['err'] if self.dtype == np.float64 else np.zeros(size)
+            work['y'] = work['data_cast'][:, self.Top[0]]
+            self.kernel.init_workspace(work, self.Top, self.dtype)
+            self.batch_work[id(data)] = work
+        return work
+
+    def subtract_bias(self, z, l, work):
+        if z.shape[0] == 1:
+            z -= self.B[l]
+        else: # a broadcast subtract buffers its operands, the bias rows from a product do not
+            z -= np.dot(work['ones'], self.B[l], out=work['bias_rows'][l])
+
+    def ForwardPass(self, X, eval=False): # X is one pattern or a batch with one pattern per row
+        X = X.reshape(-1, self.Top[0])
+        n = X.shape[0]
+        work = self.layer_workspace(n)
+        masks = self.no_masks if eval else self.masks.take(n)
+        self.dropout_masks = masks
+
+        a = X
+        for l in range(self.num_layers):
+            z = work['act'][l]
+            mask = masks[l]
+            if mask is not None and self.dropout_type == DropoutType.DROP_CONNECT:
+                if n == 1:
+                    np.multiply(self.W[l], mask[0], out=work['W_work'][l])
+                    np.dot(a, work['W_work'][l], out=z)
+                else:
+                    if work['W_batch'][l] is None:
+                        work['W_batch'][l] = np.zeros((n,) + self.W[l].shape, dtype=self.dtype)
+                    np.multiply(mask, self.W[l], out=work['W_batch'][l])
+                    np.matmul(a[:, np.newaxis, :], work['W_batch'][l], out=z[:, np.newaxis, :])
+                self.subtract_bias(z, l, work)
+            else:
+                np.dot(a, self.W[l], out=z)
+                self.subtract_bias(z, l, work)
+                if mask is not None: # ORIGIN or GAUSSIAN_DROPOUT on the layer input to the activation
+                    z *= mask
+            a = self.sigmoid(z, out=z)
+
+        self.hidout = work['act'][0]
+        self.out = a
+        return self.out
+
+    def BackwardPass(self, Input, desired): # desired holds the target columns of each pattern in Input
+        X = Input.reshape(-1, self.Top[0])
+        n = X.shape[0]
+        work = self.layer_workspace(n)
+        act = work['act']
+        delta = work['delta']
+        grad = work['grad']
+        masks = self.dropout_masks
+
+        target = work['target']
+        self.kernel.fill_target(target, desired.reshape(n, -1))
+
+        # deltas of every layer first, from the weights before this update
+        last = self.num_layers - 1
+        np.subtract(target, act[last], out=delta[last])
+        np.subtract(1, act[last], out=grad[last])
+        grad[last] *= act[last]
+        delta[last] *= grad[last] # (desired - out) * out * (1 - out)
+        for l in range(last, 0, -1):
+            np.dot(delta[l], self.W[l].T, out=delta[l - 1])
+            np.subtract(1, act[l - 1], out=grad[l - 1])
+            grad[l - 1] *= act[l - 1]
+            delta[l - 1] *= grad[l - 1] # delta[l].W[l]' * a * (1 - a)
+
+        for l in range(self.num_layers):
+            a = X if l == 0 else act[l - 1]
+            mask = masks[l]
+            W_work = work['W_work'][l]
+            if mask is not None and self.dropout_type == DropoutType.DROP_CONNECT:
+                if n == 1:
+                    np.dot(a.T, delta[l], out=W_work)
+                    W_work *= mask[0]
+                else:
+                    np.einsum('ni,no,nio->io', a, delta[l], mask, out=W_work)
+                W_work *= self.lrate
+                self.W[l] += W_work
+                bias = work['bias'][l]
+                if n == 1:
+                    np.multiply(delta[l], self.lrate, out=bias)
+                else:
+                    np.dot(work['ones'].T, delta[l], out=bias)
+                    bias *= self.lrate
+                self.B[l] -= bias
+            else:
+                if mask is not None:
+                    np.multiply(delta[l], mask, out=grad[l])
+                    grad[l] *= self.lrate
+                else:
+                    np.multiply(delta[l], self.lrate, out=grad[l])
+                np.dot(a.T, grad[l], out=W_work)
+                self.W[l] += W_work
+                if n == 1: # the bias gradient is grad itself
+                    self.B[l] -= grad[l]
+                else:
+                    self.B[l] -= np.dot(work['ones'].T, grad[l], out=work['bias'][l])
+
+    def shard(self, rng=None, kernel=None):
+        """A Network with the same settings and weights of its own, for a thread evaluating a shard of rows."""
+        return Network(self.Top, self.TrainData, self.TestData, self.lrate, self.input_dropout, self.hidden_dropout, self.dropout_type, rng, self.masks.packed,
+                       self.dtype, self.dropout_rates, self.kernel if kernel is None else kernel, self.eval_dropout)
+
+    def decode(self, w):
+        np.copyto(self.w, w) # W and B are views of self.w
+
+    def encode(self, out=None):
+        if out is None:
+            return self.w.copy()
+        np.copyto(out, self.w)
+        return out
+
+    def softmax(self):
+        prob = np.exp(self.out)/np.sum(np.exp(self.out))
+        return prob
+ 
+
+
+    def langevin_gradient(self, data, w, depth, out=None, batch_size=1):  # BP with SGD (Stocastic BP), batch_size > 1 for mini-batches
+
+        self.decode(w)  # method to decode w into the layer weights and biases
+        data = self.batch_workspace(data)['data_cast']
+        size = data.shape[0]
+
+        for i in range(0, depth):
+            self.masks.fill(min(size, self.masks.block_size)) # fresh masks for the pass, then drawn by take a block at a time
+            for start in range(0, size, batch_size):
+                Input = data[start:start + batch_size, 0:self.Top[0]]
+                Desired = data[start:start + batch_size, self.Top[0]:]
+                self.ForwardPass(Input)
+                self.BackwardPass(Input, Desired)
+
+        return self.encode(out)
+
+    def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
+
+        self.decode(w)  # method to decode w into the layer weights and biases
+        work = self.batch_workspace(data) # fx and prob are overwritten by the next call on the same data
+
+        out = self.ForwardPass(work['X'], eval=not self.eval_dropout) # whole dataset in one pass
+        return self.kernel.predict(out, work) # prob is None for kernels without class probabilities
+
+
+
+class CategoricalKernel:
+    """Classification: softmax over the output layer and a categorical likelihood of the class column."""
+
+    uses_noise = False # no tau_sq in the likelihood or prior
+    prediction_dtype = np.uint8 # stored class predictions, up to 256 classes
+
+    def init_workspace(self, work, Topo, dtype):
+        size = work['data'].shape[0]
+        work['prob'] = np.zeros((size, Topo[-1]), dtype=dtype)
+        work['rowsum'] = np.zeros((size, 1), dtype=dtype)
+        work['norm'] = np.zeros((size, Topo[-1]), dtype=dtype) # 1 / rowsum repeated over the classes
+        work['class_ones'] = np.ones((Topo[-1], 1), dtype=dtype)
+        work['pred'] = np.zeros(size, dtype=np.intp)
+        work['picked'] = np.arange(size) * Topo[-1] + work['data'][:, Topo[0]].astype(np.intp) # flat index of the true class in prob
+
+    def fill_target(self, target, desired): # one-hot, since data outputs and number of output neurons have different organisation
+        target.fill(0)
+        if target.shape[0] == 1:
+            target[0, int(desired[0, 0])] = 1
+        else:
+            target[np.arange(target.shape[0]), desired[:, 0].astype(np.intp)] = 1
+
+    def predict(self, out, work):
+        np.argmax(out, axis=1, out=work['pred'])
+        fx = work['fx']
+        np.copyto(fx, work['pred'])
+        prob = np.exp(out, out=work['prob'])
+        rowsum = np.dot(prob, work['class_ones'], out=work['rowsum'])
+        np.reciprocal(rowsum, out=rowsum)
+        prob *= np.dot(rowsum, work['class_ones'].T, out=work['norm']) # same shape, a broadcast divide buffers its operands
+        return fx, prob
+
+    def predictive(self, out):
+        """Class probabilities of stacked outputs (..., N, classes), in place."""
+        prob = np.exp(out, out=out)
+        prob /= prob.sum(axis=-1, keepdims=True)
+        return prob
+
+    def score(self, mean, targets):
+        # accuracy in percent of the most probable class under the posterior mean probabilities
+        return 'accuracy', 100 * np.mean(np.argmax(mean, axis=1) == targets)
+
+    def log_likelihood(self, fnn, data, w, tau_sq=None):
+        fx, prob = fnn.evaluate_proposal(data, w)
+        work = fnn.batch_workspace(data)
+        err = np.subtract(fx, work['y'], out=work['err'])
+        err64 = as_float64(err, work['err64'])
+        rmse = np.sqrt(np.dot(err64, err64) / err.shape[0])
+        picked = np.take(prob.ravel(), work['picked'], out=work['err'], mode='clip') # probability of the true class, 'raise' buffers out
+        lhood = np.dot(work['ones64'], as_float64(np.log(picked, out=picked), work['err64'])) # float64 sum even in float32 mode
+        return lhood, fx, rmse
+
+    def log_prior(self, sigma_squared, nu_1, nu_2, w, tau_sq=None):
+        part1 = -1 * (w.size / 2) * np.log(sigma_squared) # all weights and biases of every layer
+        part2 = 1 / (2 * sigma_squared) * np.dot(w, w)
+        return part1 - part2
+
+
+class ShardedKernel:
+    """A kernel whose log_likelihood splits the rows of a dataset into shards evaluated on a thread pool.
+
+    Every shard has a Network of its own, from Network.shard, and the partial likelihoods and
+    squared errors are added and the predictions gathered into the workspace of the full dataset.
+    numpy releases the GIL in the matrix products and ufuncs, so shards run in parallel. Datasets
+    of fewer than min_rows rows per shard are evaluated whole. The rest is the wrapped kernel.
+    """
+
+    def __init__(self, kernel, shards, min_rows=1024):
+        self.kernel = kernel
+        self.shards = shards
+        self.min_rows = min_rows
+        self.executor = None # created in the process that uses it
+        self.splits = {} # shard networks and rows of each dataset
+
+    def __getattr__(self, name):
+        try: # not set yet while unpickling, before __setstate__
+            kernel = self.__dict__['kernel']
+        except KeyError:
+            raise AttributeError(name)
+        return getattr(kernel, name)
+
+    def __getstate__(self):
+        return {'kernel': self.kernel, 'shards': self.shards, 'min_rows': self.min_rows, 'executor': None, 'splits': {}}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def split(self, fnn, data):
+        split = self.splits.get(id(data))
+        if split is None:
+            count = max(1, min(self.shards, data.shape[0] // self.min_rows))
+            bounds = np.linspace(0, data.shape[0], count + 1).astype(int)
+            split = (data, [(fnn.shard(fnn.masks.rng.spawn(1)[0], self.kernel), data[a:b], slice(a, b)) for a, b in zip(bounds[:-1], bounds[1:])])
+            self.splits[id(data)] = split # data keeps id(data) from being reused
+            if count > 1 and self.executor is None:
+                self.executor = ThreadPoolExecutor(self.shards - 1)
+        return split[1]
+
+    def log_likelihood(self, fnn, data, w, tau_sq=None):
+        shards = self.split(fnn, data)
+        if len(shards) == 1:
+            return self.kernel.log_likelihood(fnn, data, w, tau_sq)
+        evaluate = lambda shard: self.kernel.log_likelihood(shard[0], shard[1], w, tau_sq)
+        futures = [self.executor.submit(evaluate, shard) for shard in shards[1:]]
+        results = [evaluate(shards[0])] + [future.result() for future in futures] # the first shard on this thread
+        fx = fnn.batch_workspace(data)['fx']
+        lhood = sse = 0.0
+        for (network, rows, part), (shard_lhood, shard_fx, shard_rmse) in zip(shards, results):
+            lhood += shard_lhood
+            sse += shard_rmse * shard_rmse * rows.shape[0]
+            fx[part] = shard_fx
+        return lhood, fx, np.sqrt(sse / data.shape[0])
+
+
+class GaussianKernel:
+    """Regression: network outputs with Gaussian noise of variance tau_sq and an inverse gamma prior on tau_sq."""
+
+    uses_noise = True
+    prediction_dtype = np.float32
+
+    def init_workspace(self, work, Topo, dtype):
+        pass
+
+    def fill_target(self, target, desired):
+        np.copyto(target, desired[:, 0:target.shape[1]])
+
+    def predict(self, out, work):
+        fx = work['fx']
+        np.copyto(fx, out[:, 0])
+        return fx, None
+
+    def predictive(self, out):
+        return out[..., 0]
+
+    def score(self, mean, targets):
+        return 'rmse', np.sqrt(np.mean((mean - targets)**2))
+
+    def log_likelihood(self, fnn, data, w, tau_sq=None):
+        fx, _ = fnn.evaluate_proposal(data, w)
+        work = fnn.batch_workspace(data)
+        err = np.subtract(fx, work['y'], out=work['err'])
+        err64 = as_float64(err, work['err64'])
+        sse = np.dot(err64, err64)
+        n = err.shape[0]
+        rmse = np.sqrt(sse / n)
+        lhood = -(n / 2) * np.log(2 * math.pi * tau_sq) - sse / (2 * tau_sq)
+        return lhood, fx, rmse
+
+    def log_prior(self, sigma_squared, nu_1, nu_2, w, tau_sq=None):
+        part1 = -1 * (w.size / 2) * np.log(sigma_squared)
+        part2 = 1 / (2 * sigma_squared) * np.dot(w, w)
+        return part1 - part2 - (1 + nu_1) * np.log(tau_sq) - (nu_2 / tau_sq)
@@ -0,0 +1,143 @@
+""" Registry of the classification problems and their binary cache
+
+python pt_datasets.py                build the cache of every problem whose source files are present
+python pt_datasets.py iris chess     only these problems
+python pt_datasets.py --list         problems, source files and whether they are cached
+
+A problem is parsed, normalised and split once, then kept as .npy files in DATA/cache under a key
+made of the hash of its source files and the split settings. load_problem memory-maps those, so the
+replicas forked from the main process share the pages of the dataset instead of copies.
+"""
+
+from __future__ import print_function, division
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+CACHE = os.path.join(here, 'DATA', 'cache')
+
+
+class Problem:
+    """How main() reads a problem: one file split into train and test or a train and a test file.
+
+    With a single source, features columns of it are the inputs, class_column the class minus
+    class_offset, and the features are normalised over all rows before a seeded split. With two
+    sources, columns are the columns kept of each, and normalise standardises the first features
+    columns of each file with its own statistics.
+    """
+
+    def __init__(self, name, sources, delimiter, features, output, class_column=None, class_offset=0, skip_rows=0, columns=None, normalise=True):
+        self.name = name
+        self.sources = sources
+        self.delimiter = delimiter
+        self.features = features
+        self.output = output
+        self.class_column = class_column
+        self.class_offset = class_offset
+        self.skip_rows = skip_rows
+        self.columns = columns
+        self.normalise = normalise
+
+    def files(self):
+        return [os.path.join(here, source) for source in self.sources]
+
+    def source_hash(self):
+        digest = hashlib.sha1()
+        for file_name in self.files():
+            with open(file_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def build(self, seed, train_ratio):
+        """traindata, testdata, the normalisation mean and std of each and the split indices."""
+        data = [np.genfromtxt(file_name, delimiter=self.delimiter)[self.skip_rows:] for file_name in self.files()]
+        if len(data) == 1:
+            features = data[0][:, :self.features]
+            classes = data[0][:, self.class_column:self.class_column + 1] - self.class_offset
+            mean, std = features.mean(axis=0), features.std(axis=0)
+            if self.normalise:
+                features = (features - mean) / std
+            indices = np.random.default_rng(seed).permutation(features.shape[0])
+            cut = int(train_ratio * features.shape[0])
+            traindata = np.hstack([features[indices[:cut]], classes[indices[:cut]]])
+            testdata = np.hstack([features[indices[cut:]], classes[indices[cut:]]])
+            return traindata, testdata, np.stack([mean, mean]), np.stack([std, std]), indices
+        traindata, testdata = [d[:, self.columns] for d in data]
+        mean = np.stack([d[:, :self.features].mean(axis=0) for d in (traindata, testdata)])
+        std = np.stack([d[:, :self.features].std(axis=0) for d in (traindata, testdata)])
+        if self.normalise:
+            traindata[:, :self.features] = (traindata[:, :self.features] - mean[0]) / std[0]
+            testdata[:, :self.features] = (testdata[:, :self.features] - mean[1]) / std[1]
+        return traindata, testdata, mean, std, np.arange(0)
+
+
+# the problems of main(), by number and name
+PROBLEMS = {
+    1: Problem('winequality-red', ['DATA/winequality-red.csv'], ';', 11, 10, class_column=11, skip_rows=1),
+    2: Problem('winequality-white', ['DATA/winequality-white.csv'], ';', 11, 10, class_column=11, skip_rows=1),
+    3: Problem('iris', ['DATA/iris.csv'], ';', 4, 3, class_column=4, class_offset=1),
+    4: Problem('Ionosphere', ['DATA/Ions/Ions/ftrain.csv', 'DATA/Ions/Ions/ftest.csv'], ',', 34, 2, columns=slice(None, -1), normalise=False),
+    5: Problem('Cancer', ['DATA/Cancer/ftrain.txt', 'DATA/Cancer/ftest.txt'], ' ', 9, 2, columns=slice(None, -1), normalise=False),
+    6: Problem('bank-additional', ['DATA/Bank/bank-processed.csv'], ';', 20, 2, class_column=20),
+    7: Problem('PenDigit', ['DATA/PenDigit/train.csv', 'DATA/PenDigit/test.csv'], ',', 16, 10, columns=slice(None)),
+    8: Problem('chess', ['DATA/chess.csv'], ';', 6, 18, class_column=6),
+}
+PROBLEMS.update({problem.name: problem for problem in list(PROBLEMS.values())})
+
+
+def cache_folder(problem, seed=0, train_ratio=0.7, dtype=np.float64, cache=CACHE):
+    settings = json.dumps([problem.source_hash(), seed, train_ratio, np.dtype(dtype).str])
+    return os.path.join(cache, problem.name + '_' + hashlib.sha1(settings.encode()).hexdigest()[:16])
+
+
+def load_problem(problem, seed=0, train_ratio=0.7, dtype=np.float64, cache=CACHE, mmap=True):
+    """traindata and testdata of a problem (number, name or Problem), built into the cache on first use.
+
+    The arrays are memory-mapped read-only unless mmap is False. The normalisation statistics
+    and split indices are in the mean.npy, std.npy and split.npy files of the cache folder.
+    """
+    problem = PROBLEMS[problem] if not isinstance(problem, Problem) else problem
+    folder = cache_folder(problem, seed, train_ratio, dtype, cache)
+    if not os.path.exists(folder):
+        os.makedirs(cache, exist_ok=True)
+        # built in a temporary folder and renamed, runs started together may build it at the same time
+        building = tempfile.mkdtemp(dir=cache)
+        traindata, testdata, mean, std, indices = problem.build(seed, train_ratio)
+        for name, array in (('train', traindata.astype(dtype)), ('test', testdata.astype(dtype)), ('mean', mean), ('std', std), ('split', indices)):
+            np.save(os.path.join(building, name + '.npy'), array)
+        try:
+            os.rename(building, folder)
+        except OSError:
+            shutil.rmtree(building)
+            if not os.path.exists(folder):
+                raise
+    mode = 'r' if mmap else None
+    return np.load(os.path.join(folder, 'train.npy'), mmap_mode=mode), np.load(os.path.join(folder, 'test.npy'), mmap_mode=mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('problems', nargs='*')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--train-ratio', type=float, default=0.7)
+    parser.add_argument('--precision', default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--list', action='store_true')
+    args = parser.parse_args()
+
+    problems = [PROBLEMS[int(name) if name.isdigit() else name] for name in args.problems] if args.problems else [PROBLEMS[k] for k in range(1, 9)]
+    for problem in problems:
+        present = all(os.path.exists(file_name) for file_name in problem.files())
+        if args.list:
+            cached = present and os.path.exists(cache_folder(problem, args.seed, args.train_ratio, args.precision))
+            print('{:>18} {:8} {}'.format(problem.name, 'cached' if cached else ('' if present else 'missing'), ' '.join(problem.sources)))
+        elif present:
+            traindata, testdata = load_problem(problem, args.seed, args.train_ratio, args.precision)
+            print('{:>18} train {} test {}'.format(problem.name, traindata.shape, testdata.shape))
+
+if __name__ == "__main__": main()
@@ -0,0 +1,270 @@
+""" Online convergence diagnostics of the parallel tempering replicas while they run
+
+python pt_diagnostics.py 'fix_likeh/*/results/iris_*'               R-hat and ESS over the T=1 chains of every matching run
+python pt_diagnostics.py 'fix_likeh/*/results/iris_*' --watch 30    the same every 30 s, the runs are stopped once converged together
+
+A run with a ConvergenceMonitor, run_problem with early_stopping or burn_in='auto', appends the
+T=1 batches of its chains to <run folder>/diagnostics_batches.txt at every swap round and stops at
+the next one once <run folder>/stop exists. This command pools the chains of all the runs, so
+repeated runs of a configuration are checked against each other and not only their own chains.
+"""
+
+from __future__ import print_function, division
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from pt_status import open_status, STATUS_FILE
+
+
+# scalar traces the replicas summarise: untempered log-likelihood and squared norm of w of the current state
+MONITORED = ('likelihood', 'w_norm')
+# row of a replica on the board: last iteration, highest temperature and count of the interval, then
+# mean and mean square of every MONITORED trace over the iterations since the previous swap point
+BOARD_FIELDS = 3 + 2 * len(MONITORED)
+# columns of ConvergenceMonitor.history and diagnostics.txt
+COLUMNS = ['iteration', 'burn_in'] + ['rhat_' + name for name in MONITORED] + ['ess_' + name for name in MONITORED]
+BATCH_FILE = '/diagnostics_batches.txt' # chain index and board row of every T=1 batch of a run, appended at every swap round
+STOP_FILE = '/stop' # the run stops at its next swap round once it exists
+
+
+def status_board(num_chains):
+    """Shared float64 board with one row per replica, written at every swap point and read by the main process."""
+    return multiprocessing.Array('d', num_chains * BOARD_FIELDS, lock=False)
+
+
+def board_rows(board):
+    return np.frombuffer(board, dtype=np.float64).reshape(-1, BOARD_FIELDS)
+
+
+class IntervalStatistics:
+    """Running sums of the MONITORED traces of one replica, posted to its board row at every swap point."""
+
+    def __init__(self, board, index):
+        self.row = board_rows(board)[index]
+        self.sums = np.zeros((len(MONITORED), 2))
+        self.count = 0
+        self.temperature = 0.0
+
+    def add(self, temperature, *values):
+        self.count += 1
+        self.temperature = max(self.temperature, temperature)
+        for k, value in enumerate(values):
+            self.sums[k, 0] += value
+            self.sums[k, 1] += value * value
+
+    def post(self, iteration):
+        # written before the replica signals the main process, whose Event wait makes it visible
+        self.row[0] = iteration
+        self.row[1] = self.temperature
+        self.row[2] = self.count
+        self.row[3:] = (self.sums / max(self.count, 1)).ravel()
+        self.sums[:] = 0
+        self.count = 0
+        self.temperature = 0.0
+
+
+def mser_truncation(means):
+    """Number of leading batches MSER drops, the d <= n/2 that minimises var(means[d:]) / (n - d)."""
+    n = means.shape[0]
+    tail = n - np.arange(n // 2 + 1)
+    sums = np.cumsum(means[::-1])[::-1][:n // 2 + 1]
+    squares = np.cumsum(means[::-1]**2)[::-1][:n // 2 + 1]
+    deviations = squares - sums**2 / tail
+    return int(np.argmin(deviations / tail**2))
+
+
+def rebatched(counts, means, size):
+    """Counts and means of consecutive batches merged into batches of at least size samples."""
+    group = max(1, min(int(np.ceil(size / counts.mean())), counts.shape[0] // 2))
+    stop = counts.shape[0] // group * group
+    totals = counts[:stop].reshape(-1, group).sum(axis=1)
+    return totals, (counts * means)[:stop].reshape(-1, group).sum(axis=1) / totals
+
+
+def split_rhat(halves):
+    """Split-R-hat of (count, mean, variance) of every half chain."""
+    counts, means, variances = np.asarray(halves).T
+    n = counts.mean()
+    within = variances.mean()
+    if within <= 0:
+        return np.inf
+    return np.sqrt(((n - 1) / n * within + means.var(ddof=1)) / within)
+
+
+def pooled(counts, means, squares):
+    count = counts.sum()
+    mean = (counts * means).sum() / count
+    variance = ((counts * squares).sum() / count - mean**2) * count / max(count - 1, 1)
+    return count, mean, max(variance, 0.0)
+
+
+def truncation(batches):
+    # leading batches dropped from a chain, the latest MSER burn-in of its traces
+    return max(mser_truncation(batches[:, 3 + 2 * k]) for k in range(len(MONITORED)))
+
+
+def convergence(chains):
+    """MSER burn-in in batches of every chain of board rows, then split-R-hat and batch-means ESS of every MONITORED trace over the chains after it."""
+    burnin = [truncation(batches) for batches in chains]
+    chains = [batches[d:] for batches, d in zip(chains, burnin)]
+    rhat = []
+    ess = []
+    for k in range(len(MONITORED)):
+        halves = []
+        ess.append(0.0)
+        for batches in chains:
+            counts = batches[:, 2]
+            means = batches[:, 3 + 2 * k]
+            squares = batches[:, 4 + 2 * k]
+            middle = batches.shape[0] // 2
+            for half in (slice(0, middle), slice(middle, None)):
+                halves.append(pooled(counts[half], means[half], squares[half]))
+            count, mean, variance = pooled(counts, means, squares)
+            counts, means = rebatched(counts, means, int(np.sqrt(count)))
+            batch_variance = counts.mean() * means.var(ddof=1)
+            if batch_variance > 0:
+                ess[k] += float(min(count, count * variance / batch_variance))
+        rhat.append(float(split_rhat(halves)))
+    return burnin, rhat, ess
+
+
+class ConvergenceMonitor:
+    """Split-R-hat, batch-means ESS and MSER burn-in of the chains at T=1, updated at every swap round.
+
+    Every swap interval is one batch of the batch-means estimators. Only the intervals a replica
+    spent entirely at T=1 count, so the cold chain from the start and every chain once the canonical
+    phase begins. Each chain is truncated at its own MSER burn-in and split in halves for R-hat.
+
+    With stop, update() returns True, and the replicas are told to stop, once every MONITORED
+    trace has an ESS of target_ess and an R-hat below max_rhat. Nothing is computed before a chain
+    has min_batches batches at T=1. Attached with the run folder path, the batches are appended
+    to its BATCH_FILE and update() also returns True once a RunsMonitor wrote its STOP_FILE.
+    """
+
+    def __init__(self, target_ess=1000, max_rhat=1.05, min_batches=20, stop=True):
+        self.target_ess = target_ess
+        self.max_rhat = max_rhat
+        self.min_batches = min_batches
+        self.stop = stop
+        self.board = None
+        self.path = None
+        self.batches = []
+        self.history = [] # iteration, cold chain burn-in, R-hat and ESS of every MONITORED trace
+
+    def attach(self, num_chains, board=None, path=None):
+        # board is reused, e.g. the one of a ReplicaPool, when given
+        self.board = status_board(num_chains) if board is None else board
+        board_rows(self.board)[:] = 0
+        self.path = path
+        if path is not None:
+            open(path + BATCH_FILE, 'w').close()
+        self.batches = [[] for _ in range(num_chains)]
+        self.history = []
+        return self.board
+
+    def update(self):
+        """Read the board after a swap round, True once the thresholds are met."""
+        rows = board_rows(self.board)
+        if not rows[:, 2].any(): # e.g. the round of the last samples, which are not posted
+            return False
+        new = []
+        for index, (batches, row) in enumerate(zip(self.batches, rows)):
+            if row[2] > 0 and row[1] == 1:
+                batches.append(row.copy())
+                new.append(np.concatenate(([index], row)))
+        rows[:, 2] = 0
+        if self.path is not None and new:
+            with open(self.path + BATCH_FILE, 'a') as f:
+                np.savetxt(f, new, fmt='%.17g')
+        stopped = self.path is not None and os.path.exists(self.path + STOP_FILE)
+        iteration = int(rows[:, 0].max())
+        chains = [np.asarray(batches) for batches in self.batches if len(batches) >= self.min_batches]
+        if not chains:
+            return stopped
+        burnin, rhat, ess = convergence(chains)
+        first = chains[0][burnin[0]] # chains[0] is the cold chain, the longest at T=1
+        self.history.append([iteration, int(first[0] - first[2] + 1)] + rhat + ess)
+        return stopped or bool(self.stop and min(ess) >= self.target_ess and max(rhat) <= self.max_rhat)
+
+    def burn_in(self):
+        """First iteration after the MSER burn-in of the cold chain, None before min_batches batches."""
+        return int(self.history[-1][1]) if self.history else None
+
+    def summary(self):
+        return dict(zip(COLUMNS, self.history[-1])) if self.history else {}
+
+    def save(self, file_name):
+        np.savetxt(file_name, np.reshape(self.history, (-1, len(COLUMNS))), fmt='%1.5f', header=' '.join(COLUMNS))
+
+
+def read_batches(path):
+    """Board rows of the T=1 batches of every chain of the run in folder path flushed so far, one array per chain."""
+    with open(path + BATCH_FILE) as f:
+        lines = f.read().split('\n')[:-1] # a last line without a newline is still being written
+    rows = np.array([line.split() for line in lines], dtype=np.float64).reshape(-1, 1 + BOARD_FIELDS)
+    return [rows[rows[:, 0] == index, 1:] for index in np.unique(rows[:, 0])]
+
+
+class RunsMonitor(ConvergenceMonitor):
+    """ConvergenceMonitor over the T=1 chains of every run folder matching patterns, from their BATCH_FILE.
+
+    Runs matching later are picked up at the next update. A row of the history has the latest
+    iteration and burn-in over the chains. stop_runs() writes the STOP_FILE of the runs still running.
+    """
+
+    def __init__(self, patterns, target_ess=1000, max_rhat=1.05, min_batches=20):
+        ConvergenceMonitor.__init__(self, target_ess, max_rhat, min_batches)
+        self.patterns = patterns
+
+    def runs(self):
+        folders = sorted(set(folder.rstrip('/') for pattern in self.patterns for folder in glob.glob(pattern)))
+        return [folder for folder in folders if os.path.exists(folder + BATCH_FILE)]
+
+    def running(self):
+        # runs without a status file have not started their replicas yet
+        return [folder for folder in self.runs() if not os.path.exists(folder + STATUS_FILE) or not open_status(folder)[:, -1].all()]
+
+    def update(self):
+        """Read the batches of the runs, True once the thresholds are met over all their chains."""
+        chains = [batches for folder in self.runs() for batches in read_batches(folder) if len(batches) >= self.min_batches]
+        if len(chains) < 2:
+            return False
+        burnin, rhat, ess = convergence(chains)
+        firsts = [batches[d] for batches, d in zip(chains, burnin)]
+        self.history.append([int(max(batches[-1, 0] for batches in chains)), int(max(first[0] - first[2] + 1 for first in firsts))] + rhat + ess)
+        return bool(min(ess) >= self.target_ess and max(rhat) <= self.max_rhat)
+
+    def stop_runs(self):
+        for folder in self.running():
+            open(folder + STOP_FILE, 'w').close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('runs', nargs='+', help='run folders or glob patterns of run folders')
+    parser.add_argument('--watch', type=float, default=None, help='seconds between updates, the runs are stopped once converged')
+    parser.add_argument('--target-ess', type=float, default=1000)
+    parser.add_argument('--max-rhat', type=float, default=1.05)
+    parser.add_argument('--min-batches', type=int, default=20)
+    parser.add_argument('--output', default=None, help='file the history is saved to')
+    args = parser.parse_args()
+
+    monitor = RunsMonitor(args.runs, args.target_ess, args.max_rhat, args.min_batches)
+    while True:
+        converged = monitor.update()
+        print(len(monitor.runs()), 'runs', monitor.summary())
+        if args.watch is None or monitor.runs() and not monitor.running(): # waits for the first run to start
+            break
+        if converged:
+            print('Converged, stopping', len(monitor.running()), 'runs')
+            monitor.stop_runs()
+            break
+        time.sleep(args.watch)
+    if args.output is not None:
+        monitor.save(args.output)
+
+if __name__ == "__main__": main()
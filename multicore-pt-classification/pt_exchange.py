@@ -0,0 +1,287 @@
+""" Transports of the replica exchange of ParallelTempering
+
+python pt_exchange.py join /tmp/pt.sock                    run a replica of the run listening on this Unix socket
+PT_AUTHKEY=<key> python pt_exchange.py join coordinator:6000 --replicas 5   five replicas of a run on another host
+PT_AUTHKEY=<key> python pt_exchange.py join coordinator:6000 --runs 0       replicas of every run until the coordinator stops listening
+
+ParallelTempering runs its replicas as local processes exchanging states over multiprocessing
+queues and events, QueueTransport. With a SocketTransport, run_problem(exchange=address), the
+replicas are started by pt_exchange.py join on any host that reaches the address, over TCP
+(host:port) or a Unix socket (path). The coordinator sends each replica its arguments and the
+datasets and decides the swaps. At a swap point a replica sends its likelihood, and its interval
+statistics when the run is monitored and its status row, the coordinator answers whether to stop and whether its state
+moves; only replicas whose state moves send their weights and receive the ones of their new state.
+The run folder must be on a file system all the hosts share, the replicas write their traces there,
+and a relative folder is taken from where join was started.
+Both ends use the authentication key of PT_AUTHKEY. It is required for TCP, where anyone reaching
+the port could otherwise send a replica pickled arguments, a Unix socket left to the permissions of
+its file falls back to a fixed key.
+"""
+
+from __future__ import print_function, division
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+import numpy as np
+
+from pt_diagnostics import BOARD_FIELDS, board_rows, status_board
+from pt_status import STATUS_FIELDS
+
+SWAP_POINT, FINISHED, CLOSED = 0, 1, 2 # kinds of replica messages
+
+
+def parse_address(address):
+    # host:port for TCP, anything else is the path of a Unix socket
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def authkey_of(address, authkey=None):
+    """authkey, else the key of PT_AUTHKEY, for the parsed address. Raises ValueError for TCP without a key."""
+    if authkey is None and os.environ.get('PT_AUTHKEY'):
+        authkey = os.environ['PT_AUTHKEY']
+    if authkey is None:
+        if isinstance(address, tuple):
+            raise ValueError('the exchange at {}:{} is over TCP, set PT_AUTHKEY or give an authkey'.format(*address))
+        authkey = 'parallel-tempering'
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class QueueChannel:
+    """The replica end of QueueTransport: its queue, the event it signals and the one it waits on."""
+
+    def __init__(self, parameter_queue, signal_main, event, stop):
+        self.parameter_queue = parameter_queue
+        self.signal_main = signal_main
+        self.event = event
+        self.stop = stop
+
+    def exchange(self, param):
+        """Send the state at a swap point, returns the state to continue from and whether to stop."""
+        self.event.clear() # before signalling, or the main process can set it first and the wait never returns
+        self.parameter_queue.put(param)
+        self.signal_main.set()
+        self.event.wait()
+        # retrieve parameters fom queues if it has been swapped
+        result = self.parameter_queue.get()
+        return result, self.stop is not None and self.stop.is_set()
+
+    def finish(self, param):
+        self.parameter_queue.put(param)
+        self.signal_main.set()
+
+    def close(self):
+        pass
+
+
+class QueueTransport:
+    """Replicas of this machine, processes or ReplicaPool workers, exchanging over queues and events."""
+
+    def __init__(self, parameter_queue, wait_chain, event, alive, num_param, verbose=False, stop=None, error=None):
+        self.parameter_queue = parameter_queue
+        self.wait_chain = wait_chain
+        self.event = event
+        self.alive = alive # alive(index) of the process running chain index
+        self.num_param = num_param
+        self.verbose = verbose
+        self.stop = stop # the stop event the replicas read, set when a replica failed
+        self.error = error # error(index) the traceback of the failed replica of chain index, None when not known
+        self.states = []
+
+    def gather(self):
+        """Likelihoods of the states sent at a swap point, None once every replica has ended."""
+        count = 0
+        for index in range(len(self.parameter_queue)):
+            if not self.alive(index):
+                count += 1
+                self.wait_chain[index].set()
+                print(str(index) + " Dead")
+        if count == len(self.parameter_queue):
+            return None
+        if self.verbose:
+            print("Waiting")
+        for index in range(len(self.parameter_queue)):
+            if self.verbose:
+                print("Waiting for chain: {}".format(index + 1))
+            self.wait_chain[index].wait()
+            if self.verbose:
+                print("Signal from chain: {}".format(index + 1))
+        self.states = [queue.get() for queue in self.parameter_queue]
+        # a ReplicaPool worker whose replica raised sends its end marker instead of a state
+        failed = [index for index, state in enumerate(self.states) if isinstance(state, str)]
+        if failed:
+            self.abort(failed)
+            errors = [(None if self.error is None else self.error(index)) or 'chain {} ended without a state\n'.format(index) for index in failed]
+            raise RuntimeError('replica failed:\n' + '\n'.join(errors))
+        return np.array([state[self.num_param + 1] for state in self.states])
+
+    def abort(self, failed):
+        # the other replicas continue from their own state and stop, the markers are put back for ReplicaPool.finish
+        if self.stop is not None:
+            self.stop.set()
+        for index, state in enumerate(self.states):
+            self.parameter_queue[index].put(state)
+            if index not in failed:
+                self.wait_chain[index].clear()
+                self.event[index].set()
+
+    def scatter(self, order, stop):
+        # chain j continues from the state chain order[j] sent, the stop event is read by the replicas
+        for index, source in enumerate(order):
+            self.parameter_queue[index].put(self.states[source])
+        for index in range(len(self.parameter_queue)):
+            self.wait_chain[index].clear() # before releasing the chain, or its next signal can be cleared
+            self.event[index].set()
+
+    def finish(self):
+        pass
+
+
+class SocketChannel:
+    """The replica end of SocketTransport, row is its interval statistics when the run is monitored, status its status row."""
+
+    def __init__(self, connection, num_param, row, status):
+        self.connection = connection
+        self.num_param = num_param
+        self.row = row
+        self.status = status
+
+    def send(self, kind, param):
+        header = [kind, param[self.num_param + 3], param[self.num_param + 1]] # kind, iteration, likelihood
+        self.connection.send_bytes(np.concatenate([header, [] if self.row is None else self.row, self.status]).tobytes())
+
+    def exchange(self, param):
+        self.send(SWAP_POINT, param)
+        stop, moved = np.frombuffer(self.connection.recv_bytes())
+        if moved:
+            self.connection.send_bytes(param[:self.num_param + 1].tobytes()) # w and eta
+            param = np.frombuffer(self.connection.recv_bytes())
+        return param, bool(stop)
+
+    def finish(self, param):
+        self.send(FINISHED, param)
+
+    def close(self):
+        # after the traces and summaries are written, the coordinator reads them next
+        self.connection.send_bytes(np.array([CLOSED], dtype=np.float64).tobytes())
+        self.connection.close()
+
+
+class SocketTransport:
+    """Replicas anywhere, joined with pt_exchange.py join, exchanging over TCP or a Unix socket."""
+
+    def __init__(self, address, num_chains, authkey=None):
+        self.address = parse_address(address)
+        self.num_chains = num_chains
+        self.listener = multiprocessing.connection.Listener(self.address, authkey=authkey_of(self.address, authkey))
+        self.connections = []
+        self.board = None
+        self.status = None
+        self.finished = [False] * num_chains
+
+    def start(self, replica_args, board=None, status=None):
+        """Send chain i its ptReplica arguments after the channels, as the replicas join, their status goes to the status rows."""
+        self.board = None if board is None else board_rows(board)
+        self.status = status
+        print('waiting for {} replicas at {}'.format(self.num_chains, self.listener.address))
+        for index, (args, kwargs) in enumerate(replica_args):
+            connection = self.listener.accept()
+            kwargs = dict(kwargs, board=board is not None, layout=None) # the CPUs of this host mean nothing there
+            args = [np.array(arg) if isinstance(arg, np.memmap) else arg for arg in args] # the rows, not the file
+            connection.send((index, self.num_chains, args, kwargs))
+            self.connections.append(connection)
+
+    def receive(self, index):
+        message = np.frombuffer(self.connections[index].recv_bytes())
+        if message[0] == SWAP_POINT and self.board is not None:
+            self.board[index] = message[3:3 + BOARD_FIELDS]
+        if message[0] != CLOSED and self.status is not None:
+            self.status[index] = message[-len(STATUS_FIELDS):]
+        return message
+
+    def gather(self):
+        messages = [self.receive(index) for index in range(self.num_chains)]
+        for index, message in enumerate(messages):
+            self.finished[index] = message[0] == FINISHED
+        if any(self.finished):
+            for index, message in enumerate(messages):
+                if message[0] == SWAP_POINT: # waiting for an answer
+                    self.connections[index].send_bytes(np.array([1, 0], dtype=np.float64).tobytes())
+            return None
+        return np.array([message[2] for message in messages])
+
+    def scatter(self, order, stop):
+        moved = [index for index, source in enumerate(order) if source != index]
+        for index in range(self.num_chains):
+            self.connections[index].send_bytes(np.array([stop, index in moved], dtype=np.float64).tobytes())
+        states = {index: self.connections[index].recv_bytes() for index in moved}
+        for index in moved:
+            self.connections[index].send_bytes(states[order[index]])
+
+    def finish(self):
+        """Stop the replicas still sampling and wait until every one has written its files."""
+        for index, connection in enumerate(self.connections):
+            while True:
+                message = self.receive(index)
+                if message[0] == SWAP_POINT:
+                    connection.send_bytes(np.array([1, 0], dtype=np.float64).tobytes())
+                elif message[0] == CLOSED:
+                    break
+            connection.close()
+        self.listener.close()
+
+
+def join(address, authkey=None):
+    """Run one replica of the run of the coordinator at address."""
+    from pt_classification_dropout import ptReplica
+    address = parse_address(address)
+    connection = multiprocessing.connection.Client(address, authkey=authkey_of(address, authkey))
+    index, num_chains, args, kwargs = connection.recv()
+    kwargs['launched'] = time.time() # startup from the arguments on
+    kwargs['board'] = status_board(num_chains) if kwargs['board'] else None
+    row = None if kwargs['board'] is None else board_rows(kwargs['board'])[index]
+    kwargs['status'] = np.zeros(len(STATUS_FIELDS)) # sent with every message, the status file may not be shared
+    channel = SocketChannel(connection, len(args[5]), row, kwargs['status']) # args[5] is w
+    ptReplica(*args, None, None, None, chain_index=index, channel=channel, **kwargs).run()
+
+
+def join_runs(address, runs, authkey=None, patience=60):
+    # runs replicas one after the other, with runs 0 until the address refuses for patience seconds after a run
+    done = 0
+    refused = None
+    while runs == 0 or done < runs:
+        try:
+            join(address, authkey)
+        except (ConnectionRefusedError, FileNotFoundError):
+            refused = time.time() if refused is None else refused
+            if runs == 0 and done > 0 and time.time() - refused > patience:
+                return
+            time.sleep(1) # the coordinator is not listening yet, or post-processing the last run
+            continue
+        refused = None
+        done += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['join'])
+    parser.add_argument('address', help='host:port or the path of a Unix socket')
+    parser.add_argument('--replicas', type=int, default=1, help='replicas started on this host')
+    parser.add_argument('--runs', type=int, default=1, help='runs each replica joins, 0 until the coordinator stops')
+    args = parser.parse_args()
+    try:
+        authkey_of(parse_address(args.address)) # before starting the replicas
+    except ValueError as error:
+        parser.error(str(error))
+
+    workers = [multiprocessing.Process(target=join_runs, args=(args.address, args.runs)) for _ in range(args.replicas)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__": main()
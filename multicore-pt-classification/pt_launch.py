@@ -0,0 +1,131 @@
+""" Concurrent parallel tempering runs packed onto a core budget
+
+python pt_launch.py specs.json                                     every run of the file, as many at once as the cores allow
+python pt_launch.py specs.json --cores 32
+python pt_launch.py --problems 3 5 --dropout ORIGIN DROP_CONNECT --seeds 0 1    the product of these
+python pt_launch.py --problems 3 --seeds 0 1 --split-seeds 0 1 2                 repeated runs over different splits
+python pt_launch.py specs.json --start-method forkserver          runs and replicas forked from a preloaded server
+python pt_launch.py --problems 3 5 --cores 20 --pin               every run bound to CPUs of its own, its replicas pinned
+
+A spec file holds a JSON list of run specs, or one spec per line. A spec is an object of run_problem
+keyword arguments, e.g.
+    {"problem": 3, "dropout_type": "GAUSSIAN_DROPOUT", "input_dropout": 0.1, "hidden_dropout": 0.2, "seed": 1}
+Every run takes num_chains cores (10 by default), one per replica, times its likelihood shards.
+Runs are started in order while their cores fit in the budget, a run larger than the budget starts
+once nothing else is running.
+With --pin a run is bound to as many free CPUs, which become the BLAS thread budget of its replicas.
+Results go to the SQLite store of run_problem, see pt_results.py, one transaction per run.
+"""
+
+from __future__ import print_function, division
+import argparse
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+from pt_core import DropoutType
+from pt_threads import allowed_cpus
+
+
+def read_specs(file_name):
+    with open(file_name) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def run_spec(spec):
+    from pt_classification_dropout import run_problem
+    spec = dict(spec)
+    if 'dropout_type' in spec:
+        spec['dropout_type'] = DropoutType[spec['dropout_type']]
+    return run_problem(**spec)
+
+
+def cores_of(spec, cores):
+    return min(spec.get('num_chains', 10) * spec.get('shards', 1), cores)
+
+
+def run_pinned(target, spec, cpus):
+    os.sched_setaffinity(0, cpus) # inherited by the replicas
+    return target(spec)
+
+
+def launch(specs, cores, target=run_spec, pin=False):
+    """Run target(spec) for every spec in its own process, at most cores replicas at a time. Returns the exit codes.
+
+    With pin every process is bound to CPUs no other running process has.
+    """
+    pending = list(enumerate(specs))
+    running = {} # sentinel -> (index, process, cores, start time, CPUs)
+    codes = [None] * len(specs)
+    free = cores
+    cpus = allowed_cpus()
+    if pin and not hasattr(os, 'sched_setaffinity'):
+        raise ValueError('pinning runs needs os.sched_setaffinity, not available on this platform')
+    if pin and cores > len(cpus):
+        raise ValueError('pinning {} cores on {} CPUs'.format(cores, len(cpus)))
+    free_cpus = cpus[:cores]
+    while pending or running:
+        for item in list(pending):
+            index, spec = item
+            needed = cores_of(spec, cores)
+            if needed <= free:
+                run_cpus = free_cpus[:needed] if pin else []
+                free_cpus = free_cpus[len(run_cpus):]
+                if pin:
+                    process = multiprocessing.Process(target=run_pinned, args=(target, spec, run_cpus))
+                else:
+                    process = multiprocessing.Process(target=target, args=(spec,)) # not daemonic, it starts the replicas
+                process.start()
+                running[process.sentinel] = (index, process, needed, time.time(), run_cpus)
+                free -= needed
+                pending.remove(item)
+                print('started run {} {} on {} cores{}, {} free'.format(index, json.dumps(spec), needed, ' (CPUs {})'.format(run_cpus) if pin else '', free))
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            index, process, needed, started, run_cpus = running.pop(sentinel)
+            process.join()
+            codes[index] = process.exitcode
+            free += needed
+            free_cpus = [cpu for cpu in cpus if cpu in free_cpus or cpu in run_cpus]
+            print('run {} finished with exit code {} after {:.1f} min'.format(index, process.exitcode, (time.time() - started) / 60))
+    return codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('specs', nargs='?', help='JSON file of run specs')
+    parser.add_argument('--cores', type=int, default=os.cpu_count())
+    parser.add_argument('--problems', type=int, nargs='+', default=[])
+    parser.add_argument('--dropout', nargs='+', default=['DROP_CONNECT'], choices=[t.name for t in DropoutType])
+    parser.add_argument('--input-dropout', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--hidden-dropout', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[None])
+    parser.add_argument('--split-seeds', type=int, nargs='+', default=[0], help='seeds of the train and test split')
+    parser.add_argument('--chains', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=None, help='overrides the NumSample of every problem')
+    parser.add_argument('--shards', type=int, default=1, help='likelihood threads per replica')
+    parser.add_argument('--start-method', default=None, choices=['fork', 'forkserver', 'spawn'])
+    parser.add_argument('--pin', action='store_true', help='bind runs to their own CPUs and pin their replicas')
+    parser.add_argument('--early-stopping', action='store_true', help='end runs once the convergence monitor finds them converged')
+    args = parser.parse_args()
+
+    if args.start_method is not None:
+        from pt_classification_dropout import set_start_method
+        set_start_method(args.start_method)
+
+    specs = read_specs(args.specs) if args.specs else []
+    for problem, dropout, input_dropout, hidden_dropout, seed, split_seed in itertools.product(args.problems, args.dropout, args.input_dropout, args.hidden_dropout, args.seeds, args.split_seeds):
+        specs.append({'problem': problem, 'dropout_type': dropout, 'input_dropout': input_dropout, 'hidden_dropout': hidden_dropout,
+                      'seed': seed, 'split_seed': split_seed, 'num_chains': args.chains, 'num_samples': args.samples, 'pin': args.pin, 'shards': args.shards, 'early_stopping': args.early_stopping})
+    if not specs:
+        parser.error('no runs, give a spec file or --problems')
+    codes = launch(specs, args.cores, pin=args.pin)
+    failed = [index for index, code in enumerate(codes) if code != 0]
+    print('{} runs, {} failed{}'.format(len(codes), len(failed), ': ' + ' '.join(map(str, failed)) if failed else ''))
+
+if __name__ == "__main__": main()
@@ -0,0 +1,995 @@
+""" Recording and post-processing of the posterior written by the parallel tempering replicas"""
+
+from __future__ import print_function, division
+import os
+import queue
+import struct
+import threading
+import zipfile
+import numpy as np
+
+from pt_core import CategoricalKernel, layer_offsets
+
+
+# per-chain .npy files of every trace a replica can record: trace -> {array: (folder, prefix, suffix)}
+TRACE_FILES = {
+    'pos_w': {'pos_w': ('/posterior/pos_w/', 'chain_', '.npy')},
+    'likelihood': {'likelihood': ('/posterior/pos_likelihood/', 'chain_', '.npy')},
+    'rmse': {'rmse_train': ('/predictions/', 'rmse_train_chain_', '.npy'), 'rmse_test': ('/predictions/', 'rmse_test_chain_', '.npy')},
+    'accuracy': {'acc_train': ('/predictions/', 'acc_train_chain_', '.npy'), 'acc_test': ('/predictions/', 'acc_test_chain_', '.npy')},
+    'accept': {'accept': ('/posterior/accept_list/', 'chain_', '.npy')},
+    'w_traces': {'w_traces': ('/traces/', 'w_traces_', '_.npy')},
+    'predictions': {'fx_train': ('/predictions/', 'fxtrain_samples_chain_', '.npz'), 'fx_test': ('/predictions/', 'fxtest_samples_chain_', '.npz')},
+}
+
+# traces that only change when a proposal is accepted, stored once per accepted state when run-length
+# encoded, with the (iteration, run length) of every state in the runs file of the chain
+RUN_LENGTH_TRACES = ('pos_w', 'rmse', 'accuracy', 'predictions')
+RUN_FILE = ('/posterior/', 'runs_chain_', '.npy')
+
+# scalar traces of the streaming summaries and their quantiles, one summary_chain_<T>.npz per replica
+SUMMARY_TRACES = ('likelihood', 'rmse_train', 'rmse_test', 'acc_train', 'acc_test')
+SUMMARY_QUANTILES = (0.05, 0.5, 0.95)
+SUMMARY_FILE = ('/posterior/', 'summary_chain_', '.npz')
+
+
+class RecordingPolicy:
+    """Which per-iteration traces the replicas keep, from which iteration on and how thinned.
+
+    traces is a subset of TRACE_FILES, start is the first recorded iteration (None starts at
+    the burn-in) and after it every thin-th iteration is kept. Traces that are not kept are
+    neither allocated nor written.
+
+    chains limits the replicas that record: None for all, 'cold' for T=1 only or a collection
+    of temperatures. The others keep only their acceptance and swap statistics, unless
+    canonical is set, then they record the canonical phase where every chain samples at T=1.
+
+    With run_length the RUN_LENGTH_TRACES keep one row per accepted state and its run length
+    instead of repeating the row after every rejected proposal.
+    """
+
+    def __init__(self, traces=tuple(TRACE_FILES), start=None, thin=1, chains=None, canonical=False, run_length=True):
+        unknown = set(traces).difference(TRACE_FILES)
+        if unknown:
+            raise ValueError('Unknown traces: {}'.format(', '.join(sorted(unknown))))
+        if thin < 1:
+            raise ValueError('thin must be at least 1, got {}'.format(thin))
+        if isinstance(chains, str) and chains != 'cold':
+            raise ValueError("chains must be None, 'cold' or temperatures, got {!r}".format(chains))
+        self.traces = tuple(traces)
+        self.start = start
+        self.thin = thin
+        self.chains = chains if chains is None or chains == 'cold' else tuple(chains)
+        self.canonical = canonical
+        self.run_length = run_length
+
+    def resolve(self, burnin):
+        """Same policy with start fixed, None becomes the burn-in iteration."""
+        return RecordingPolicy(self.traces, burnin if self.start is None else self.start, self.thin, self.chains, self.canonical, self.run_length)
+
+    def for_chain(self, temperature, canonical_start):
+        """The policy of the replica at temperature, whose canonical phase starts at canonical_start."""
+        if self.chains is None or (temperature == 1 if self.chains == 'cold' else temperature in self.chains):
+            return self
+        if self.canonical:
+            return RecordingPolicy(self.traces, max(self.start, canonical_start), self.thin, run_length=self.run_length)
+        return RecordingPolicy((), self.start, self.thin, run_length=self.run_length)
+
+    def encodes(self, trace):
+        return self.run_length and trace in RUN_LENGTH_TRACES
+
+    def keeps(self, trace):
+        return trace in self.traces
+
+    def records(self, iteration):
+        return iteration >= self.start and (iteration - self.start) % self.thin == 0
+
+    def row(self, iteration):
+        return (iteration - self.start) // self.thin
+
+    def rows(self, iterations):
+        """Number of rows recorded in iterations 0 .. iterations-1."""
+        return len(range(self.start, iterations, self.thin))
+
+
+def save_blocks(file_name, array, block_rows=256):
+    """Save array as a compressed .npz of blocks of block_rows rows, read back with BlockArray."""
+    blocks = {'block_' + str(k): array[start:start + block_rows] for k, start in enumerate(range(0, array.shape[0], block_rows))}
+    np.savez_compressed(file_name, rows=array.shape[0], block_rows=block_rows, template=array[:0], **blocks)
+
+
+def merged_moments(weighted_blocks):
+    # count, mean and sum of squared deviations of (block, weights) pairs, merged pairwise
+    count, mean, m2 = 0, 0.0, 0.0
+    for block, weights in weighted_blocks:
+        block = np.asarray(block, dtype=np.float64)
+        if weights is None:
+            weights = np.ones(block.shape[0])
+        weights = weights.reshape((-1,) + (1,) * (block.ndim - 1))
+        n = weights.sum()
+        block_mean = (block * weights).sum(axis=0) / n
+        block_m2 = (weights * (block - block_mean)**2).sum(axis=0)
+        delta = block_mean - mean
+        total = count + n
+        mean = mean + delta * n / total
+        m2 = m2 + block_m2 + delta**2 * count * n / total
+        count = total
+    return count, mean, m2
+
+
+def npy_header(dtype, shape, length=None):
+    # .npy version 1.0 header of length bytes in all, padded with spaces so that it can be rewritten in place
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    if length is None:
+        length = -(-(len(header) + 11) // 64) * 64 + 64 # room for a shape with more digits
+    header += ' ' * (length - len(header) - 11) + '\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class NpyStream:
+    """.npy file written block by block, its header fixed up with the final number of rows on close."""
+
+    def __init__(self, file_name, dtype, row_shape, max_rows):
+        self.file = open(file_name, 'wb')
+        self.dtype = np.dtype(dtype)
+        self.row_shape = row_shape
+        self.header_length = len(npy_header(dtype, (max_rows,) + row_shape))
+        self.file.write(npy_header(dtype, (max_rows,) + row_shape, self.header_length))
+        self.rows = 0
+
+    def write(self, block):
+        self.file.write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+        self.rows += block.shape[0]
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(npy_header(self.dtype, (self.rows,) + self.row_shape, self.header_length))
+        self.file.close()
+
+
+class BlockStream:
+    """Compressed .npz of blocks written one at a time, the same layout as save_blocks."""
+
+    def __init__(self, file_name, dtype, row_shape, block_rows):
+        self.archive = zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED)
+        self.template = np.zeros((0,) + row_shape, dtype=dtype)
+        self.block_rows = block_rows
+        self.blocks = 0
+        self.rows = 0
+
+    def member(self, name, array):
+        with self.archive.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+    def write(self, block):
+        self.member('block_' + str(self.blocks), block.astype(self.template.dtype, copy=False))
+        self.blocks += 1
+        self.rows += block.shape[0]
+
+    def close(self):
+        self.member('rows', np.array(self.rows))
+        self.member('block_rows', np.array(self.block_rows))
+        self.member('template', self.template)
+        self.archive.close()
+
+
+class TraceWriter:
+    """Background thread writing the blocks handed to it to their streams.
+
+    The queue holds at most max_blocks blocks, put blocks while it is full, so a replica never gets
+    more than that ahead of the disk.
+    """
+
+    def __init__(self, max_blocks):
+        self.queue = queue.Queue(max_blocks)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    item[0].write(item[1])
+                except Exception as e: # raised in the replica by put or close
+                    self.error = e
+
+    def put(self, stream, block):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((stream, block))
+
+    def close(self, streams):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        for stream in streams:
+            stream.close()
+
+
+class ChainRecorder:
+    """The traces of one replica, streamed to its files as its RecordingPolicy says.
+
+    record takes the id of the current state, e.g. the number of accepted proposals, and
+    run-length encoded arrays get a new row only when it changes. Every array fills a block of
+    block_rows rows that is handed to a TraceWriter thread once complete, so at most a block per
+    array plus queued_blocks blocks are held in memory whatever the number of samples.
+    Predictions of train_size and test_size points are kept as prediction_dtype, uint8 class
+    indices or float32 regression outputs.
+    """
+
+    def __init__(self, policy, samples, w_size, train_size=0, test_size=0, prediction_dtype=np.float32, block_rows=256, queued_blocks=4):
+        self.policy = policy
+        self.samples = samples
+        self.block_rows = block_rows
+        self.queued_blocks = queued_blocks
+        widths = {'pos_w': (w_size,), 'w_traces': (w_size,), 'likelihood': (2,), 'fx_train': (train_size,), 'fx_test': (test_size,)}
+        dtypes = {'fx_train': prediction_dtype, 'fx_test': prediction_dtype}
+        self.blocks = {} # name -> (index of the block, its rows)
+        self.encoded = set()
+        self.files = {}
+        for trace in policy.traces:
+            for name, file_name in TRACE_FILES[trace].items():
+                if policy.encodes(trace):
+                    self.encoded.add(name)
+                self.blocks[name] = [0, np.zeros((block_rows,) + widths.get(name, ()), dtype=dtypes.get(name, np.float64))]
+                self.files[name] = file_name
+        if self.encoded:
+            self.blocks['runs'] = [0, np.zeros((block_rows, 2), dtype=np.int64)] # iteration of every state and its run length
+            self.files['runs'] = RUN_FILE
+        self.num_runs = 0
+        self.state = None
+        self.streams = {}
+        self.writer = None
+
+    def open(self, path, temperature):
+        """Create the files of the chain at temperature and start the writer thread."""
+        rows = self.policy.rows(self.samples)
+        for name, (folder, prefix, suffix) in self.files.items():
+            file_name = path + folder + prefix + str(temperature) + suffix
+            block = self.blocks[name][1]
+            if suffix == '.npz':
+                self.streams[name] = BlockStream(file_name, block.dtype, block.shape[1:], self.block_rows)
+            else:
+                self.streams[name] = NpyStream(file_name, block.dtype, block.shape[1:], rows)
+        if self.streams:
+            self.writer = TraceWriter(self.queued_blocks * len(self.streams))
+
+    def row_block(self, name, row):
+        # the block of name holding row, handing the earlier ones to the writer
+        entry = self.blocks[name]
+        while row // self.block_rows > entry[0]:
+            self.writer.put(self.streams[name], entry[1].copy())
+            entry[1][:] = 0
+            entry[0] += 1
+        return entry[1]
+
+    def record(self, iteration, state=None, **values):
+        if not self.policy.records(iteration):
+            return
+        row = self.policy.row(iteration)
+        new_run = False
+        if self.encoded.intersection(values):
+            if self.num_runs and state == self.state:
+                self.row_block('runs', self.num_runs - 1)[(self.num_runs - 1) % self.block_rows, 1] += 1
+            else:
+                self.row_block('runs', self.num_runs)[self.num_runs % self.block_rows] = iteration, 1
+                self.num_runs += 1
+                self.state = state
+                new_run = True
+        for name, value in values.items():
+            if name not in self.blocks:
+                continue
+            if name not in self.encoded:
+                self.row_block(name, row)[row % self.block_rows] = value
+            elif new_run:
+                self.row_block(name, self.num_runs - 1)[(self.num_runs - 1) % self.block_rows] = value
+
+    def close(self, iterations=None):
+        """Write the last rows and close the files, iterations cuts a chain stopped before all its samples."""
+        rows = self.policy.rows(self.samples if iterations is None else iterations)
+        for name, stream in self.streams.items():
+            total = self.num_runs if name in self.encoded or name == 'runs' else rows
+            self.row_block(name, total)
+            if total % self.block_rows:
+                self.writer.put(stream, self.blocks[name][1][:total % self.block_rows].copy())
+        if self.writer is not None:
+            self.writer.close(self.streams.values())
+
+
+class RunningMoments:
+    """Weighted Welford mean and variance, with the extremes, of values of a fixed shape."""
+
+    def __init__(self, shape=()):
+        self.count = 0.0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.max = np.full(shape, -np.inf)
+        self.min = np.full(shape, np.inf)
+
+    def add(self, value, weight=1):
+        self.count += weight
+        delta = value - self.mean
+        self.mean += delta * (weight / self.count)
+        self.m2 += weight * delta * (value - self.mean)
+        np.maximum(self.max, value, out=self.max)
+        np.minimum(self.min, value, out=self.min)
+
+    def merge(self, other):
+        # pairwise update of Chan et al., same as merged_moments
+        total = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.mean = self.mean + delta * other.count / total
+            self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / total
+            self.count = total
+            self.max = np.maximum(self.max, other.max)
+            self.min = np.minimum(self.min, other.min)
+        return self
+
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def arrays(self, name):
+        return {name + '_' + key: np.asarray(getattr(self, key)) for key in ('count', 'mean', 'm2', 'max', 'min')}
+
+    @classmethod
+    def from_arrays(cls, archive, name):
+        moments = cls()
+        for key in ('count', 'mean', 'm2', 'max', 'min'):
+            setattr(moments, key, archive[name + '_' + key].copy() if key != 'count' else float(archive[name + '_count']))
+        return moments
+
+
+class TDigest:
+    """Merging t-digest of a weighted stream (Dunning and Ertl, 2019), for quantiles in constant memory.
+
+    Values are buffered and merged into at most about compression / 2 centroids, small at the tails
+    where the arcsine scale puts them. Digests of several streams merge into one.
+    """
+
+    def __init__(self, compression=200, buffer_size=512):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.buffer = []
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+
+    def compress(self, means=(), weights=()):
+        if self.buffer:
+            values, counts = zip(*self.buffer)
+            means = np.concatenate([means, values])
+            weights = np.concatenate([weights, counts])
+            self.buffer = []
+        if len(means) == 0:
+            return
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        self.min = min(self.min, means.min())
+        self.max = max(self.max, means.max())
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        # centroids whose centre falls in the same unit of k(q) = compression / (2 pi) * asin(2q - 1) are merged
+        cumulative = np.cumsum(weights)
+        centre = (cumulative - weights / 2) / cumulative[-1]
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * centre - 1))
+        starts = np.flatnonzero(np.concatenate([[True], k[1:] != k[:-1]]))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def merge(self, other):
+        other.compress()
+        self.compress(other.means, other.weights)
+        return self
+
+    def quantile(self, q):
+        self.compress()
+        if self.weights.size == 0:
+            return np.full(np.shape(q), np.nan)
+        cumulative = np.cumsum(self.weights)
+        centres = cumulative - self.weights / 2
+        positions = np.concatenate([[0], centres, [cumulative[-1]]])
+        return np.interp(np.asarray(q) * cumulative[-1], positions, np.concatenate([[self.min], self.means, [self.max]]))
+
+    def arrays(self, name):
+        self.compress()
+        return {name + '_means': self.means, name + '_weights': self.weights, name + '_range': np.array([self.min, self.max])}
+
+    @classmethod
+    def from_arrays(cls, archive, name):
+        digest = cls()
+        digest.means = archive[name + '_means']
+        digest.weights = archive[name + '_weights']
+        digest.min, digest.max = archive[name + '_range']
+        return digest
+
+
+class StreamingSummary:
+    """Constant-memory summary of the states a replica visits from iteration start on.
+
+    Like ChainRecorder.record, record takes the id of the current state. Each state enters the
+    running moments of w and of the SUMMARY_TRACES and the t-digests of the SUMMARY_TRACES once,
+    weighted by the iterations it was held. With start None, for a burn-in only known at the end,
+    the summary is kept in segments starting at 0, min_segment and every doubling of the
+    iteration after it, which load_summary merges from the burn-in on.
+    """
+
+    def __init__(self, start, w_size, min_segment=64):
+        self.start = 0 if start is None else start
+        self.w_size = w_size
+        self.next = min_segment if start is None else None # iteration the next segment starts at
+        self.segments = []
+        self.new_segment(self.start)
+        self.state = None
+        self.current = None
+        self.weight = 0
+
+    def new_segment(self, start):
+        self.w = RunningMoments((self.w_size,))
+        self.scalars = RunningMoments((len(SUMMARY_TRACES),))
+        self.digests = [TDigest() for _ in SUMMARY_TRACES]
+        self.segments.append((start, self.w, self.scalars, self.digests))
+
+    def record(self, iteration, state, w, **values):
+        if iteration < self.start:
+            return
+        if self.next is not None and iteration >= self.next:
+            self.flush() # a state held across the boundary is weighted in both segments
+            self.new_segment(iteration)
+            self.next = 2 * iteration
+        if state != self.state or self.current is None:
+            self.flush()
+            self.state = state
+            self.current = (np.array(w, dtype=np.float64), np.array([values[name] for name in SUMMARY_TRACES], dtype=np.float64))
+        self.weight += 1
+
+    def flush(self):
+        if self.weight:
+            self.w.add(self.current[0], self.weight)
+            self.scalars.add(self.current[1], self.weight)
+            for digest, value in zip(self.digests, self.current[1]):
+                digest.add(value, self.weight)
+        self.weight = 0
+
+    def save(self, path, temperature):
+        self.flush()
+        folder, prefix, suffix = SUMMARY_FILE
+        arrays = {'starts': np.array([segment[0] for segment in self.segments])}
+        for k, (start, w, scalars, digests) in enumerate(self.segments):
+            arrays.update(w.arrays(segment_name('w', k)), **scalars.arrays(segment_name('scalars', k)))
+            for name, digest in zip(SUMMARY_TRACES, digests):
+                arrays.update(digest.arrays(segment_name('digest', k) + '_' + name))
+        np.savez(path + folder + prefix + str(temperature) + suffix, **arrays)
+
+
+def segment_name(name, k):
+    # the first segment keeps the names of a summary saved in one piece
+    return name if k == 0 else name + str(k)
+
+
+def load_summary(path, temperatures, burn_in=None):
+    """Summary of a run from the streaming summaries of the chains at temperatures.
+
+    Every SUMMARY_TRACES entry and pos_w get the mean, std, max and min over the states of all
+    the chains, the traces also their SUMMARY_QUANTILES over all the chains and per chain,
+    (num_chains, len(SUMMARY_QUANTILES)). A summary in segments starts at the first segment at
+    or after the burn_in iteration, the last one if none is. burn_in of the summary is the
+    iteration it starts from, None for summaries saved without it.
+    """
+    w = RunningMoments()
+    scalars = RunningMoments()
+    digests = {name: TDigest() for name in SUMMARY_TRACES}
+    chain_quantiles = {name: [] for name in SUMMARY_TRACES}
+    starts = []
+    folder, prefix, suffix = SUMMARY_FILE
+    for temperature in temperatures:
+        with np.load(path + folder + prefix + str(temperature) + suffix) as archive:
+            segments = archive['starts'] if 'starts' in archive.files else [None]
+            first = 0
+            if burn_in is not None and len(segments) > 1:
+                first = next((k for k, start in enumerate(segments) if start >= burn_in), len(segments) - 1)
+            starts.append(segments[first])
+            chain_digests = {name: TDigest() for name in SUMMARY_TRACES}
+            for k in range(first, len(segments)):
+                w.merge(RunningMoments.from_arrays(archive, segment_name('w', k)))
+                scalars.merge(RunningMoments.from_arrays(archive, segment_name('scalars', k)))
+                for name in SUMMARY_TRACES:
+                    chain_digests[name].merge(TDigest.from_arrays(archive, segment_name('digest', k) + '_' + name))
+            for name in SUMMARY_TRACES:
+                chain_quantiles[name].append(chain_digests[name].quantile(SUMMARY_QUANTILES))
+                digests[name].merge(chain_digests[name])
+    summary = {'samples': scalars.count, 'temperatures': list(temperatures), 'quantiles': SUMMARY_QUANTILES,
+               'burn_in': None if None in starts else int(max(starts))}
+    summary['pos_w'] = {'mean': w.mean, 'std': w.std(), 'max': w.max, 'min': w.min}
+    for k, name in enumerate(SUMMARY_TRACES):
+        summary[name] = {'mean': scalars.mean[k], 'std': scalars.std()[k], 'max': scalars.max[k], 'min': scalars.min[k],
+                         'quantiles': digests[name].quantile(SUMMARY_QUANTILES), 'chain_quantiles': np.array(chain_quantiles[name])}
+    return summary
+
+
+def load_traces(path, policies, temperatures, burnin, memory_budget=256 * 2**20):
+    """ChainArray of every recorded array after the burn-in, None for the traces no chain kept.
+
+    policies holds the resolved policy of every chain. Only the chains that recorded a trace
+    are part of its ChainArray, their temperatures are in its temperatures attribute.
+    """
+    traces = {}
+    for trace, arrays in TRACE_FILES.items():
+        recorded = [(policy, temperature) for policy, temperature in zip(policies, temperatures) if policy.keeps(trace)]
+        for name, (folder, prefix, suffix) in arrays.items():
+            if recorded:
+                chains = []
+                for policy, temperature in recorded:
+                    file_name = path + folder + prefix + str(temperature) + suffix
+                    chain = BlockArray(file_name) if suffix == '.npz' else np.load(file_name, mmap_mode='r')
+                    if policy.encodes(trace):
+                        runs = np.load(path + RUN_FILE[0] + RUN_FILE[1] + str(temperature) + RUN_FILE[2])
+                        chain = RunLengthArray(chain, runs[:, 1], runs[:, 0])
+                    chains.append(chain[policy.rows(burnin):])
+                traces[name] = ChainArray(chains, memory_budget, [temperature for policy, temperature in recorded])
+            else:
+                traces[name] = None
+    return traces
+
+
+class BlockArray:
+    """Rows of a file written by save_blocks, decompressed one block at a time when indexed.
+
+    Slicing rows returns another BlockArray over the same file, any other index reads only
+    the blocks holding the rows it selects.
+    """
+
+    def __init__(self, file_name, offset=0, stop=None, archive=None):
+        self.archive = np.load(file_name) if archive is None else archive # members are read on access
+        self.file_name = file_name
+        self.block_rows = int(self.archive['block_rows'])
+        template = self.archive['template']
+        self.offset = offset
+        self.stop = int(self.archive['rows']) if stop is None else stop
+        self.shape = (self.stop - offset,) + template.shape[1:]
+        self.dtype = template.dtype
+        self.cached = (None, None) # last block read
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block(self, k):
+        if self.cached[0] != k:
+            self.cached = (k, self.archive['block_' + str(k)])
+        return self.cached[1]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if not index:
+            return self
+        rows, rest = index[0], index[1:]
+        if isinstance(rows, slice) and rows.step in (None, 1):
+            start, stop, _ = rows.indices(self.shape[0])
+            view = BlockArray(self.file_name, self.offset + start, self.offset + max(start, stop), self.archive)
+            return np.asarray(view)[(slice(None),) + rest] if rest else view
+        rows = np.arange(self.shape[0])[rows] + self.offset
+        flat = np.atleast_1d(rows)
+        out = np.empty((flat.size,) + self.shape[1:], dtype=self.dtype)
+        for k in np.unique(flat // self.block_rows):
+            selected = flat // self.block_rows == k
+            out[selected] = self.block(k)[flat[selected] - k * self.block_rows]
+        return (out if np.ndim(rows) else out[0])[rest]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[np.arange(self.shape[0])]
+        return out if dtype is None else out.astype(dtype)
+
+
+class RunLengthArray:
+    """One run-length encoded chain that indexes like the array of all its recorded rows.
+
+    states holds one row per accepted state, lengths how many consecutive recorded rows it
+    occupies and iterations where it was first recorded. Slicing rows returns another
+    RunLengthArray over the same states, any other index expands only the rows it selects.
+    """
+
+    def __init__(self, states, lengths, iterations=None, offset=0, stop=None, bounds=None):
+        self.states = states
+        self.lengths = lengths
+        self.iterations = iterations
+        self.bounds = np.concatenate([[0], np.cumsum(lengths)]) if bounds is None else bounds # first row of every state
+        self.offset = offset
+        self.stop = int(self.bounds[-1]) if stop is None else stop
+        self.shape = (self.stop - self.offset,) + states.shape[1:]
+        self.dtype = states.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def state_index(self, rows):
+        """Index into states of every row of this array."""
+        return np.searchsorted(self.bounds, np.asarray(rows) + self.offset, side='right') - 1
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if not index:
+            return self
+        rows, rest = index[0], index[1:]
+        if isinstance(rows, slice) and rows.step in (None, 1):
+            start, stop, _ = rows.indices(self.shape[0])
+            states = self.states[(slice(None),) + rest] if rest else self.states
+            return RunLengthArray(states, self.lengths, self.iterations, self.offset + start, self.offset + max(start, stop), self.bounds)
+        return self.states[self.state_index(np.arange(self.shape[0])[rows])][rest]
+
+    def weighted(self, rows_per_chunk):
+        """Yield (states, weights) blocks, weights being how many of the rows hold each state."""
+        if self.shape[0] == 0:
+            return
+        first, last = self.state_index([0, self.shape[0] - 1])
+        for start in range(first, last + 1, rows_per_chunk):
+            stop = min(start + rows_per_chunk, last + 1)
+            weights = np.minimum(self.bounds[start + 1:stop + 1], self.stop) - np.maximum(self.bounds[start:stop], self.offset)
+            yield np.asarray(self.states[start:stop]), weights
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.states[self.state_index(np.arange(self.shape[0]))]
+        return out if dtype is None else out.astype(dtype)
+
+
+class ChainArray:
+    """Per-chain traces seen as one (num_chains, samples, ...) array without loading them.
+
+    Each chain is a read-only memory map of its .npy file with the burn-in sliced off, so
+    indexing returns views and the summaries are accumulated in chunks of at most
+    memory_budget bytes. Chains may differ in length, samples is then the longest one and
+    the summaries count only the recorded rows. Run-length encoded chains are expanded chunk
+    by chunk, their summaries weight every state by its run length instead.
+    """
+
+    def __init__(self, chains, memory_budget=256 * 2**20, temperatures=None):
+        self.chains = chains
+        self.lengths = [chain.shape[0] for chain in chains]
+        self.shape = (len(chains), max(self.lengths)) + chains[0].shape[1:]
+        self.dtype = chains[0].dtype
+        self.memory_budget = memory_budget
+        self.temperatures = temperatures
+
+    @classmethod
+    def load(cls, files, burnin=0, memory_budget=256 * 2**20):
+        return cls([np.load(file_name, mmap_mode='r')[burnin:] for file_name in files], memory_budget)
+
+    @property
+    def size(self):
+        return sum(self.lengths) * int(np.prod(self.shape[2:]))
+
+    @property
+    def rows_per_chunk(self):
+        row_bytes = int(np.prod(self.shape[2:])) * self.dtype.itemsize
+        return max(1, min(self.shape[1], self.memory_budget // row_bytes))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        # a chain index gives a view of that chain, a slice over chains gives another ChainArray of views
+        if not isinstance(index, tuple):
+            index = (index,)
+        if isinstance(index[0], slice):
+            temperatures = None if self.temperatures is None else self.temperatures[index[0]]
+            return ChainArray([chain[index[1:]] for chain in self.chains[index[0]]], self.memory_budget, temperatures)
+        return self.chains[index[0]][index[1:]]
+
+    def chunks(self):
+        """Yield (chain, start, block) with block a view of samples start:start+len(block) of chain.
+
+        Blocks of run-length encoded chains are expanded copies.
+        """
+        rows = self.rows_per_chunk
+        for chain in range(self.shape[0]):
+            for start in range(0, self.lengths[chain], rows):
+                block = self.chains[chain][start:start + rows]
+                yield chain, start, block if isinstance(block, np.ndarray) else np.asarray(block)
+
+    def weighted_chunks(self):
+        """Yield (block, weights) covering every chain, weights None when each row counts once."""
+        rows = self.rows_per_chunk
+        for chain in self.chains:
+            if isinstance(chain, RunLengthArray):
+                for block in chain.weighted(rows):
+                    yield block
+            else:
+                for start in range(0, chain.shape[0], rows):
+                    yield np.asarray(chain[start:start + rows]), None
+
+    def moments(self):
+        """Count, mean and sum of squared deviations over all samples of all chains.
+
+        Chunks are merged with the pairwise update of Chan et al., so a long chain does
+        not lose precision the way a running sum of squares would.
+        """
+        return merged_moments(self.weighted_chunks())
+
+    # np.mean, np.std and np.amax dispatch to these; without an axis they reduce over chains
+    # and samples lazily, any other reduction works on the materialized array
+    def mean(self, axis=None, dtype=None, out=None):
+        if axis is not None or out is not None:
+            return np.asarray(self).mean(axis=axis, dtype=dtype, out=out)
+        return self.moments()[1]
+
+    def std(self, axis=None, dtype=None, out=None, ddof=0):
+        if axis is not None or out is not None:
+            return np.asarray(self).std(axis=axis, dtype=dtype, out=out, ddof=ddof)
+        count, mean, m2 = self.moments()
+        return np.sqrt(m2 / (count - ddof))
+
+    def max(self, axis=None, out=None, **kwargs):
+        if axis is not None or out is not None or kwargs:
+            return np.asarray(self).max(axis=axis, out=out, **kwargs)
+        return np.max([block.max(axis=0) for block, weights in self.weighted_chunks() if len(block)], axis=0)
+
+    def min(self, axis=None, out=None, **kwargs):
+        if axis is not None or out is not None or kwargs:
+            return np.asarray(self).min(axis=axis, out=out, **kwargs)
+        return np.min([block.min(axis=0) for block, weights in self.weighted_chunks() if len(block)], axis=0)
+
+    def savetxt(self, file_name, fmt='%.18e'):
+        # same rows as np.savetxt of the chains stacked one after the other
+        with open(file_name, 'w') as f:
+            for chain, start, block in self.chunks():
+                np.savetxt(f, block, fmt=fmt)
+
+    def __array__(self, dtype=None, copy=None):
+        # only materialized when asked for explicitly, e.g. for plotting; shorter chains are padded with nan
+        if len(set(self.lengths)) > 1:
+            out = np.full(self.shape, np.nan, dtype=np.float64 if dtype is None else dtype)
+        else:
+            out = np.empty(self.shape, dtype=self.dtype if dtype is None else dtype)
+        for chain, start, block in self.chunks():
+            out[chain, start:start + block.shape[0]] = block
+        return out
+
+    def __repr__(self):
+        return 'ChainArray(shape={}, dtype={})'.format(self.shape, self.dtype)
+
+
+class PosteriorPredictions:
+    """Predictions fx of every posterior sample on one dataset, produced on request.
+
+    Behaves like the (num_chains, samples, N) array show_results used to fill with zeros,
+    but nothing is held in memory: the rows come from the predictions the replicas stored
+    (a ChainArray) when there are any, otherwise they are generated from the posterior
+    weights. Every chunk is at most memory_budget bytes. The ensemble summaries weight a
+    run-length encoded state by its run length.
+    """
+
+    def __init__(self, pos_w, fnn, data, stored=None, memory_budget=256 * 2**20):
+        self.pos_w = pos_w # (num_chains, samples, num_param) array or ChainArray, not copied
+        self.fnn = fnn
+        self.data = data
+        self.shape = (pos_w.shape[0], pos_w.shape[1], data.shape[0])
+        self.lengths = getattr(pos_w, 'lengths', [pos_w.shape[1]] * pos_w.shape[0]) # samples of every chain
+        self.dtype = np.dtype(np.float64)
+        self.memory_budget = memory_budget
+        self.stored = stored
+        if stored is not None and stored.dtype != self.dtype:
+            # compact rows read in chunks of as many rows as float64 ones, converted they stay within memory_budget
+            self.stored = ChainArray(stored.chains, self.rows_per_chunk * self.shape[2] * stored.dtype.itemsize, stored.temperatures)
+
+    @property
+    def rows_per_chunk(self):
+        return max(1, min(self.shape[1], self.memory_budget // (self.shape[2] * self.dtype.itemsize)))
+
+    def chunks(self):
+        """Yield (chain, start, block) with block holding samples start:start+len(block) of chain.
+
+        Generated and converted blocks share one buffer that the next chunk overwrites. A run-length
+        encoded pos_w is evaluated once per state, the rows of a run copy its prediction.
+        """
+        rows = self.rows_per_chunk
+        buffer = None
+        if self.stored is not None:
+            for chain, start, block in self.stored.chunks():
+                if block.dtype != self.dtype:
+                    if buffer is None:
+                        buffer = np.empty((rows, self.shape[2]), dtype=self.dtype)
+                    np.copyto(buffer[:block.shape[0]], block)
+                    block = buffer[:block.shape[0]]
+                yield chain, start, block
+            return
+        for chain in range(self.shape[0]):
+            chain_w = self.pos_w[chain]
+            previous = None
+            for start in range(0, self.lengths[chain], rows):
+                stop = min(start + rows, self.lengths[chain])
+                if buffer is None:
+                    buffer = np.empty((rows, self.shape[2]), dtype=self.dtype)
+                block = buffer[:stop - start]
+                states = chain_w.state_index(np.arange(start, stop)) if isinstance(chain_w, RunLengthArray) else [None] * (stop - start)
+                for k in range(stop - start):
+                    if states[k] is not None and previous is not None and states[k] == previous[0]:
+                        block[k] = previous[1]
+                    else:
+                        block[k], _ = self.fnn.evaluate_proposal(self.data, chain_w[start + k])
+                    previous = (states[k], block[k])
+                yield chain, start, block
+
+    def weighted_chunks(self):
+        """Yield (block, weights) over all samples, weights None when each row counts once."""
+        if self.stored is not None:
+            return self.stored.weighted_chunks()
+        return ((block, None) for chain, start, block in self.chunks())
+
+    def mean(self):
+        """Posterior mean prediction of every data point, accumulated chunk by chunk."""
+        return merged_moments(self.weighted_chunks())[1]
+
+    def std(self):
+        count, mean, m2 = merged_moments(self.weighted_chunks())
+        return np.sqrt(m2 / count)
+
+    def vote_counts(self, num_classes=None):
+        """(N, num_classes) number of posterior samples predicting every class for every data point."""
+        num_classes = self.fnn.Top[-1] if num_classes is None else num_classes
+        counts = np.zeros((self.shape[2], num_classes))
+        for block, weights in self.weighted_chunks():
+            weights = np.ones(block.shape[0]) if weights is None else weights
+            for c in range(num_classes):
+                counts[:, c] += weights @ (block == c)
+        return counts
+
+    def majority_vote(self, counts=None):
+        return np.argmax(self.vote_counts() if counts is None else counts, axis=1)
+
+    def ensemble_accuracy(self, counts=None):
+        """Accuracy in percent of the majority vote against the class column of data."""
+        targets = self.data[:, self.fnn.Top[0]]
+        return 100 * np.mean(self.majority_vote(counts) == targets)
+
+    def uncertainty(self, counts=None):
+        """Share of posterior samples disagreeing with the majority vote, per data point."""
+        counts = self.vote_counts() if counts is None else counts
+        return 1 - counts.max(axis=1) / counts.sum(axis=1)
+
+    def __array__(self, dtype=None, copy=None):
+        # only materialized when asked for explicitly, e.g. np.asarray(fx_train); shorter chains are padded with nan
+        out = np.full(self.shape, np.nan, dtype=self.dtype if dtype is None else dtype)
+        for chain, start, block in self.chunks():
+            out[chain, start:start + block.shape[0]] = block
+        return out
+
+
+def load_posterior(path, temperatures=None, burnin=0, mmap=True, memory_budget=256 * 2**20):
+    """ChainArray of the pos_w samples of a finished run, memory-mapped unless mmap is False.
+
+    temperatures selects chains (None for every chain that recorded pos_w) and burnin is the
+    number of stored rows skipped at the start of each. Run-length encoded chains are read
+    together with their runs file.
+    """
+    folder, prefix, suffix = TRACE_FILES['pos_w']['pos_w']
+    stored = sorted(float(name[len(prefix):-len(suffix)]) for name in os.listdir(path + folder) if name.startswith(prefix) and name.endswith(suffix))
+    if temperatures is None:
+        temperatures = stored
+    chains = []
+    for temperature in temperatures:
+        chain = np.load(path + folder + prefix + str(temperature) + suffix, mmap_mode='r' if mmap else None)
+        runs_file = path + RUN_FILE[0] + RUN_FILE[1] + str(temperature) + RUN_FILE[2]
+        if os.path.exists(runs_file):
+            runs = np.load(runs_file)
+            chain = RunLengthArray(chain, runs[:, 1], runs[:, 0])
+        chains.append(chain[burnin:])
+    return ChainArray(chains, memory_budget, list(temperatures))
+
+
+def weighted_quantiles(values, weights, q):
+    """Weighted empirical quantiles q of values along axis 0, the smallest values whose cumulative weight reaches q of the total."""
+    order = np.argsort(values, axis=0)
+    cumulative = np.cumsum(weights[order], axis=0)
+    values = np.take_along_axis(values, order, axis=0)
+    last = values.shape[0] - 1
+    return [np.take_along_axis(values, np.minimum(np.sum(cumulative < p * cumulative[-1], axis=0, keepdims=True), last), axis=0)[0] for p in q]
+
+
+class PredictiveEngine:
+    """Posterior predictive of stored weight samples on any dataset, many samples at once.
+
+    pos_w is a ChainArray of weight samples such as load_posterior returns, of which every
+    thin-th row is used. A run-length encoded chain evaluates each selected state once and
+    weights it by the rows it stands for. Batches of samples go through the network as
+    stacked (S, in, out) matmuls, sized to keep a batch within memory_budget bytes, and the
+    kernel turns the outputs into class probabilities or regression means. The data is taken
+    a chunk of rows at a time, so the predictions of every sample on a chunk fit in memory_budget
+    for their quantiles.
+    """
+
+    def __init__(self, topology, pos_w, kernel=None, thin=1, dtype=np.float64, memory_budget=256 * 2**20):
+        self.topology = topology
+        self.pos_w = pos_w
+        self.kernel = CategoricalKernel() if kernel is None else kernel
+        self.thin = thin
+        self.dtype = np.dtype(dtype)
+        self.memory_budget = memory_budget
+        self.offsets = layer_offsets(topology)
+
+    def batch_size(self, size):
+        # the widest layer output and its activation for every sample of the batch
+        return max(1, self.memory_budget // (2 * size * max(self.topology[1:]) * self.dtype.itemsize))
+
+    def rows_per_chunk(self, samples):
+        # predictions of every sample, their sort order and the noisy copy of a regression
+        return max(1, self.memory_budget // (3 * samples * self.topology[-1] * 8))
+
+    def sample_count(self):
+        """Number of weight samples batches yields, the states of a run-length encoded chain once."""
+        count = 0
+        for chain in self.pos_w.chains:
+            rows = np.arange(0, chain.shape[0], self.thin)
+            count += np.unique(chain.state_index(rows)).size if isinstance(chain, RunLengthArray) else rows.size
+        return count
+
+    def batches(self, batch_size):
+        """Yield (W, weights), up to batch_size weight samples and the number of rows each stands for."""
+        for chain in self.pos_w.chains:
+            rows = np.arange(0, chain.shape[0], self.thin)
+            for start in range(0, rows.size, batch_size):
+                selected = rows[start:start + batch_size]
+                if isinstance(chain, RunLengthArray):
+                    states, counts = np.unique(chain.state_index(selected), return_counts=True)
+                    yield chain.states[states], counts
+                else:
+                    yield chain[selected], None
+
+    def forward(self, W, X):
+        """Outputs (S, N, out) of the S weight samples in W on the N patterns in X."""
+        W = np.asarray(W, dtype=self.dtype)
+        a = X
+        for l, (w0, w1, b0, b1) in enumerate(self.offsets):
+            z = np.matmul(a, W[:, w0:w1].reshape(-1, self.topology[l], self.topology[l + 1]))
+            z -= W[:, np.newaxis, b0:b1]
+            np.negative(z, out=z)
+            np.exp(z, out=z)
+            z += 1
+            a = np.reciprocal(z, out=z)
+        return a
+
+    def predict(self, data, level=0.95, tau_sq=None, seed=None):
+        """Posterior predictive summary of data, streamed over the weight samples.
+
+        Returns a dict with the weighted mean class probabilities or regression means, their
+        std, the lower and upper bounds of the central level interval, weighted empirical
+        quantiles of the per-sample predictions, and the number of samples. A regression kernel
+        needs the observation noise variance tau_sq, which its std includes and which its
+        interval gets from a N(0, tau_sq) draw for every sample, with a generator seeded by seed.
+        When data has a target column the kernel score of the mean, accuracy or rmse, is added.
+        """
+        if self.kernel.uses_noise and tau_sq is None:
+            raise ValueError('the regression predictive needs the noise variance tau_sq')
+        rng = np.random.default_rng(seed)
+        X = np.ascontiguousarray(data[:, :self.topology[0]], dtype=self.dtype)
+        chunk = self.rows_per_chunk(self.sample_count())
+        parts = []
+        for start in range(0, X.shape[0], chunk):
+            rows = X[start:start + chunk]
+            blocks = [(self.kernel.predictive(self.forward(W, rows)), weights) for W, weights in self.batches(self.batch_size(rows.shape[0]))]
+            count, mean, m2 = merged_moments(blocks)
+            values = np.concatenate([block for block, weights in blocks])
+            weights = np.concatenate([np.ones(len(block)) if weights is None else weights for block, weights in blocks])
+            variance = m2 / count
+            if self.kernel.uses_noise:
+                values += rng.normal(0, np.sqrt(tau_sq), values.shape)
+                variance += tau_sq
+            lower, upper = weighted_quantiles(values, weights, (0.5 - level / 2, 0.5 + level / 2))
+            parts.append((mean, np.sqrt(variance), lower, upper))
+        mean, std, lower, upper = (np.concatenate(part) for part in zip(*parts))
+        result = {'mean': mean, 'std': std, 'lower': lower, 'upper': upper, 'samples': count}
+        if data.shape[1] > self.topology[0]:
+            name, value = self.kernel.score(mean, data[:, self.topology[0]])
+            result[name] = value
+        return result
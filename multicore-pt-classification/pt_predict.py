@@ -0,0 +1,56 @@
+""" Posterior predictive of a finished parallel tempering run on a dataset
+
+python pt_predict.py RUN DATA --topology 4,12,3                  mean class probabilities and accuracy of every chain's samples
+python pt_predict.py RUN DATA --topology 4,12,3 --chains cold    T=1 chain only
+python pt_predict.py RUN DATA --topology 5,7,1 --regression --tau-sq 0.01      regression means and rmse, intervals with the noise
+
+RUN is the results folder of the run (the one holding posterior/pos_w) and DATA a text file with the
+features and, optionally, the target column, preprocessed the same way as the training data. The
+intervals are weighted quantiles of the predictions of the samples, regression ones of the predictions
+plus Gaussian noise of variance --tau-sq.
+"""
+
+from __future__ import print_function, division
+import argparse
+import numpy as np
+
+from pt_core import CategoricalKernel, GaussianKernel
+from pt_posterior import PredictiveEngine, load_posterior
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('run')
+    parser.add_argument('data')
+    parser.add_argument('--topology', required=True, help='comma separated layer sizes, e.g. 4,12,3')
+    parser.add_argument('--delimiter', default=None)
+    parser.add_argument('--chains', default='all', choices=['all', 'cold'])
+    parser.add_argument('--burnin', type=int, default=0, help='stored rows skipped at the start of every chain')
+    parser.add_argument('--thin', type=int, default=1)
+    parser.add_argument('--level', type=float, default=0.95, help='coverage of the predictive intervals')
+    parser.add_argument('--regression', action='store_true')
+    parser.add_argument('--tau-sq', type=float, default=None, help='observation noise variance of a regression')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the regression noise draws')
+    parser.add_argument('--no-mmap', action='store_true', help='load the samples instead of memory-mapping them')
+    parser.add_argument('--memory', type=int, default=256, help='MB per batch of samples')
+    parser.add_argument('--save', default=None, help='write mean, lower and upper per data point to this file')
+    args = parser.parse_args()
+    if args.regression and args.tau_sq is None:
+        parser.error('--regression needs --tau-sq')
+
+    topology = [int(size) for size in args.topology.split(',')]
+    data = np.loadtxt(args.data, delimiter=args.delimiter, ndmin=2)
+    pos_w = load_posterior(args.run, [1.0] if args.chains == 'cold' else None, args.burnin, not args.no_mmap)
+    kernel = GaussianKernel() if args.regression else CategoricalKernel()
+    engine = PredictiveEngine(topology, pos_w, kernel, args.thin, memory_budget=args.memory * 2**20)
+    result = engine.predict(data, args.level, args.tau_sq, args.seed)
+
+    print('chains {} samples {:.0f}'.format(pos_w.temperatures, result['samples']))
+    for name in ('accuracy', 'rmse'):
+        if name in result:
+            print('{} {:.4f}'.format(name, result[name]))
+    if args.save is not None:
+        columns = [result['mean'], result['lower'], result['upper']]
+        np.savetxt(args.save, np.column_stack([np.reshape(c, (data.shape[0], -1)) for c in columns]), fmt='%1.5f')
+
+if __name__ == "__main__": main()
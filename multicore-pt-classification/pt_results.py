@@ -0,0 +1,142 @@
+""" SQLite store of the results of parallel tempering runs
+
+python pt_results.py fix_likeh/results.db                                  runs per problem
+python pt_results.py fix_likeh/results.db --problem iris                   runs of a problem, per dropout type and rates
+python pt_results.py fix_likeh/results.db --problem iris --by dropout_type --metrics acc_test swap_perc
+python pt_results.py fix_likeh/results.db --import fix_likeh/*/results/master_result_file.txt
+
+Every run is one row of the runs table, inserted in a transaction, so runs writing to the same
+file at once never leave partial rows. --import reads the rows of legacy master result files, the
+dropout type taken from the fix_likeh/<type>/ folder they are in.
+"""
+
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from pt_core import DropoutType
+
+
+# columns of the result row run_problem appends to result.txt, the rows of the legacy master result files
+RESULT_COLUMNS = ('problem', 'NumSample', 'maxtemp', 'swap_interval', 'use_langevin_gradients', 'learn_rate', 'acc_train', 'acc_train_std', 'acc_train_max', 'acc_test', 'acc_test_std', 'acc_test_max', 'swap_perc', 'accept_per', 'timetotal')
+
+# configuration, metrics, timings and sampler statistics of a run
+SCHEMA = (
+    ('name', 'TEXT'), ('path', 'TEXT'), ('finished', 'REAL'), ('dataset', 'TEXT'), ('problem', 'INTEGER'),
+    ('dropout_type', 'TEXT'), ('input_dropout', 'REAL'), ('hidden_dropout', 'REAL'), ('learn_rate', 'REAL'),
+    ('maxtemp', 'REAL'), ('swap_ratio', 'REAL'), ('swap_interval', 'INTEGER'), ('num_chains', 'INTEGER'),
+    ('NumSample', 'INTEGER'), ('burn_in', 'INTEGER'), ('seed', 'INTEGER'), ('split_seed', 'INTEGER'), ('precision', 'TEXT'), ('use_langevin_gradients', 'INTEGER'),
+    ('acc_train', 'REAL'), ('acc_train_std', 'REAL'), ('acc_train_max', 'REAL'),
+    ('acc_test', 'REAL'), ('acc_test_std', 'REAL'), ('acc_test_max', 'REAL'),
+    ('rmse_train', 'REAL'), ('rmse_test', 'REAL'), ('ensemble_acc_train', 'REAL'), ('ensemble_acc_test', 'REAL'),
+    ('swap_perc', 'REAL'), ('accept_per', 'REAL'), ('timetotal', 'REAL'), ('start_method', 'TEXT'), ('startup', 'REAL'),
+    ('threads', 'INTEGER'), ('blas_threads', 'INTEGER'), ('shards', 'INTEGER'), ('pin', 'INTEGER'), ('config', 'TEXT'),
+)
+COLUMNS = tuple(column for column, _ in SCHEMA)
+
+
+class ResultsStore:
+    """The runs table of an SQLite file, created or extended with the SCHEMA columns on open."""
+
+    def __init__(self, file_name, timeout=60):
+        folder = os.path.dirname(file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(file_name, timeout=timeout) # waits for the writers of other runs
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT)')
+            present = set(row['name'] for row in self.connection.execute('PRAGMA table_info(runs)'))
+            for column, kind in SCHEMA:
+                if column not in present:
+                    self.connection.execute('ALTER TABLE runs ADD COLUMN "{}" {}'.format(column, kind))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS runs_problem ON runs (problem, dataset, dropout_type)')
+
+    def add_run(self, **fields):
+        """Insert a run, fields not in SCHEMA go to the JSON config column. Returns its id."""
+        config = {name: fields.pop(name) for name in list(fields) if name not in COLUMNS}
+        if isinstance(fields.get('dropout_type'), DropoutType):
+            fields['dropout_type'] = fields['dropout_type'].name
+        if config:
+            fields['config'] = json.dumps(config, sort_keys=True, default=str)
+        fields.setdefault('finished', time.time())
+        names = list(fields)
+        with self.connection:
+            cursor = self.connection.execute('INSERT INTO runs ({}) VALUES ({})'.format(', '.join('"{}"'.format(name) for name in names), ', '.join('?' * len(names))), [fields[name] for name in names])
+        return cursor.lastrowid
+
+    def runs(self, problem=None, **equal):
+        """Rows of the runs, of a problem (number or dataset name) and with the given column values."""
+        conditions, values = [], []
+        if problem is not None:
+            conditions.append('(problem = ? OR dataset = ?)')
+            values += [problem, problem]
+        for column, value in equal.items():
+            conditions.append('"{}" = ?'.format(column))
+            values.append(value.name if isinstance(value, DropoutType) else value)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return [dict(row) for row in self.connection.execute('SELECT * FROM runs' + where + ' ORDER BY id', values)]
+
+    def compare(self, problem=None, by=('dropout_type', 'input_dropout', 'hidden_dropout'), metrics=('acc_train', 'acc_test', 'swap_perc', 'accept_per', 'timetotal')):
+        """Count, mean and std of metrics over the runs of a problem grouped by the by columns."""
+        groups = ['dataset'] + [column for column in by if column != 'dataset']
+        select = ['"{}"'.format(column) for column in groups] + ['COUNT(*) AS runs']
+        for metric in metrics:
+            select.append('AVG("{0}") AS "{0}"'.format(metric))
+            select.append('SQRT(MAX(AVG("{0}" * "{0}") - AVG("{0}") * AVG("{0}"), 0)) AS "{0}_std"'.format(metric))
+        where, values = '', []
+        if problem is not None:
+            where, values = ' WHERE problem = ? OR dataset = ?', [problem, problem]
+        group = ', '.join('"{}"'.format(column) for column in groups)
+        return [dict(row) for row in self.connection.execute('SELECT {} FROM runs{} GROUP BY {} ORDER BY {}'.format(', '.join(select), where, group, group), values)]
+
+    def import_master_file(self, file_name, dropout_type=None):
+        """Add the rows of a legacy master_result_file.txt. Returns the number of rows."""
+        count = 0
+        for line in open(file_name):
+            fields = line.split()
+            if len(fields) != len(RESULT_COLUMNS) + 1:
+                continue # a partial line of interleaved writers
+            row = dict(zip(RESULT_COLUMNS, map(float, fields[:-1])))
+            self.add_run(name=fields[-1], dataset=fields[-1].rsplit('_', 1)[0], dropout_type=dropout_type, path=file_name, finished=os.path.getmtime(file_name), **row)
+            count += 1
+        return count
+
+    def close(self):
+        self.connection.close()
+
+
+def print_rows(rows):
+    if not rows:
+        print('no runs')
+        return
+    columns = list(rows[0])
+    print(' '.join('{:>14}'.format(column[:14]) for column in columns))
+    for row in rows:
+        print(' '.join('{:>14.4g}'.format(value) if isinstance(value, float) else '{:>14}'.format(str(value)[:14]) for value in row.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store')
+    parser.add_argument('--problem', default=None, help='number or dataset name')
+    parser.add_argument('--by', nargs='+', default=None)
+    parser.add_argument('--metrics', nargs='+', default=['acc_train', 'acc_test', 'swap_perc', 'accept_per', 'timetotal'])
+    parser.add_argument('--import', dest='imports', nargs='+', default=[], help='legacy master result files')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    for file_name in args.imports:
+        parts = os.path.normpath(file_name).split(os.sep)
+        dropout_type = next((t.name for t in DropoutType for part in parts if part == t.name.lower().replace('_', '')), None)
+        print('{} rows from {}'.format(store.import_master_file(file_name, dropout_type), file_name))
+    problem = int(args.problem) if args.problem is not None and args.problem.isdigit() else args.problem
+    by = args.by if args.by is not None else (['dropout_type', 'input_dropout', 'hidden_dropout'] if problem is not None else [])
+    print_rows(store.compare(problem, by, args.metrics))
+    store.close()
+
+if __name__ == "__main__": main()
@@ -0,0 +1,97 @@
+""" Live status of the replicas of a parallel tempering run
+
+python pt_status.py fix_likeh/dropconnect/results/iris_0              samples, acceptance and throughput of every replica
+python pt_status.py fix_likeh/dropconnect/results/iris_0 --watch 5    the same every 5 seconds until the replicas finish
+
+Every replica keeps its counters in its row of <run folder>/status.bin, float64 rows of STATUS_FIELDS
+mapped by the replicas, the main process and this command. A replica updates its row every
+STATUS_INTERVAL samples and at every swap point, replicas joined over a socket send it with their
+swap messages. ParallelTempering logs a line of the run from it every status_every seconds, the
+lines of every accepted proposal and swap are only printed with verbose.
+"""
+
+from __future__ import print_function, division
+import argparse
+import os
+import time
+import numpy as np
+
+# swap_wait is the seconds spent at swap points, updated the time of the last update, finished 1 once the replica ended
+STATUS_FIELDS = ('temperature', 'iteration', 'samples', 'accepted', 'langevin', 'likelihood', 'samples_per_sec', 'swap_wait', 'updated', 'finished')
+STATUS_FILE = '/status.bin'
+STATUS_INTERVAL = 100 # samples between updates of a replica
+
+
+def create_status(path, num_chains):
+    """Zeroed status rows of num_chains replicas in the run folder path."""
+    return np.memmap(path + STATUS_FILE, np.float64, 'w+', shape=(num_chains, len(STATUS_FIELDS)))
+
+
+def open_status(path, mode='r'):
+    return np.memmap(path + STATUS_FILE, np.float64, mode).reshape(-1, len(STATUS_FIELDS))
+
+
+def replica_row(path, index):
+    # a replica started without the status file of run_chains keeps its counters to itself
+    if os.path.exists(path + STATUS_FILE):
+        return open_status(path, 'r+')[index]
+    return np.zeros(len(STATUS_FIELDS))
+
+
+class ReplicaStatus:
+    """Counters of one replica written to its status row, samples_per_sec since the previous update."""
+
+    def __init__(self, row, temperature, samples):
+        self.row = row
+        self.row[:] = 0
+        self.row[0] = temperature
+        self.row[2] = samples
+        self.swap_wait = 0.0
+        self.last = (0, time.time())
+
+    def post(self, iteration, accepted, langevin, likelihood, finished=False):
+        now = time.time()
+        last_iteration, last_time = self.last
+        rate = self.row[6] # kept when no sample was taken since, at the end of the run
+        if iteration > last_iteration:
+            rate = (iteration - last_iteration) / (now - last_time)
+            self.last = (iteration, now)
+        self.row[1] = iteration
+        self.row[3:] = (accepted, langevin, likelihood, rate, self.swap_wait, now, finished)
+
+
+def status_line(rows):
+    """One line of the whole run: samples of the slowest replica, acceptance, Langevin share, throughput and swap waits."""
+    iteration, samples, accepted, langevin, rate, swap_wait = (rows[:, STATUS_FIELDS.index(name)] for name in ('iteration', 'samples', 'accepted', 'langevin', 'samples_per_sec', 'swap_wait'))
+    done = max(1.0, iteration.sum())
+    coldest = rows[np.argmin(rows[:, 0])]
+    return 'samples {:.0f}/{:.0f} ({:.0f}%), accepted {:.1f}%, langevin {:.1f}%, {:.0f} samples/s, swap wait {:.1f} s mean, likelihood {:.2f} at T={:.2f}, {:.0f}/{} finished'.format(
+        iteration.min(), samples.max(), 100 * iteration.min() / max(1.0, samples.max()), 100 * accepted.sum() / done, 100 * langevin.sum() / done,
+        rate.sum(), swap_wait.mean(), coldest[5], coldest[0], rows[:, -1].sum(), len(rows))
+
+
+def print_status(rows):
+    now = time.time()
+    print('{:>5} {:>8} {:>8} {:>8} {:>9} {:>10} {:>12} {:>10} {:>10} {:>8}'.format('chain', 'T', 'sample', 'of', 'accept %', 'langevin %', 'likelihood', 'samples/s', 'swap wait', 'age'))
+    for index, row in enumerate(rows):
+        temperature, iteration, samples, accepted, langevin, likelihood, rate, swap_wait, updated, finished = row
+        age = 'finished' if finished else ('-' if not updated else '{:.1f} s'.format(now - updated))
+        print('{:>5} {:>8.3f} {:>8.0f} {:>8.0f} {:>9.1f} {:>10.1f} {:>12.3f} {:>10.0f} {:>10.1f} {:>8}'.format(
+            index, temperature, iteration, samples, 100 * accepted / max(1.0, iteration), 100 * langevin / max(1.0, iteration), likelihood, rate, swap_wait, age))
+    print(status_line(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='run folder')
+    parser.add_argument('--watch', type=float, default=None, help='seconds between updates')
+    args = parser.parse_args()
+
+    rows = open_status(args.path.rstrip('/'))
+    print_status(rows)
+    while args.watch is not None and not rows[:, -1].all():
+        time.sleep(args.watch)
+        print()
+        print_status(rows)
+
+if __name__ == "__main__": main()
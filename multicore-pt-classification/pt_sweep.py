@@ -0,0 +1,127 @@
+""" Hyperparameter sweeps of run_problem with a cache of the completed configurations
+
+python pt_sweep.py sweep.json                   run the configurations of the sweep that have no result yet
+python pt_sweep.py sweep.json --cores 32
+python pt_sweep.py sweep.json --dry-run         list the configurations and whether they are done
+python pt_sweep.py sweep.json --table           only collect the results into the table
+
+A sweep file is a JSON object such as
+    {"folder": "sweeps/dropout",
+     "fixed": {"problem": 3, "num_samples": 20000},
+     "grid": {"dropout_type": ["ORIGIN", "DROP_CONNECT", "GAUSSIAN_DROPOUT"], "hidden_dropout": [0.1, 0.2], "seed": [0, 1], "split_seed": [0, 1]},
+     "random": {"samples": 8, "seed": 0, "ranges": {"learn_rate": [0.01, 0.2], "maxtemp": [2, 8]}}}
+fixed and grid hold run_problem keyword arguments. Every point of the grid is run as is, or with samples
+random draws of the ranges when random is given, integers when both bounds are integers.
+
+The result of a configuration is kept in <folder>/runs/<key>.json, key being the hash of the
+configuration and of the dataset files, and configurations with a result are skipped. The rest are
+scheduled on the core budget like pt_launch.py. <folder>/table.csv collects every result of the sweep.
+"""
+
+from __future__ import print_function, division
+import argparse
+import csv
+import functools
+import hashlib
+import itertools
+import json
+import os
+import numpy as np
+
+from pt_datasets import PROBLEMS
+from pt_launch import launch, run_spec
+
+
+def configurations(sweep):
+    fixed = sweep.get('fixed', {})
+    grid = sweep.get('grid', {})
+    points = [dict(fixed, **dict(zip(grid, values))) for values in itertools.product(*grid.values())]
+    if 'random' not in sweep:
+        return points
+    random = sweep['random']
+    rng = np.random.default_rng(random.get('seed', 0))
+    configs = []
+    for point in points:
+        for _ in range(random['samples']):
+            config = dict(point)
+            for name, (low, high) in random['ranges'].items():
+                if isinstance(low, int) and isinstance(high, int):
+                    config[name] = int(rng.integers(low, high + 1))
+                else:
+                    config[name] = round(float(rng.uniform(low, high)), 6)
+            configs.append(config)
+    return configs
+
+
+def config_key(config):
+    # the configuration and the source files of its dataset, a configuration without split_seed is split with seed 0
+    data = PROBLEMS[config['problem']].source_hash()
+    return hashlib.sha1(json.dumps([config, data], sort_keys=True).encode()).hexdigest()[:16]
+
+
+def result_file(folder, key):
+    return os.path.join(folder, 'runs', key + '.json')
+
+
+def write_json(file_name, value):
+    # written next to the file and renamed over it, a result is either complete or absent
+    with open(file_name + '.tmp', 'w') as f:
+        json.dump(value, f, indent=1)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def run_config(folder, config):
+    from pt_results import RESULT_COLUMNS
+    allres, name, path = run_spec(config)
+    write_json(result_file(folder, config_key(config)), {'config': config, 'result': dict(zip(RESULT_COLUMNS, map(float, allres))), 'name': name, 'path': path})
+
+
+def collect(folder, configs):
+    """Write <folder>/table.csv, one row per configuration with a result. Returns the rows."""
+    rows = []
+    for config in configs:
+        file_name = result_file(folder, config_key(config))
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                record = json.load(f)
+            row = dict(record['config'])
+            row.setdefault('split_seed', 0) # the split of run_problem when not configured
+            for column, value in dict(record['result'], name=record['name'], path=record['path']).items():
+                row.setdefault(column, value) # problem, learn_rate and maxtemp as configured
+            rows.append(row)
+    columns = []
+    for row in rows:
+        columns += [column for column in row if column not in columns]
+    with open(os.path.join(folder, 'table.csv.tmp'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(os.path.join(folder, 'table.csv.tmp'), os.path.join(folder, 'table.csv'))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sweep')
+    parser.add_argument('--cores', type=int, default=os.cpu_count())
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--table', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.sweep) as f:
+        sweep = json.load(f)
+    folder = sweep.get('folder', os.path.splitext(args.sweep)[0])
+    os.makedirs(os.path.join(folder, 'runs'), exist_ok=True)
+    configs = configurations(sweep)
+    todo = [config for config in configs if not os.path.exists(result_file(folder, config_key(config)))]
+    print('{} configurations, {} done, {} to run'.format(len(configs), len(configs) - len(todo), len(todo)))
+    if args.dry_run:
+        for config in configs:
+            print(config_key(config), 'todo' if config in todo else 'done', json.dumps(config, sort_keys=True))
+        return
+    if todo and not args.table:
+        launch(todo, args.cores, functools.partial(run_config, folder))
+    rows = collect(folder, configs)
+    print('{} results in {}'.format(len(rows), os.path.join(folder, 'table.csv')))
+
+if __name__ == "__main__": main()
@@ -0,0 +1,155 @@
+""" BLAS thread budget and CPU affinity of the replica processes
+
+python pt_threads.py                  CPUs, NUMA nodes and BLAS pools of this process
+python pt_threads.py --chains 10 --threads 20 --pin     the layout of a run of 10 replicas on 20 cores
+python pt_threads.py --chains 10 --threads 40 --shards 2     the same with the likelihood in 2 shards per replica
+
+A run gets a budget of threads, all the CPUs it may run on by default, and every replica gets
+threads // num_chains cores of it, at least one. A replica evaluating its likelihood in shards
+threads (see pt_core.ShardedKernel) gets at most as many shards as cores, and its BLAS and OpenMP
+pools are limited to cores // shards threads, so that shards times BLAS threads fit in its cores.
+With pin it is bound to its cores, taken in NUMA node order so that a replica stays on one node when it fits.
+The pools of an imported numpy are limited with threadpoolctl when it is installed. Without it,
+the thread variables are set only while replicas are started with spawn or forkserver, which read
+them when they import numpy, and the environment of the run is restored after. Forked replicas
+and the workers of a ReplicaPool then keep the pools of the run, layout.json records whether
+the limit applied in every replica.
+"""
+
+from __future__ import print_function, division
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+
+try:
+    from threadpoolctl import threadpool_info, threadpool_limits
+except ImportError:
+    threadpool_info = threadpool_limits = None
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def numa_nodes():
+    """CPUs of every NUMA node from sysfs, a single node of every CPU when it is not available."""
+    nodes = []
+    for file_name in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'), key=lambda f: int(f.split('/')[-2][4:])):
+        with open(file_name) as f:
+            nodes.append(parse_cpulist(f.read()))
+    return nodes or [list(range(os.cpu_count()))]
+
+
+def allowed_cpus():
+    # the CPUs of this process, in NUMA node order, every CPU where affinity is not available (macOS)
+    allowed = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count())
+    return [cpu for node in numa_nodes() for cpu in node if cpu in allowed] or sorted(allowed)
+
+
+class ReplicaLayout:
+    """BLAS threads and CPUs of each replica of a run, applied by the replica when it starts.
+
+    threads is the budget of the run, the number of cpus by default. With pin, replica i is
+    bound to the next cores of cpus, wrapping around when the replicas need more.
+    """
+
+    def __init__(self, num_chains, threads=None, pin=False, cpus=None, shards=1):
+        self.cpus = allowed_cpus() if cpus is None else list(cpus)
+        self.threads = len(self.cpus) if threads is None else threads
+        self.cores = max(1, self.threads // num_chains)
+        self.shards = max(1, min(shards, self.cores))
+        self.blas_threads = self.cores // self.shards
+        self.pin = pin
+        if pin and not hasattr(os, 'sched_setaffinity'):
+            raise ValueError('pinning replicas needs os.sched_setaffinity, not available on this platform')
+        self.core_sets = [None] * num_chains
+        self.limited = None # whether blas_threads applied in every replica, known once they ran
+        if pin:
+            self.core_sets = [[self.cpus[(i * self.cores + k) % len(self.cpus)] for k in range(self.cores)] for i in range(num_chains)]
+
+    def environment(self):
+        return {name: str(self.blas_threads) for name in THREAD_VARIABLES}
+
+    @contextlib.contextmanager
+    def exported(self):
+        """The thread variables set while replicas are started with spawn or forkserver, restored after.
+
+        A forked replica has numpy loaded already and would only inherit them, a forkserver reads
+        them when the server starts, at the first replica started with it.
+        """
+        saved = {}
+        if multiprocessing.get_start_method() != 'fork':
+            saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+            os.environ.update(self.environment())
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    def apply(self, index):
+        """Bind replica index to its CPUs and limit its pools, returns whether the limit applied."""
+        # the CPUs of the run when not pinned, a ReplicaPool worker may have been pinned by an earlier run
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.core_sets[index] or self.cpus)
+        if threadpool_limits is not None:
+            threadpool_limits(self.blas_threads)
+            return True
+        # the pools of its numpy were sized from its environment when numpy was imported
+        return all(os.environ.get(name) == value for name, value in self.environment().items())
+
+    def metadata(self):
+        return {'threads': self.threads, 'cores': self.cores, 'shards': self.shards, 'blas_threads': self.blas_threads, 'limited': self.limited, 'pin': self.pin, 'cpus': self.cpus, 'core_sets': self.core_sets,
+                'numa_nodes': numa_nodes(), 'start_method': multiprocessing.get_start_method(), 'threadpoolctl': threadpool_limits is not None,
+                'blas': blas_pools()}
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.metadata(), f, indent=1)
+
+
+def blas_limits():
+    """Threads of every BLAS and OpenMP pool loaded here, for restore_blas_limits, None without threadpoolctl."""
+    return None if threadpool_info is None else threadpool_info()
+
+
+def restore_blas_limits(limits):
+    # threadpool_limits takes the list of threadpool_info and sets every pool back to its num_threads
+    if limits is not None:
+        threadpool_limits(limits)
+
+
+def blas_pools():
+    """Library, threading layer and threads of the BLAS and OpenMP pools loaded here, [] without threadpoolctl."""
+    if threadpool_info is None:
+        return []
+    return [{key: pool.get(key) for key in ('internal_api', 'threading_layer', 'num_threads', 'version')} for pool in threadpool_info()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chains', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--pin', action='store_true')
+    parser.add_argument('--shards', type=int, default=1)
+    args = parser.parse_args()
+
+    import numpy # loads the BLAS pools that blas_pools lists
+    metadata = ReplicaLayout(args.chains, args.threads, args.pin, shards=args.shards).metadata()
+    metadata['numpy'] = numpy.__version__
+    print(json.dumps(metadata, indent=1))
+
+if __name__ == "__main__": main()
@@ -6,198 +6,10 @@ from scipy.stats import multivariate_normal
 from scipy.stats import norm
 import math
 import os
+import sys
 
-from enum import Enum
-class DropoutType(Enum):
-    ORIGIN = 1
-    DROP_CONNECT = 2
-    GAUSSIAN_DROPOUT = 3
-# An example of a class
-class Network:
-    def __init__(self, Topo, Train, Test, learn_rate, input_dropout, hidden_dropout, dropout_type: DropoutType):
-        self.Top = Topo  # NN topology [input, hidden, output]
-        self.TrainData = Train
-        self.TestData = Test
-        np.random.seed()
-        self.lrate = learn_rate
-        self.input_dropout = input_dropout
-        self.hidden_dropout = hidden_dropout
-        self.dropout_type = dropout_type
-
-        self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-        self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-        self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-        self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
-
-        self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
-        self.out = np.zeros((1, self.Top[2]))  # output last layer
-
-    def sigmoid(self, x):
-        return 1 / (1 + np.exp(-x))
-
-    def sampleEr(self, actualout):
-        error = np.subtract(self.out, actualout)
-        sqerror = np.sum(np.square(error)) / self.Top[2]
-        return sqerror
-
-    def ForwardPass(self, X, eval=False):
-        if eval:
-            input_dropout = 0
-            hidden_dropout = 0
-        else:
-            input_dropout = self.input_dropout
-            hidden_dropout = self.hidden_dropout
-            
-        if self.dropout_type == DropoutType.ORIGIN:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*z1.shape) > input_dropout).astype(float)
-            z1 = z1 * self.input_dropout_mask / (1.0 - input_dropout) # dropout on z1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-            
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*z2.shape) > hidden_dropout).astype(float)
-            z2 = z2 * self.hidden_dropout_mask / (1.0 - hidden_dropout) # dropout on z2
-            self.out = self.sigmoid(z2)
-        
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(self.W1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*self.W1.shape) > input_dropout).astype(float)
-
-            z1 = X.dot(self.W1 * self.input_dropout_mask / (1.0 - input_dropout)) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(self.W2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*self.W2.shape) > hidden_dropout).astype(float)
-            z2 = self.hidout.dot(self.W2 * self.hidden_dropout_mask / (1.0 - hidden_dropout)) - self.B2
-            self.out = self.sigmoid(z2)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                sigma1 = input_dropout * (1 - input_dropout)
-                self.input_dropout_mask = np.random.normal(1, sigma1, z1.shape)
-            z1  = z1 * self.input_dropout_mask
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                sigma2 = hidden_dropout * (1 - hidden_dropout)
-                self.hidden_dropout_mask = np.random.normal(1, sigma2, z2.shape)
-            z2 = z2 * self.hidden_dropout_mask
-            self.out = self.sigmoid(z2)
-
-        else: # no dropout
-            z1 = X.dot(self.W1) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-            z2 = self.hidout.dot(self.W2) - self.B2
-            self.out = self.sigmoid(z2)  # output second hidden layer
-
-
-    def BackwardPass(self, Input, desired):
-        if self.dropout_type == DropoutType.ORIGIN:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot((self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout))[np.newaxis, :])
-            self.B2 += -self.lrate * (self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout))
-            self.W1 += self.lrate * Input[:, np.newaxis].dot((self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout))[np.newaxis, :])
-            self.B1 += -self.lrate * (self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout))
-
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :]) * self.hidden_dropout_mask / (1.0 - self.hidden_dropout)
-            self.B2 += -self.lrate * (out_delta)
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :]) * self.input_dropout_mask / (1.0 - self.input_dropout)
-            self.B1 += -self.lrate * (hid_delta)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot((self.hidden_dropout_mask * out_delta)[np.newaxis, :])
-            self.B2 += -self.lrate * (self.hidden_dropout_mask * out_delta)
-            self.W1 += self.lrate * Input[:, np.newaxis].dot((self.input_dropout_mask * hid_delta)[np.newaxis, :])
-            self.B1 += -self.lrate * (self.input_dropout_mask * hid_delta)
-        else:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :])
-            self.B2 += -self.lrate * out_delta
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :])
-            self.B1 += -self.lrate * hid_delta
-
-    def decode(self, w):
-        w_layer1size = self.Top[0] * self.Top[1]
-        w_layer2size = self.Top[1] * self.Top[2]
-
-        w_layer1 = w[0:w_layer1size]
-        self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-        w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-        self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-        self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]]
-        self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]]
-
-
-    def encode(self):
-        w1 = self.W1.ravel()
-        w2 = self.W2.ravel()
-        w = np.concatenate([w1, w2, self.B1, self.B2])
-        return w
-
-    def langevin_gradient(self, data, w, depth):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-
-        for i in range(0, depth):
-            for i in range(0, size):
-                pat = i
-                Input = data[pat, 0:self.Top[0]]
-                Desired = data[pat, self.Top[0]:]
-                self.ForwardPass(Input)
-                self.BackwardPass(Input, Desired)
-
-        w_updated = self.encode()
-
-        return  w_updated
-
-    def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-
-        for i in range(0, size):  # to see what fx is produced by your current weight update
-            Input = data[i, 0:self.Top[0]]
-            self.ForwardPass(Input)
-            fx[i] = self.out
-
-        return fx
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'multicore-pt-classification'))
+from pt_core import DropoutType, Network, GaussianKernel, num_parameters # network and likelihood shared with the parallel tempering samplers
 
 
 class MCMC:
@@ -215,29 +27,18 @@ class MCMC:
         self.l_prob = l_prob # likelihood prob
 
         self.learn_rate =  learn_rate
+        self.kernel = GaussianKernel()
         # ----------------
 
     def rmse(self, predictions, targets):
         return np.sqrt(((predictions - targets) ** 2).mean())
 
     def likelihood_func(self, neuralnet, data, w, tausq):
-        y = data[:, self.topology[0]]
-        fx = neuralnet.evaluate_proposal(data, w)
-        rmse = self.rmse(fx, y)
-        #loss = -0.5 * np.log(2 * math.pi * tausq) - 0.5 * np.square(y - fx) / tausq
-
-        n = y.shape[0]
-
-        loss =( -(n/2) * np.log(2 * math.pi * tausq)) -( (1/(2*tausq)) * np.sum(np.square(y - fx)))
+        loss, fx, rmse = self.kernel.log_likelihood(neuralnet, data, w, tausq)
         return [loss, fx, rmse]
 
     def prior_likelihood(self, sigma_squared, nu_1, nu_2, w, tausq):
-        h = self.topology[1]  # number hidden neurons
-        d = self.topology[0]  # number input neurons
-        part1 = -1 * ((d * h + h + 2) / 2) * np.log(sigma_squared)
-        part2 = 1 / (2 * sigma_squared) * (sum(np.square(w)))
-        log_loss = part1 - part2  - (1 + nu_1) * np.log(tausq) - (nu_2 / tausq)
-        return log_loss
+        return self.kernel.log_prior(sigma_squared, nu_1, nu_2, w, tausq)
 
     def sampler(self, w_limit, tau_limit):
 
@@ -258,7 +59,7 @@ class MCMC:
         print(y_train.size)
         print(y_test.size)
 
-        w_size = (netw[0] * netw[1]) + (netw[1] * netw[2]) + netw[1] + netw[2]  # num of weights and bias
+        w_size = num_parameters(netw)  # num of weights and bias
 
         pos_w = np.ones((samples, w_size))  # posterior of all weights and bias over all samples
         pos_tau = np.ones((samples, 1))
@@ -279,11 +80,11 @@ class MCMC:
         step_eta = tau_limit #exp 1
         # --------------------- Declare FNN and initialize
          
-        neuralnet = Network(self.topology, self.traindata, self.testdata, self.learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type)
+        neuralnet = Network(self.topology, self.traindata, self.testdata, self.learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, kernel=self.kernel, eval_dropout=True) # proposals are evaluated with dropout on
         print('evaluate Initial w')
 
-        pred_train = neuralnet.evaluate_proposal(self.traindata, w)
-        pred_test = neuralnet.evaluate_proposal(self.testdata, w)
+        pred_train, _ = neuralnet.evaluate_proposal(self.traindata, w)
+        pred_test, _ = neuralnet.evaluate_proposal(self.testdata, w)
 
         eta = np.log(np.var(pred_train - y_train))
         tau_pro = np.exp(eta)
@@ -129,7 +129,7 @@ class Network:
         for i in range(0, size):  # to see what fx is produced by your current weight update
             Input = data[i, 0:self.Top[0]]
             self.ForwardPass(Input)
-            fx[i] = self.out
+            fx[i] = self.out.item()
 
         return fx
  
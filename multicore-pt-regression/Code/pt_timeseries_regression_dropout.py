@@ -23,201 +23,12 @@ from scipy.stats import norm
 
 import io
 
-from enum import Enum
-class DropoutType(Enum):
-    ORIGIN = 1
-    DROP_CONNECT = 2
-    GAUSSIAN_DROPOUT = 3
-
-class Network:
-
-    def __init__(self, Topo, Train, Test, learn_rate, input_dropout, hidden_dropout, dropout_type: DropoutType):
-        self.Top = Topo  # NN topology [input, hidden, output]
-        self.TrainData = Train
-        self.TestData = Test
-        self.lrate = learn_rate
-        self.input_dropout = input_dropout
-        self.hidden_dropout = hidden_dropout
-        self.dropout_type = dropout_type
-
-        self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-        self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-        self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-        self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
-
-        self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
-        self.out = np.zeros((1, self.Top[2]))  # output last layer
-
-    def sigmoid(self, x):
-        return 1 / (1 + np.exp(-x))
-
-    def sampleEr(self, actualout):
-        error = np.subtract(self.out, actualout)
-        sqerror = np.sum(np.square(error)) / self.Top[2]
-        return sqerror
-
-    def ForwardPass(self, X, eval=False):
-        if eval:
-            input_dropout = 0
-            hidden_dropout = 0
-        else:
-            input_dropout = self.input_dropout
-            hidden_dropout = self.hidden_dropout
-
-        if self.dropout_type == DropoutType.ORIGIN:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*z1.shape) > input_dropout).astype(float)
-            z1 = z1 * self.input_dropout_mask / (1.0 - input_dropout) # dropout on z1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*z2.shape) > hidden_dropout).astype(float)
-            z2 = z2 * self.hidden_dropout_mask / (1.0 - hidden_dropout) # dropout on z2
-            self.out = self.sigmoid(z2)
-
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(self.W1)
-            else:
-                self.input_dropout_mask = (np.random.rand(*self.W1.shape) > input_dropout).astype(float)
-            
-            z1 = X.dot(self.W1 * self.input_dropout_mask / (1.0 - input_dropout)) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(self.W2)
-            else:
-                self.hidden_dropout_mask = (np.random.rand(*self.W2.shape) > hidden_dropout).astype(float)
-            z2 = self.hidout.dot(self.W2 * self.hidden_dropout_mask / (1.0 - hidden_dropout)) - self.B2
-            self.out = self.sigmoid(z2)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            z1 = X.dot(self.W1) - self.B1
-            if input_dropout == 0:
-                self.input_dropout_mask = np.ones_like(z1)
-            else:
-                sigma1 = input_dropout * (1 - input_dropout)
-                self.input_dropout_mask = np.random.normal(1, sigma1, z1.shape)
-            z1  = z1 * self.input_dropout_mask
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-
-            z2 = self.hidout.dot(self.W2) - self.B2
-            if hidden_dropout == 0:
-                self.hidden_dropout_mask = np.ones_like(z2)
-            else:
-                sigma2 = hidden_dropout * (1 - hidden_dropout)
-                self.hidden_dropout_mask = np.random.normal(1, sigma2, z2.shape)
-            z2 = z2 * self.hidden_dropout_mask
-            self.out = self.sigmoid(z2)
-
-        else: # no dropout
-            z1 = X.dot(self.W1) - self.B1
-            self.hidout = self.sigmoid(z1)  # output of first hidden layer
-            z2 = self.hidout.dot(self.W2) - self.B2
-            self.out = self.sigmoid(z2)  # output second hidden layer
-
-    def BackwardPass(self, Input, desired):
-        if self.dropout_type == DropoutType.ORIGIN:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot((self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout))[np.newaxis, :])
-            self.B2 += -self.lrate * (self.hidden_dropout_mask * out_delta / (1.0 - self.hidden_dropout))
-            self.W1 += self.lrate * Input[:, np.newaxis].dot((self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout))[np.newaxis, :])
-            self.B1 += -self.lrate * (self.input_dropout_mask * hid_delta / (1.0 - self.input_dropout))
-
-        elif self.dropout_type == DropoutType.DROP_CONNECT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :]) * self.hidden_dropout_mask / (1.0 - self.hidden_dropout)
-            self.B2 += -self.lrate * (out_delta)
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :]) * self.input_dropout_mask / (1.0 - self.input_dropout)
-            self.B1 += -self.lrate * (hid_delta)
-
-        elif self.dropout_type == DropoutType.GAUSSIAN_DROPOUT:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot((self.hidden_dropout_mask * out_delta)[np.newaxis, :])
-            self.B2 += -self.lrate * (self.hidden_dropout_mask * out_delta)
-            self.W1 += self.lrate * Input[:, np.newaxis].dot((self.input_dropout_mask * hid_delta)[np.newaxis, :])
-            self.B1 += -self.lrate * (self.input_dropout_mask * hid_delta)
-        else:
-            out_delta = (desired - self.out) * (self.out * (1 - self.out))
-            hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
-
-            self.W2 += self.lrate * self.hidout[:, np.newaxis].dot(out_delta[np.newaxis, :])
-            self.B2 += -self.lrate * out_delta
-            self.W1 += self.lrate * Input[:, np.newaxis].dot(hid_delta[np.newaxis, :])
-            self.B1 += -self.lrate * hid_delta
-
-    def decode(self, w):
-        w_layer1size = self.Top[0] * self.Top[1]
-        w_layer2size = self.Top[1] * self.Top[2]
-
-        w_layer1 = w[0:w_layer1size]
-        self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-        w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-        self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-        self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]]
-        self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]]
-
-    def encode(self):
-        w1 = self.W1.ravel()
-        w2 = self.W2.ravel()
-        w = np.concatenate([w1, w2, self.B1, self.B2])
-        return w
-
-    def langevin_gradient(self, data, w, depth):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-
-        for i in range(0, depth):
-            for i in range(0, size):
-                pat = i
-                Input = data[pat, 0:self.Top[0]]
-                Desired = data[pat, self.Top[0]:]
-                self.ForwardPass(Input)
-                self.BackwardPass(Input, Desired)
-
-        w_updated = self.encode()
-
-        return  w_updated
-
-    def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
-
-        self.decode(w)  # method to decode w into W1, W2, B1, B2.
-        size = data.shape[0]
-
-        Input = np.zeros((1, self.Top[0]))  # temp hold input
-        Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros(size)
-
-        for i in range(0, size):  # to see what fx is produced by your current weight update
-            Input = data[i, 0:self.Top[0]]
-            self.ForwardPass(Input, eval=True)
-            fx[i] = self.out
-
-        return fx
- 
-
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'multicore-pt-classification'))
+from pt_core import DropoutType, Network, GaussianKernel, num_parameters # network and likelihood shared with the classification samplers
 
 class ptReplica(multiprocessing.Process):
 
-    def __init__(self, use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, w, minlim_param, maxlim_param, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, langevin_prob, path, parameter_queue, main_process,event ):
+    def __init__(self, use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, w, minlim_param, maxlim_param, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, langevin_prob, path, parameter_queue, main_process,event, kernel=None ):
         #MULTIPROCESSING VARIABLES
         multiprocessing.Process.__init__(self)
         self.processID = temperature
@@ -254,6 +65,8 @@ class ptReplica(multiprocessing.Process):
         self.hidden_dropout = hidden_dropout
         self.dropout_type = dropout_type
 
+        self.kernel = GaussianKernel() if kernel is None else kernel
+
         self.l_prob = langevin_prob  # can be evaluated for diff problems - if data too large keep this low value since the gradients cost comp time
 
         self.w_size = 0
@@ -280,11 +93,8 @@ class ptReplica(multiprocessing.Process):
 
 
     def likelihood_func(self, fnn, data, w, tau_sq):
-        y = data[:, self.topology[0]]
-        fx = fnn.evaluate_proposal(data,w)
-        rmse = self.rmse(fx, y)
-        loss = np.sum(-0.5*np.log(2*math.pi*tau_sq) - 0.5*np.square(y-fx)/tau_sq)
-        return [np.sum(loss)/self.adapttemp, fx, rmse]
+        loss, fx, rmse = self.kernel.log_likelihood(fnn, data, w, tau_sq)
+        return [loss/self.adapttemp, fx, rmse]
 
     '''def prior_likelihood(self, sigma_squared, nu_1, nu_2, w):
         h = self.topology[1]  # number hidden neurons
@@ -295,12 +105,7 @@ class ptReplica(multiprocessing.Process):
         return log_loss'''
 
     def prior_likelihood(self, sigma_squared, nu_1, nu_2, w, tausq):
-        h = self.topology[1]  # number hidden neurons
-        d = self.topology[0]  # number input neurons
-        part1 = -1 * ((d * h + h + 2) / 2) * np.log(sigma_squared)
-        part2 = 1 / (2 * sigma_squared) * (sum(np.square(w)))
-        log_loss = part1 - part2  - (1 + nu_1) * np.log(tausq) - (nu_2 / tausq)
-        return log_loss
+        return self.kernel.log_prior(sigma_squared, nu_1, nu_2, w, tausq)
 
     def run(self):
         #INITIALISING FOR FNN
@@ -317,7 +122,7 @@ class ptReplica(multiprocessing.Process):
 
 
         
-        w_size = (netw[0] * netw[1]) + (netw[1] * netw[2]) + netw[1] + netw[2]  # num of weights and bias
+        w_size = num_parameters(netw)  # num of weights and bias
         self.w_size = w_size
         pos_w = np.ones((samples, w_size)) #Posterior for all weights
         #pos_w = np.ones((samples, w_size)) #Posterior for all weights
@@ -341,12 +146,12 @@ class ptReplica(multiprocessing.Process):
 
         step_eta = 0.2
         #Declare FNN
-        fnn = Network(self.topology, self.traindata, self.testdata, learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type)
+        fnn = Network(self.topology, self.traindata, self.testdata, learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, kernel=self.kernel)
 
         print(self.topology, ' topo')
         #Evaluate Proposals
-        pred_train  = fnn.evaluate_proposal(self.traindata,w) #    
-        pred_test  = fnn.evaluate_proposal(self.testdata, w) #
+        pred_train, _ = fnn.evaluate_proposal(self.traindata,w) #    
+        pred_test, _ = fnn.evaluate_proposal(self.testdata, w) #
         #Check Variance of Proposal
 
         eta = np.log(np.var(pred_train - y_train))
@@ -510,9 +315,9 @@ class ptReplica(multiprocessing.Process):
                 print(i)
                 # print('\nTemperature: {} Swapping weights: {}'.format(self.temperature, w[:2]))
                 param = np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood*self.temperature]),np.asarray([self.temperature])])
+                self.event.clear() # before signalling, or the main process can set it first and the wait never returns
                 self.parameter_queue.put(param)
                 self.signal_main.set()
-                self.event.clear()
                 self.event.wait()
                 result =  self.parameter_queue.get()
                 w = result[0:self.w_size]
@@ -570,12 +375,12 @@ class ptReplica(multiprocessing.Process):
 
 class ParallelTempering:
 
-    def __init__(self,  use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, langevin_prob, path):
+    def __init__(self,  use_langevin_gradients, learn_rate, input_dropout, hidden_dropout, dropout_type, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, langevin_prob, path, kernel=None):
         #FNN Chain variables
         self.traindata = traindata
         self.testdata = testdata
         self.topology = topology
-        self.num_param = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
+        self.num_param = num_parameters(topology)
         #Parallel Tempering variables
         self.swap_interval = swap_interval
         self.path = path
@@ -609,6 +414,7 @@ class ParallelTempering:
         self.input_dropout = input_dropout
         self.hidden_dropout = hidden_dropout
         self.dropout_type = dropout_type
+        self.kernel = GaussianKernel() if kernel is None else kernel
 
         self.use_langevin_gradients = use_langevin_gradients
 
@@ -733,7 +539,7 @@ class ParallelTempering:
         for i in range(0, self.num_chains):
 
             w = np.random.randn(self.num_param)
-            self.chains.append(ptReplica( self.use_langevin_gradients, self.learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, w, self.minlim_param, self.maxlim_param, self.NumSamples,self.traindata,self.testdata,self.topology,self.burn_in,self.temperatures[i],self.swap_interval, self.langevin_prob, self.path,self.parameter_queue[i],self.wait_chain[i],self.event[i]))
+            self.chains.append(ptReplica( self.use_langevin_gradients, self.learn_rate, self.input_dropout, self.hidden_dropout, self.dropout_type, w, self.minlim_param, self.maxlim_param, self.NumSamples,self.traindata,self.testdata,self.topology,self.burn_in,self.temperatures[i],self.swap_interval, self.langevin_prob, self.path,self.parameter_queue[i],self.wait_chain[i],self.event[i], self.kernel))
 
     def surr_procedure(self,queue):
 
@@ -834,8 +640,8 @@ class ParallelTempering:
                     total_swaps_main += 1
 
             for index in range (self.num_chains):
+                    self.wait_chain[index].clear() # before releasing the chain, or its next signal can be cleared
                     self.event[index].set()
-                    self.wait_chain[index].clear()
 
         print("Joining processes")
 